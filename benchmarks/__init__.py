@@ -0,0 +1,5 @@
+"""
+Benchmarks of stats-code: deterministic synthetic trees, timings of each stage
+of a scan and of whole scans, with comparison against a stored baseline.
+Run with `python -m benchmarks --help`.
+"""
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from pathlib import Path
+from .stages import Timing, run_stages
+from .synthetic import generate_tree
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+
+def compare(
+    timings: dict[str, Timing], baseline: dict[str, Timing], threshold: float
+) -> list[str]:
+    """
+    Print the ratio of each stage to the baseline, and return the regressed ones.
+    """
+    regressed: list[str] = []
+    print(f"{'stage':<20} {'min (s)':>10} {'baseline':>10} {'ratio':>7}")
+    for name, timing in timings.items():
+        base = baseline.get(name)
+        if base is None or not base["min"]:
+            print(f"{name:<20} {timing['min']:>10.4f} {'-':>10} {'-':>7}")
+            continue
+        ratio = timing["min"] / base["min"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressed.append(name)
+            flag = "  <- regression"
+        print(
+            f"{name:<20} {timing['min']:>10.4f} {base['min']:>10.4f} {ratio:>6.2f}x{flag}"
+        )
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark stats-code.")
+    parser.add_argument(
+        "--tree",
+        type=str,
+        default=os.path.join(tempfile.gettempdir(), "stats-code-bench-tree"),
+        help="Where the synthetic tree is generated, and reused if up to date",
+    )
+    parser.add_argument(
+        "--path",
+        type=str,
+        default=None,
+        help="Benchmark an existing tree (e.g. a CPython checkout) instead",
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="Size of the tree")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the tree")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage")
+    parser.add_argument(
+        "--stages", nargs="*", default=None, help="Only run these stages"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the results as JSON"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=str(BASELINE_PATH),
+        help=f"Results to compare against (default: {BASELINE_PATH})",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store these results as the baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown ratio reported as a regression (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    if args.path:
+        root = Path(os.path.abspath(args.path))
+        tree: dict[str, object] = {"path": str(root)}
+    else:
+        root = Path(os.path.abspath(args.tree))
+        tree = {"scale": args.scale, "seed": args.seed}
+        tree.update(generate_tree(root, args.scale, args.seed))
+    timings = run_stages(root, args.repeat, args.stages)
+    results = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tree": tree,
+        },
+        "stages": timings,
+    }
+
+    regressed: list[str] = []
+    baseline_path = Path(args.baseline)
+    if baseline_path.exists() and not args.save_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if baseline.get("meta", {}).get("tree") != tree:
+            print("Warning: the baseline was measured on another tree")
+        regressed = compare(timings, baseline.get("stages", {}), args.threshold)
+    else:
+        compare(timings, {}, args.threshold)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Baseline saved to {baseline_path}")
+    if regressed:
+        print(f"Regressions: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from pathlib import Path
+from typing import Callable
+from stats_code.counter import classify_files, collect_files, counter
+from stats_code.language_config import LanguageConfig
+from stats_code.line_classifier import LineClassifier, LineCounts
+from stats_code.result import Result
+from stats_code.utils import counter_lines_in_file
+
+"""
+Timings of each stage of a scan, so that a regression can be blamed on a
+specific subsystem, and of whole scans.
+"""
+
+# (min, median) seconds of the repeated runs
+Timing = dict[str, float | int]
+
+
+def measure(run: Callable[[], object], repeat: int, items: int) -> Timing:
+    times: list[float] = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start_time)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "repeat": repeat,
+        "items": items,
+    }
+
+
+class Workload:
+    """
+    The inputs of every stage, gathered once from a walk of the tree so that
+    each stage is timed on its own.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.config = LanguageConfig.from_yaml()
+        self.result = Result(self.config.languages)
+        # (files of a directory, its node, its gitignore rules, their stats,
+        #  their devices)
+        self.tasks = list(
+            collect_files(self.result, root, Result.ROOT, False, [], self.config)
+        )
+        self.files = [file_path for files, *_ in self.tasks for file_path in files]
+        # (file, node, language)
+        self.counted: list[tuple[Path, int, int]] = [
+            (file_path, node_id, language_id)
+            for files, node_id, _, language_ids, _ in classify_files(
+                self.tasks, self.config
+            )
+            for file_path, language_id in zip(files, language_ids)
+        ]
+        self.contents = [file_path.read_bytes() for file_path, _, _ in self.counted]
+
+    def walk(self) -> None:
+        result = Result(self.config.languages)
+        for _ in collect_files(result, self.root, Result.ROOT, False, [], self.config):
+            pass
+
+    def ignore(self) -> None:
+        # the rules are compiled by the walk, only matching is timed here
+        for files, _, rules, _, _ in self.tasks:
+            if rules is not None:
+                for file_path in files:
+                    rules.match(file_path)
+
+    def lookup(self) -> None:
+        # a cold memo, as in a fresh process
+        lookup = self.config.detect_language_by_path
+        self.config.clear_lookup_memo()
+        for file_path in self.files:
+            lookup(file_path)
+
+    def filter(self) -> None:
+        # git files, gitignore, skip config and language lookup of every file
+        self.config.clear_lookup_memo()
+        for _ in classify_files(self.tasks, self.config):
+            pass
+
+    def count(self) -> None:
+        languages = self.config.languages
+        for file_path, _, language_id in self.counted:
+            counter_lines_in_file(file_path, languages[language_id]._syntax)
+
+    def newlines(self) -> None:
+        # the lower bound of counting lines in memory
+        for content in self.contents:
+            content.count(b"\n")
+
+    def classify(self) -> None:
+        languages = self.config.languages
+        for content, (_, _, language_id) in zip(self.contents, self.counted):
+            classifier = LineClassifier(languages[language_id]._syntax)
+            classifier.feed(content)
+            classifier.finish()
+
+    def aggregate(self) -> None:
+        # merge packed totals of batches into a new tree, then roll it up
+        result = Result(self.config.languages)
+        for _, parent, name in self.result.nodes():
+            result.add_node(parent, name)
+        counts = LineCounts(10, 2, 3)
+        for start in range(0, len(self.counted), 2000):
+            totals: dict[tuple[int, int], list[int]] = {}
+            for _, node_id, language_id in self.counted[start : start + 2000]:
+                total = totals.setdefault((node_id, language_id), [0, 0, 0])
+                total[0] += counts.code
+                total[1] += counts.comment
+                total[2] += counts.blank
+            packed = array("q")
+            for (node_id, language_id), (code, comment, blank) in totals.items():
+                packed.extend((node_id, language_id, code, comment, blank))
+            result.add_packed(packed)
+        # roll the tree up, as read by the outputs
+        total = result.total
+        assert total, "nothing was aggregated"
+        result.directories(1)
+
+    def end_to_end(self, executor: str) -> None:
+        counter(self.root, False, None, executor=executor)
+
+
+def import_time() -> float:
+    """
+    Import time of the command line entry point, as reported by -X importtime.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import stats_code.__main__"],
+        capture_output=True,
+        text=True,
+    ).stderr
+    matched = re.search(r"\|\s*(\d+) \| stats_code\.__main__$", output, re.M)
+    return int(matched.group(1)) / 1e6 if matched else float("nan")
+
+
+def startup(cache_dir: str) -> None:
+    """
+    A whole run on an empty directory, which is mostly fixed costs.
+    """
+    with tempfile.TemporaryDirectory() as empty_dir:
+        subprocess.run(
+            [sys.executable, "-m", "stats_code", empty_dir, "--format", "csv"]
+            + ["--cache-dir", cache_dir],
+            capture_output=True,
+            check=True,
+        )
+
+
+def run_stages(root: Path, repeat: int, only: list[str] | None) -> dict[str, Timing]:
+    workload = Workload(root)
+    files = len(workload.files)
+    counted = len(workload.counted)
+    stages: dict[str, tuple[Callable[[], object], int]] = {
+        "walk": (workload.walk, files),
+        "ignore": (workload.ignore, files),
+        "lookup": (workload.lookup, files),
+        "filter": (workload.filter, files),
+        "count": (workload.count, counted),
+        "newlines": (workload.newlines, counted),
+        "classify": (workload.classify, counted),
+        "aggregate": (workload.aggregate, counted),
+        "end_to_end_serial": (lambda: workload.end_to_end("serial"), counted),
+        "end_to_end_process": (lambda: workload.end_to_end("process"), counted),
+        "end_to_end_thread": (lambda: workload.end_to_end("thread"), counted),
+    }
+    timings: dict[str, Timing] = {}
+    for name, (run, items) in stages.items():
+        if only is None or name in only:
+            timings[name] = measure(run, repeat, items)
+    if only is None or "startup" in only:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            startup(cache_dir)  # build the config cache
+            timings["startup"] = measure(lambda: startup(cache_dir), repeat, 1)
+    if only is None or "import" in only:
+        times = [import_time() for _ in range(repeat)]
+        timings["import"] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "repeat": repeat,
+            "items": 1,
+        }
+    return timings
@@ -0,0 +1,151 @@
+import json
+import random
+import shutil
+from pathlib import Path
+
+"""
+Deterministic synthetic trees, covering the shapes which stress each stage:
+many small files, a few huge files, deep nesting, many nested .gitignore
+files, node_modules-style trees and mixed encodings.
+"""
+
+# bump when the generated content changes, so cached trees are regenerated
+TREE_VERSION = 1
+MARKER_NAME = ".stats-code-bench.json"
+
+_PYTHON_LINES = [
+    "import os",
+    "def handler_{n}(value):",
+    "    # convert the value before use",
+    '    """',
+    "    Docstring of handler {n}.",
+    '    """',
+    "    result = value * {n}  # inline comment",
+    "    return str(result)",
+    "",
+    "class Model{n}:",
+    "    name = 'model {n} # not a comment'",
+    "",
+]
+_C_LINES = [
+    "#include <stdio.h>",
+    "/* block comment",
+    " * of function {n}",
+    " */",
+    "static int function_{n}(int value) {{",
+    "    // line comment",
+    '    const char *s = "/* not a comment */";',
+    "    return value + {n};",
+    "}}",
+    "",
+]
+_JS_LINES = [
+    "const value{n} = require('./module{n}');",
+    "// line comment",
+    "function run{n}(x) {{",
+    "  const template = `multi",
+    "  line {n}`;",
+    "  return x + {n}; /* trailing */",
+    "}}",
+    "",
+    "module.exports = run{n};",
+]
+_SOURCES = [(".py", _PYTHON_LINES), (".c", _C_LINES), (".js", _JS_LINES)]
+
+
+def _source(rng: random.Random, lines: list[str], target_lines: int) -> str:
+    out: list[str] = []
+    while len(out) < target_lines:
+        n = rng.randrange(1000)
+        start = rng.randrange(len(lines))
+        out.extend(line.format(n=n) for line in lines[start:] + lines[:start])
+    return "\n".join(out[:target_lines]) + "\n"
+
+
+def _write(path: Path, content: str | bytes, stats: dict[str, int]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    path.write_bytes(data)
+    stats["files"] += 1
+    stats["bytes"] += len(data)
+
+
+def generate_tree(root: Path, scale: float = 1.0, seed: int = 0) -> dict[str, int]:
+    """
+    Generate the synthetic tree under `root`, unless the one already there
+    was generated with the same parameters. Return its file and byte counts.
+    """
+    marker = root / MARKER_NAME
+    params = {"version": TREE_VERSION, "scale": scale, "seed": seed}
+    try:
+        existing = json.loads(marker.read_text(encoding="utf-8"))
+        if existing.get("params") == params:
+            return dict(existing["stats"])
+    except (OSError, ValueError):
+        pass
+    if root.exists():
+        shutil.rmtree(root)
+    rng = random.Random(seed)
+    stats = {"files": 0, "bytes": 0}
+    # counted as a git repo, so .gitignore files apply
+    (root / ".git").mkdir(parents=True)
+    _write(root / ".gitignore", "*.log\nnode_modules/\nbuild/\n!keep.log\n", stats)
+
+    # many small files in a wide, shallow tree
+    for i in range(int(5000 * scale)):
+        suffix, lines = _SOURCES[i % len(_SOURCES)]
+        path = root / "src" / f"pkg{i % 50}" / f"mod{i // 50 % 20}" / f"file{i}{suffix}"
+        _write(path, _source(rng, lines, rng.randrange(5, 120)), stats)
+
+    # a few huge files
+    for i, (suffix, lines) in enumerate(_SOURCES[:2]):
+        _write(
+            root / "huge" / f"generated{i}{suffix}",
+            _source(rng, lines, int(250_000 * scale)),
+            stats,
+        )
+
+    # deep nesting
+    deep = root / "deep"
+    for depth in range(int(150 * max(scale, 0.2))):
+        deep = deep / f"d{depth}"
+        _write(deep / "leaf.py", _source(rng, _PYTHON_LINES, 10), stats)
+
+    # many nested .gitignore files, with re-included files
+    nested = root / "nested"
+    for i in range(int(40 * max(scale, 0.25))):
+        nested = nested / f"n{i}"
+        _write(
+            nested / ".gitignore", f"*.tmp{i}\n/ignored{i}/\n!keep{i}.tmp{i}\n", stats
+        )
+        _write(nested / f"keep{i}.tmp{i}", "kept\n", stats)
+        _write(nested / f"drop{i}.tmp{i}", "dropped\n", stats)
+        _write(nested / f"ignored{i}" / "file.py", "x = 1\n", stats)
+        _write(nested / f"code{i}.js", _source(rng, _JS_LINES, 30), stats)
+
+    # node_modules-style trees, pruned by .gitignore
+    for i in range(int(1000 * scale)):
+        package = root / "web" / "node_modules" / f"package{i % 100}"
+        _write(package / "lib" / f"index{i}.js", _source(rng, _JS_LINES, 40), stats)
+    _write(root / "web" / "app.js", _source(rng, _JS_LINES, 200), stats)
+
+    # mixed encodings, line endings and binary files
+    for i in range(int(200 * scale)):
+        text = _source(rng, _PYTHON_LINES, 50).replace("Docstring", "Dôcstring")
+        kind = i % 6
+        path = root / "encodings" / f"file{i}.py"
+        if kind == 0:
+            _write(path, text.encode("utf-16"), stats)
+        elif kind == 1:
+            _write(path, text.encode("latin-1"), stats)
+        elif kind == 2:
+            _write(path, text.replace("\n", "\r\n"), stats)
+        elif kind == 3:
+            _write(path, text.replace("\n", "\r"), stats)
+        elif kind == 4:
+            _write(path, text.encode("utf-8-sig"), stats)
+        else:
+            _write(root / "encodings" / f"blob{i}.bin", rng.randbytes(4096), stats)
+
+    marker.write_text(json.dumps({"params": params, "stats": stats}), encoding="utf-8")
+    return stats
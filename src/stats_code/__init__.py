@@ -0,0 +1,34 @@
+from typing import TYPE_CHECKING
+from .counter import ScanCancelled, counter
+from .language_config import Language, LanguageConfig
+from .line_classifier import LineCounts
+from .result import Result
+
+if TYPE_CHECKING:
+    from .scanner import ScannedFile, Scanner
+
+"""
+Count code, comment and blank lines of source trees. `Scanner` is the entry
+point for programs scanning many trees, `counter()` runs a single scan.
+The command line tool imports the other names anyway, but not the scanner,
+which is only imported when first used.
+"""
+
+__all__ = [
+    "Language",
+    "LanguageConfig",
+    "LineCounts",
+    "Result",
+    "ScanCancelled",
+    "ScannedFile",
+    "Scanner",
+    "counter",
+]
+
+
+def __getattr__(name: str) -> object:
+    if name not in ("ScannedFile", "Scanner"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from . import scanner
+
+    return getattr(scanner, name)
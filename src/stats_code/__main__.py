@@ -1,30 +1,471 @@
 import argparse
 import os
-from .counter import counter
-from .render import render_stats
+import sys
+from typing import Any, TextIO
+from contextlib import redirect_stdout
+from .counter import DEFAULT_MAX_FILE_SIZE, LARGE_FILE_POLICIES, counter
+from .output import (
+    FORMATS,
+    NdjsonWriter,
+    write_csv,
+    write_history_csv,
+    write_history_json,
+    write_json,
+)
+from .render import render_duplicates, render_history, render_roots, render_stats
+from .result import DEFAULT_TIME_BUDGET
+from .scan_profile import ScanProfile
+from .cache import default_cache_dir
+from .executor import EXECUTORS
 from pathlib import Path
 
+# duplicate groups reported by `--duplicates` without a number
+DEFAULT_DUPLICATES = 20
+
 
 def main() -> None:
+    if sys.argv[1:2] == ["watch"]:
+        _watch_main(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(
-        description="Counter code lines in a github style."
+        description="Counter code lines in a github style. "
+        "Run `stats-code watch --help` for the watch mode."
     )
     parser.add_argument(
-        "path", nargs="?", type=str, help="Path to the begin directory."
+        "path",
+        nargs="*",
+        type=str,
+        help="Path to the begin directory or archive, or several roots counted "
+        "together.",
+    )
+    parser.add_argument(
+        "--roots-from",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="Read more roots from FILE, one path per line ('-' for stdin)",
     )
     parser.add_argument(
         "--no-git",
         action="store_true",
         help="Disable gitignore rules (enabled by default)",
     )
+    parser.add_argument(
+        "--git-index",
+        action="store_true",
+        help="Enumerate files of git repos from .git/index instead of walking the tree",
+    )
+    parser.add_argument(
+        "--untracked",
+        action="store_true",
+        help="With --git-index, also count untracked files which are not ignored",
+    )
+    parser.add_argument(
+        "--rev",
+        type=str,
+        default=None,
+        help="Count the tree of a git revision instead of the work tree, "
+        "or the history up to it with --since or --every",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        default=None,
+        metavar="DATE",
+        help="Count every first-parent commit since DATE (any date git log accepts)",
+    )
+    parser.add_argument(
+        "--every",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Count one first-parent commit out of N, up to --rev",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Hash files while reading them, classify each distinct content once "
+        "and also report unique lines, counting identical files once",
+    )
+    parser.add_argument(
+        "--duplicates",
+        type=int,
+        nargs="?",
+        const=DEFAULT_DUPLICATES,
+        default=None,
+        metavar="N",
+        help="With --dedup, also report the N groups of identical files with the "
+        f"most duplicated lines (default: {DEFAULT_DUPLICATES}), "
+        "except in the csv output",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=_size,
+        default=DEFAULT_MAX_FILE_SIZE,
+        metavar="SIZE",
+        help="Size in bytes (or with a K, M or G suffix) above which files are "
+        f"handled by --large-files (default: {DEFAULT_MAX_FILE_SIZE >> 20}M)",
+    )
+    parser.add_argument(
+        "--large-files",
+        choices=LARGE_FILE_POLICIES,
+        default="full",
+        help="Count files above --max-file-size in line aligned ranges in parallel, "
+        "only count their lines as code, or skip them (default: full)",
+    )
+    parser.add_argument(
+        "--archives",
+        action="store_true",
+        help="Also count inside the .zip and .tar(.gz, .bz2, .xz, .zst) archives "
+        "found in the tree, without extracting them",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Estimate line counts, with confidence margins, from a sample of the "
+        "files stratified by language and size, within --time-budget or "
+        "--file-budget",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="With --estimate, stop counting files after SECONDS "
+        f"(default: {DEFAULT_TIME_BUDGET:g} unless --file-budget is given)",
+    )
+    parser.add_argument(
+        "--file-budget",
+        type=int,
+        default=None,
+        metavar="N",
+        help="With --estimate, stop counting files after N files",
+    )
+    _add_executor_arguments(parser)
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="table",
+        help="Output format, ndjson streams a record per file while scanning "
+        "(default: table)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Report stage timings, file counters, worker usage and slowest files",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="Write a viztracer trace of the scan to FILE (needs viztracer)",
+    )
+    _add_cache_arguments(parser)
 
     args = parser.parse_args()
-    path = args.path if args.path else os.getcwd()
+    if args.every is not None and args.every < 1:
+        parser.error("--every must be at least 1")
+    history = args.rev is not None or args.since is not None or args.every is not None
+    roots = _roots(args.path, args.roots_from)
+    if not roots:
+        roots = [Path(os.getcwd())]
+    if history and len(roots) > 1:
+        parser.error("--rev, --since and --every count a single path")
+    if history and args.dedup:
+        parser.error("--dedup counts the work tree, not a revision")
+    if args.duplicates is not None and not args.dedup:
+        parser.error("--duplicates needs --dedup")
+    if args.estimate and (
+        history or args.dedup or len(roots) > 1 or args.archives or roots[0].is_file()
+    ):
+        parser.error(
+            "--estimate counts a single work tree, without --dedup or --archives"
+        )
+    if (args.time_budget is not None or args.file_budget is not None) and not (
+        args.estimate
+    ):
+        parser.error("--time-budget and --file-budget need --estimate")
     no_git_flag = bool(args.no_git)
+    cache_dir = _cache_dir(args)
+
+    abs_path = roots[0]
+    # several roots are the children of a root node named by their absolute path
+    path: Path | list[Path] = abs_path if len(roots) == 1 else roots
+    out = sys.stdout
+    ndjson = (
+        NdjsonWriter(out, str(abs_path) if len(roots) == 1 else None, args.duplicates)
+        if args.format == "ndjson"
+        else None
+    )
+    profile = ScanProfile() if args.profile else None
+    tracer = _start_tracer(args.trace) if args.trace else None
+    if history:
+        with redirect_stdout(sys.stderr if args.format != "table" else out):
+            _history(args, abs_path, cache_dir, out, ndjson, profile)
+        if tracer is not None:
+            tracer.stop()
+            tracer.save()
+        return
+    # keep progress and error messages out of machine readable outputs
+    with redirect_stdout(sys.stderr if args.format != "table" else out):
+        if args.estimate:
+            # the estimate and history modes are only imported when used
+            from .estimate import estimate
+
+            time_budget = args.time_budget
+            if time_budget is None and args.file_budget is None:
+                time_budget = DEFAULT_TIME_BUDGET
+            result = estimate(
+                abs_path,
+                no_git_flag,
+                time_budget,
+                args.file_budget,
+                git_index_flag=bool(args.git_index),
+                untracked_flag=bool(args.untracked),
+                jobs=args.jobs,
+                executor=args.executor,
+                cache_dir=cache_dir,
+                profile=profile,
+                on_round=ndjson.estimate if ndjson is not None else None,
+            )
+        else:
+            result = counter(
+                path,
+                no_git_flag,
+                cache_dir,
+                git_index_flag=bool(args.git_index),
+                untracked_flag=bool(args.untracked),
+                jobs=args.jobs,
+                executor=args.executor,
+                on_file=ndjson.file if ndjson is not None else None,
+                profile=profile,
+                dedup=bool(args.dedup),
+                max_file_size=args.max_file_size,
+                large_file_policy=args.large_files,
+                archives_flag=bool(args.archives),
+            )
+    if tracer is not None:
+        tracer.stop()
+        tracer.save()
+    if args.format == "table":
+        if len(roots) > 1:
+            render_roots(result)
+        render_stats(result)
+        if args.duplicates is not None:
+            render_duplicates(result, args.duplicates)
+        if profile is not None:
+            print(profile.report())
+    elif args.format == "json":
+        write_json(result, out, profile, args.duplicates)
+    elif args.format == "csv":
+        write_csv(result, out, by_root=len(roots) > 1)
+        if profile is not None:
+            print(profile.report(), file=sys.stderr)
+    elif ndjson is not None:
+        ndjson.finish(result, profile)
+
+
+def _size(value: str) -> int:
+    """
+    Parse a size in bytes, with an optional K, M or G binary suffix.
+    """
+    shift = {"K": 10, "M": 20, "G": 30}.get(value[-1:].upper(), 0)
+    number = value[:-1] if shift else value
+    try:
+        size = int(number) << shift
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"size must be positive: {value!r}")
+    return size
+
+
+def _roots(paths: list[str], roots_from: str | None) -> list[Path]:
+    """
+    Absolute paths of the roots given as arguments, then of those listed in
+    `roots_from`, skipping blank lines, comments and repeated roots.
+    """
+    if roots_from is not None:
+        try:
+            if roots_from == "-":
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(roots_from, "r", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+        except OSError as e:
+            print(f"Cannot read roots from {roots_from}: {e}", file=sys.stderr)
+            sys.exit(1)
+        paths = paths + [
+            line.strip()
+            for line in lines
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+    roots = dict.fromkeys(Path(os.path.abspath(path)) for path in paths)
+    return list(roots)
+
+
+def _add_executor_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of workers (default: cpu count + 1 processes, or more threads)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default=None,
+        help="Count files in a process pool, a thread pool or a single process "
+        "(default: threads on network file systems, processes otherwise)",
+    )
+
+
+def _add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help=f"Directory of the incremental scan cache (default: {default_cache_dir()})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Disable the incremental scan cache (enabled by default)",
+    )
+
+
+def _cache_dir(args: argparse.Namespace) -> Path | None:
+    if args.no_cache:
+        return None
+    return Path(args.cache_dir) if args.cache_dir else default_cache_dir()
+
+
+def _watch_main(argv: list[str]) -> None:
+    # the watch mode is only imported when used
+    from .watch import QUERIES, default_socket_path, query, watch
+
+    parser = argparse.ArgumentParser(
+        prog="stats-code watch",
+        description="Scan a directory once, then keep its stats up to date from "
+        "file changes, and serve them as JSON over a Unix socket.",
+    )
+    parser.add_argument(
+        "path", nargs="?", type=str, help="Path to the begin directory."
+    )
+    parser.add_argument(
+        "--no-git",
+        action="store_true",
+        help="Disable gitignore rules (enabled by default)",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Path of the Unix socket (default: one per directory in the temp dir)",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Walk the tree every SECONDS instead of using inotify "
+        "(default: inotify when available)",
+    )
+    parser.add_argument(
+        "--query",
+        nargs="?",
+        const="total",
+        choices=QUERIES,
+        default=None,
+        help="Print the stats served by a running watcher and exit: "
+        "the totals of the tree and of its repos, or the whole tree",
+    )
+    _add_executor_arguments(parser)
+    _add_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+    abs_path = Path(os.path.abspath(args.path if args.path else os.getcwd()))
+    socket_path = Path(args.socket) if args.socket else default_socket_path(abs_path)
+    if args.query is not None:
+        try:
+            sys.stdout.buffer.write(query(socket_path, args.query))
+        except OSError as e:
+            print(f"Cannot query the watcher on {socket_path}: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    # stop like on Ctrl-C when run as a service, so the socket is removed
+    import signal
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        watch(
+            abs_path,
+            bool(args.no_git),
+            socket_path,
+            _cache_dir(args),
+            jobs=args.jobs,
+            executor=args.executor,
+            poll=args.poll,
+        )
+    except OSError as e:
+        print(f"Cannot watch {abs_path}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _history(
+    args: argparse.Namespace,
+    abs_path: Path,
+    cache_dir: Path | None,
+    out: TextIO,
+    ndjson: NdjsonWriter | None,
+    profile: ScanProfile | None,
+) -> None:
+    """
+    Count the commits selected by --rev, --since and --every, and write them
+    as a time series, streamed as they are counted except for the table.
+    """
+    from .history import GitHistoryError, count_history
+
+    commits = count_history(
+        abs_path, args.rev or "HEAD", args.since, args.every, cache_dir, profile
+    )
+    try:
+        if args.format == "table":
+            series = list(commits)
+            with redirect_stdout(out):
+                render_history(series)
+                if profile is not None:
+                    print(profile.report())
+        elif args.format == "json":
+            write_history_json(commits, out, profile)
+        elif args.format == "csv":
+            write_history_csv(commits, out)
+            if profile is not None:
+                print(profile.report(), file=sys.stderr)
+        elif ndjson is not None:
+            for commit in commits:
+                ndjson.commit(commit)
+            ndjson.finish_history(profile)
+    except GitHistoryError as e:
+        print(f"Error reading git history of {abs_path}: {e}", file=sys.stderr)
+        sys.exit(1)
+
 
-    abs_path = Path(os.path.abspath(path))
-    result = counter(abs_path, no_git_flag)
-    render_stats(result)
+def _start_tracer(output_file: str) -> Any:
+    """
+    Start a viztracer trace of the scan, which is only a dev dependency.
+    Worker processes are not traced, use `--executor thread` or `serial`.
+    """
+    try:
+        from viztracer import VizTracer
+    except ImportError:
+        print("--trace needs viztracer, install it with `pip install viztracer`")
+        sys.exit(1)
+    tracer = VizTracer(output_file=output_file)
+    tracer.start()
+    return tracer
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+import posixpath
+import stat
+from pathlib import Path
+from typing import IO, Iterator
+from .language_config import LanguageConfig
+from .scan_profile import BINARY, COUNTED, SKIP_TOO_LARGE
+from .utils import RangeHasher, counter_lines_in_stream
+
+"""
+Counting inside .zip and .tar archives (optionally compressed with gzip, bzip2,
+xz or zstd) without extracting them: members are streamed in order, classified
+by their path in the archive and counted from the decompressed stream a chunk
+at a time, so memory stays bounded whatever the size of the members.
+"""
+
+_ZIP_SUFFIXES = (".zip",)
+_TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+_ZSTD_TAR_SUFFIXES = (".tar.zst", ".tar.zstd", ".tzst")
+ARCHIVE_SUFFIXES = _ZIP_SUFFIXES + _TAR_SUFFIXES + _ZSTD_TAR_SUFFIXES
+
+# (member path in the archive, size, language_id, code_lines, comment_lines,
+#  blank_lines, content digest or "")
+MemberRecord = tuple[str, int, int, int, int, int, str]
+# (counted members, content of the .gitignore members by directory in the
+#  archive, members by outcome as profile counters)
+ArchiveScan = tuple[list[MemberRecord], dict[str, bytes], dict[str, int]]
+
+
+def is_archive(path: Path) -> bool:
+    return path.name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _member_path(name: str) -> str | None:
+    """
+    Normalize the path of a member, relative to the archive root.
+    Return None for members which would land outside of it.
+    """
+    path = posixpath.normpath(name).lstrip("/")
+    if path in ("", ".") or path == ".." or path.startswith("../"):
+        return None
+    return path
+
+
+def _zstd_reader(raw: IO[bytes]) -> IO[bytes]:
+    # zstandard is an optional dependency, only needed for .tar.zst archives
+    try:
+        import zstandard
+    except ImportError:
+        raise OSError(
+            ".tar.zst archives need zstandard, install it with `pip install zstandard`"
+        )
+    reader: IO[bytes] = zstandard.ZstdDecompressor().stream_reader(raw)
+    return reader
+
+
+def iter_members(archive_path: Path) -> Iterator[tuple[str, int, IO[bytes]]]:
+    """
+    Stream the regular files of an archive, in the order they are stored,
+    as (path in the archive, size, content stream). Each stream is only
+    readable until the next member is yielded. Links are not followed.
+    """
+    # tarfile and zipfile, with their compression modules, are slow to import,
+    # and only needed when there are archives
+    import tarfile
+    import zipfile
+
+    name = archive_path.name.lower()
+    if name.endswith(_ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or stat.S_ISLNK(info.external_attr >> 16):
+                    continue
+                path = _member_path(info.filename)
+                if path is not None:
+                    with zf.open(info) as member:
+                        yield path, info.file_size, member
+        return
+    with open(archive_path, "rb") as raw:
+        fileobj = _zstd_reader(raw) if name.endswith(_ZSTD_TAR_SUFFIXES) else raw
+        # a stream rather than random access, so compressed archives are only
+        # decompressed once, and the compression is detected from the content
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+            for tar_info in tf:
+                if not tar_info.isfile():
+                    continue
+                path = _member_path(tar_info.name)
+                extracted = tf.extractfile(tar_info)
+                if path is not None and extracted is not None:
+                    yield path, tar_info.size, extracted
+
+
+def scan_archive(
+    archive_path: Path,
+    config: LanguageConfig,
+    max_file_size: int | None = None,
+    dedup: bool = False,
+) -> ArchiveScan:
+    """
+    Count the members of an archive which the config does not skip, hashing
+    them with `dedup`, and skipping those bigger than `max_file_size`.
+    .gitignore members are kept rather than counted, as gitignore rules can
+    only be applied once the whole archive is known. An archive which can not
+    be read completely keeps the members counted before the error.
+    """
+    import lzma
+    import tarfile
+    import zipfile
+    import zlib
+
+    # errors of a truncated or corrupted archive, raised while streaming it
+    archive_errors = (
+        OSError,
+        EOFError,
+        RuntimeError,
+        ValueError,
+        tarfile.TarError,
+        zipfile.BadZipFile,
+        zlib.error,
+        lzma.LZMAError,
+    )
+    classify = config.classify
+    languages = config.languages
+    records: list[MemberRecord] = []
+    gitignores: dict[str, bytes] = {}
+    counters: dict[str, int] = {}
+
+    def count(name: str, value: int = 1) -> None:
+        counters[name] = counters.get(name, 0) + value
+
+    try:
+        for path, size, member in iter_members(archive_path):
+            count("files_seen")
+            count("bytes_seen", size)
+            if posixpath.basename(path) == ".gitignore":
+                gitignores[posixpath.dirname(path)] = member.read()
+                continue
+            language_id, reason = classify(archive_path / path)
+            if reason is None and max_file_size is not None and size > max_file_size:
+                reason = SKIP_TOO_LARGE
+            if reason is not None:
+                count(reason)
+                continue
+            hasher = RangeHasher() if dedup else None
+            counts = counter_lines_in_stream(
+                member, languages[language_id]._syntax, hasher
+            )
+            count(COUNTED)
+            count("bytes_counted", size)
+            if size and not counts.total:
+                count(BINARY)
+            digest = hasher.hexdigest() if hasher is not None else ""
+            records.append((path, size, language_id, *counts, digest))
+    except archive_errors as e:
+        print(f"Error reading archive {archive_path}: {e}")
+    return records, gitignores, counters
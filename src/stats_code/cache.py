@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+"""
+A persistent, per-root cache of file results so that warm runs only need to
+stat files and recount the ones that changed, and a per-repo cache of git blob
+line counts for history scans.
+"""
+
+CACHE_VERSION = 4
+BLOB_CACHE_VERSION = 1
+
+# (size, mtime_ns, inode, language_id, code_lines, comment_lines, blank_lines,
+#  content digest or "" if the file was not hashed)
+CacheEntry = tuple[int, int, int, int, int, int, int, str]
+# "<blob id>:<language_id>" -> (code_lines, comment_lines, blank_lines)
+BlobEntries = dict[str, tuple[int, int, int]]
+
+# files modified this close to the scan start may change again within the same
+# mtime tick, so they are not persisted (the "racily clean" problem)
+RACY_WINDOW_NS = 2_000_000_000
+
+
+def default_cache_dir() -> Path:
+    xdg_cache = os.environ.get("XDG_CACHE_HOME")
+    base = Path(xdg_cache) if xdg_cache else Path.home() / ".cache"
+    return base / "stats-code"
+
+
+class ScanCache:
+    """
+    On-disk cache of per-file results, keyed by path and (size, mtime_ns, inode).
+    The whole cache is dropped when the language config fingerprint changes.
+    """
+
+    def __init__(self, cache_dir: Path, root: Path, fingerprint: str) -> None:
+        root_key = hashlib.sha1(str(root).encode("utf-8")).hexdigest()
+        self.path: Path = cache_dir / f"{root_key}.json"
+        self.fingerprint: str = fingerprint
+        self.entries: dict[str, CacheEntry] = {}
+        self._started_ns: int = time.time_ns()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Error loading cache {self.path}: {e}")
+            return
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != CACHE_VERSION
+            or data.get("fingerprint") != self.fingerprint
+        ):
+            return  # stale cache, start over
+        self.entries = {
+            key: (
+                entry[0],
+                entry[1],
+                entry[2],
+                entry[3],
+                entry[4],
+                entry[5],
+                entry[6],
+                entry[7],
+            )
+            for key, entry in data.get("entries", {}).items()
+        }
+
+    def lookup(self, file_paths: list[Path]) -> dict[str, CacheEntry]:
+        """
+        Return the cached entries of the given files, if any.
+        """
+        found: dict[str, CacheEntry] = {}
+        for file_path in file_paths:
+            key = str(file_path)
+            entry = self.entries.get(key)
+            if entry is not None:
+                found[key] = entry
+        return found
+
+    def save(self, entries: dict[str, CacheEntry]) -> None:
+        """
+        Replace the cache with the entries seen in this run.
+        """
+        threshold = self._started_ns - RACY_WINDOW_NS
+        kept = {key: entry for key, entry in entries.items() if entry[1] < threshold}
+        data = {
+            "version": CACHE_VERSION,
+            "fingerprint": self.fingerprint,
+            "entries": kept,
+        }
+        _write_atomic(self.path, data)
+        self.entries = kept
+
+
+class RootCaches:
+    """
+    The scan caches of several roots scanned together, each file being looked
+    up in and saved to the cache of the innermost root containing it.
+    """
+
+    def __init__(self, cache_dir: Path, roots: list[Path], fingerprint: str) -> None:
+        self.caches: dict[str, ScanCache] = {
+            str(root): ScanCache(cache_dir, root, fingerprint) for root in roots
+        }
+
+    def _root_of(self, file_path: str) -> str | None:
+        dir_path = os.path.dirname(file_path)
+        while dir_path not in self.caches:
+            parent = os.path.dirname(dir_path)
+            if parent == dir_path:
+                return None
+            dir_path = parent
+        return dir_path
+
+    def lookup(self, file_paths: list[Path]) -> dict[str, CacheEntry]:
+        """
+        Return the cached entries of the given files of a same directory, if any.
+        """
+        root = self._root_of(str(file_paths[0])) if file_paths else None
+        if root is None:
+            return {}
+        return self.caches[root].lookup(file_paths)
+
+    def save(self, entries: dict[str, CacheEntry]) -> None:
+        """
+        Replace the cache of every root with the entries seen in this run.
+        """
+        by_root: dict[str, dict[str, CacheEntry]] = {root: {} for root in self.caches}
+        for key, entry in entries.items():
+            root = self._root_of(key)
+            if root is not None:
+                by_root[root][key] = entry
+        for root, cache in self.caches.items():
+            cache.save(by_root[root])
+
+
+class BlobCache:
+    """
+    On-disk cache of line counts of the blobs of a git repo, keyed by blob id
+    and language. Blobs never change, so entries are only dropped with the
+    whole cache when the language config fingerprint changes.
+    """
+
+    def __init__(self, cache_dir: Path, git_dir: Path, fingerprint: str) -> None:
+        repo_key = hashlib.sha1(str(git_dir).encode("utf-8")).hexdigest()
+        self.path: Path = cache_dir / f"blobs-{repo_key}.json"
+        self.fingerprint: str = fingerprint
+        self.entries: BlobEntries = {}
+        self._loaded: int = 0
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Error loading cache {self.path}: {e}")
+            return
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != BLOB_CACHE_VERSION
+            or data.get("fingerprint") != self.fingerprint
+        ):
+            return  # stale cache, start over
+        self.entries = {
+            key: (entry[0], entry[1], entry[2])
+            for key, entry in data.get("entries", {}).items()
+        }
+        self._loaded = len(self.entries)
+
+    def save(self) -> None:
+        """
+        Write the cache back, if blobs were counted since it was loaded.
+        """
+        if len(self.entries) == self._loaded:
+            return
+        data = {
+            "version": BLOB_CACHE_VERSION,
+            "fingerprint": self.fingerprint,
+            "entries": self.entries,
+        }
+        _write_atomic(self.path, data)
+        self._loaded = len(self.entries)
+
+
+def _write_atomic(path: Path, data: object) -> None:
+    """
+    Write JSON to a temporary file and atomically rename it, so concurrent
+    writers never leave a torn cache behind (last writer wins).
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=path.parent, prefix=path.name, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        print(f"Error saving cache {path}: {e}")
@@ -1,84 +1,1020 @@
+import os
+import re
+import stat
+import time
+from collections import deque
+from itertools import chain
 from pathlib import Path
-from multiprocessing import Pool, cpu_count
-from .result import RepoStatsNode, Result
-from .language_config import LanguageConfig
-from .counter_worker import init_worker, process_file, Task
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Sequence, TypeVar
+from .line_classifier import LineCounts
+from .result import Result
+from .language_config import SKIP_PATHS, Language, LanguageConfig
+from .utils import check_dir, combine_digests, file_ranges
+from .gitignore import GitIgnoreMatcher, IgnoreRules
+from .archive import ArchiveScan, MemberRecord, is_archive
+from .counter_worker import (
+    ArchiveTask,
+    BatchResult,
+    FileStat,
+    RangeResult,
+    RangeTask,
+    Task,
+    count_range,
+    init_worker,
+    process_archive,
+    process_batch,
+)
+from .cache import CacheEntry, RootCaches, ScanCache
+from .executor import default_executor, default_jobs
+from .scan_profile import (
+    COUNTED,
+    SPLIT,
+    SKIP_DUPLICATE,
+    SKIP_GIT_FILE,
+    SKIP_GITIGNORE,
+    SKIP_TOO_LARGE,
+    ScanProfile,
+)
+from .line_classifier import INITIAL_STATE
+from .git_index import (
+    MODE_GITLINK,
+    MODE_SYMLINK,
+    MODE_TYPE_MASK,
+    IndexEntry,
+    UnsupportedIndexError,
+    read_index,
+    resolve_git_dir,
+)
 
-TASK_THRESHOLD = 1500
+if TYPE_CHECKING:
+    from multiprocessing.pool import AsyncResult, Pool
+
+# a batch holds about this many bytes of files to count, or this many files
+BATCH_BYTES = 4 << 20
+BATCH_FILES = 2000
+# smaller batches for threads, so that enough reads are in flight
+THREAD_BATCH_BYTES = 1 << 20
+# counting less than this is faster than starting a process pool
+PARALLEL_THRESHOLD_BYTES = 64 << 20
+# tasks queued per worker of a warm pool by each scan sharing it, and how
+# often a scan waiting for them checks its cancellation and deadline
+POOL_TASKS_PER_WORKER = 2
+POOL_POLL_SECONDS = 0.05
+# estimated cost of a file served from the cache, or of a file with no content
+MIN_FILE_COST = 512
+# files bigger than this are counted in line aligned ranges, in parallel
+DEFAULT_MAX_FILE_SIZE = 256 << 20
+# what to do with files bigger than the max file size: count them in ranges,
+# only count their lines in ranges, without classifying them, or skip them
+LARGE_FILE_POLICIES = ("full", "count-fast", "skip")
+# files of git itself, like .gitignore or .gitmodules
+GIT_FILE_RE = re.compile(r".*\.git.*?")
+
+# (files of a directory, its node_id, the gitignore rules applying to them or None,
+#  their stats, their devices)
+WalkTask = tuple[list[Path], int, IgnoreRules | None, list[FileStat], list[int]]
+# (st_dev, st_ino) of the files and directories already reached
+Seen = set[tuple[int, int]]
+# (file, its node_id, its stat, its language_id, its range tasks)
+LargeFile = tuple[Path, int, FileStat, int, list[RangeTask]]
+# (archive, node_id of its directory, or of itself if it is a root, its size)
+ArchiveFile = tuple[Path, int, int]
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class ScanCancelled(Exception):
+    """
+    Raised by `counter()` when its scan is cancelled before it completes.
+    """
+
+
+def _check_stop(cancelled: Callable[[], bool] | None, deadline: float | None) -> None:
+    if cancelled is not None and cancelled():
+        raise ScanCancelled("scan cancelled")
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError("scan timed out")
+
+
+def _until_stopped(
+    items: Iterable[T], cancelled: Callable[[], bool] | None, deadline: float | None
+) -> Iterator[T]:
+    """
+    Stop an iterator, e.g. a lazy walk consumed by a pool, by raising
+    `ScanCancelled` or `TimeoutError` before the next item.
+    """
+    for item in items:
+        _check_stop(cancelled, deadline)
+        yield item
+
+
+def _pool_imap(
+    pool: "Pool",
+    func: Callable[[T], R],
+    items: Iterable[T],
+    in_flight: int,
+    cancelled: Callable[[], bool] | None,
+    deadline: float | None,
+) -> Iterator[R]:
+    """
+    Like `Pool.imap`, for a pool shared by concurrent scans: `items` are
+    consumed in the calling thread rather than by the task handler thread of
+    the pool, at most `in_flight` of them are queued at once, so that the scans
+    sharing the pool take turns, and results are waited for a little at a time,
+    checking the cancellation and the deadline in between.
+    """
+    pending: deque[AsyncResult[R]] = deque()
+    it = iter(items)
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < in_flight:
+            try:
+                item = next(it)
+            except StopIteration:
+                exhausted = True
+            else:
+                pending.append(pool.apply_async(func, (item,)))
+        if not pending:
+            return
+        oldest = pending.popleft()
+        while not oldest.ready():
+            _check_stop(cancelled, deadline)
+            oldest.wait(POOL_POLL_SECONDS)
+        yield oldest.get()
+
+
+def _scan_dir(
+    dir_path: Path,
+) -> tuple[list[Path], list[Path], list[FileStat], list[int], set[str]]:
+    """
+    List a directory with a single `os.scandir` call, reusing the entry types.
+    Returns (sub directories, files, stats of the files, devices of the files,
+    all entry names).
+    """
+    dirs: list[Path] = []
+    files: list[Path] = []
+    stats: list[FileStat] = []
+    devs: list[int] = []
+    names: set[str] = set()
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                names.add(entry.name)
+                try:
+                    if entry.is_dir():
+                        if entry.name != ".git":
+                            dirs.append(Path(entry.path))
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append(Path(entry.path))
+                        stats.append((st.st_size, st.st_mtime_ns, st.st_ino))
+                        devs.append(st.st_dev)
+                except OSError:
+                    continue  # broken entry, e.g. a dangling symlink
+    except OSError as e:
+        print(f"Error reading directory {dir_path}: {e}")
+    return dirs, files, stats, devs, names
+
+
+def _first_visit(dir_path: Path, seen: Seen) -> bool:
+    """
+    Check that a directory was not reached yet, e.g. through a symlink or a
+    bind mount, and remember it. Symlink cycles are never walked around.
+    """
+    try:
+        st = dir_path.stat()
+    except OSError:
+        return False
+    key = (st.st_dev, st.st_ino)
+    if key in seen:
+        return False
+    seen.add(key)
+    return True
+
+
+def check_dir_skipped(
+    dir_path: Path,
+    config: LanguageConfig,
+    ignore_rules: IgnoreRules | None,
+) -> bool:
+    """
+    Check if a whole directory can be pruned, because its files would all be
+    dropped by the skip paths or the active gitignore rules anyway.
+    """
+    if check_dir(config.skip._spec, dir_path):
+        return True
+    return ignore_rules is not None and ignore_rules.match(dir_path, is_dir=True)
 
 
 def collect_files(
+    result: Result,
     dir_path: Path,
-    cur_node_id: int,
+    node_id: int,
     no_git_flag: bool,
     ignore: list[Path],
-) -> list[Task]:
+    config: LanguageConfig,
+    in_repo: bool = False,
+    seen: Seen | None = None,
+) -> Iterator[WalkTask]:
     """
-    A recursive function to count lines in all files under a directory.
-    Returns a list of tuples (file_path, repo_node, language).
+    Walk all files under a directory, whose node is `node_id`, yielding the files
+    of each directory with their gitignore rules, and adding a node for every
+    directory walked. `ignore` lists the .gitignore files of its ancestors, and
+    `in_repo` tells whether it is inside a git repo, when walking a subtree.
+    The walk is iterative, so deep trees do not hit the recursion limit, and
+    directories skipped by config or gitignore rules are never descended into.
+    Directories already in `seen` are not walked again.
     """
-    ignore_append_flag: bool = False
-    if not no_git_flag:
-        if (dir_path / ".git").exists():
+    if seen is None:
+        seen = set()
+    if not _first_visit(dir_path, seen):
+        return
+    matcher = GitIgnoreMatcher()
+    # (directory, node_id, ancestor .gitignore files, is inside a git repo)
+    stack: list[tuple[Path, int, list[Path], bool]] = [
+        (dir_path, node_id, ignore, in_repo)
+    ]
+    while stack:
+        cur_dir, cur_node_id, cur_ignore, in_repo = stack.pop()
+        dirs, files, stats, devs, names = _scan_dir(cur_dir)
+        if not no_git_flag and ".git" in names:
             # is a git repo
-            if (dir_path / ".gitignore").exists():
-                try:
-                    ignore.append(dir_path / ".gitignore")
-                    ignore_append_flag = True
-                except Exception as e:
-                    print(f"Error loading .gitignore in {dir_path}: {e}")
-            new_repo_node = RepoStatsNode()
-            RepoStatsNode.get_node_by_id(cur_node_id).submodules[dir_path.name] = (
-                new_repo_node
+            result.mark_repo(cur_node_id)
+            in_repo = True
+        if in_repo and ".gitignore" in names:
+            cur_ignore = cur_ignore + [cur_dir / ".gitignore"]
+
+        ignore_rules = matcher.rules_for(cur_ignore)
+        for sub_dir in dirs:
+            if not check_dir_skipped(sub_dir, config, ignore_rules) and _first_visit(
+                sub_dir, seen
+            ):
+                sub_node_id = result.add_node(cur_node_id, sub_dir.name)
+                stack.append((sub_dir, sub_node_id, cur_ignore, in_repo))
+        if files:
+            yield (files, cur_node_id, ignore_rules, stats, devs)
+
+
+def collect_files_from_index(
+    result: Result,
+    dir_path: Path,
+    node_id: int,
+    untracked_flag: bool,
+    config: LanguageConfig,
+    seen: Seen | None = None,
+) -> Iterator[WalkTask] | None:
+    """
+    Collect tasks of a git work tree, whose node is `node_id`, from its index
+    instead of walking the directory.
+    Nested repos are found from gitlinks, untracked files that are not ignored
+    are only collected with `untracked_flag`.
+    Returns None if the index can not be used.
+    """
+    git_dir = resolve_git_dir(dir_path)
+    if git_dir is None:
+        return None
+    try:
+        entries = read_index(git_dir)
+    except UnsupportedIndexError as e:
+        print(f"Cannot use git index of {dir_path}, walking instead: {e}")
+        return None
+    result.mark_repo(node_id)
+    if seen is None:
+        seen = set()
+    return _iter_index_tasks(
+        result, dir_path, node_id, entries, untracked_flag, config, seen
+    )
+
+
+def dir_node(result: Result, dir_nodes: dict[str, int], rel_dir: str) -> int:
+    """
+    Return the node of a directory relative to a work tree, adding the missing ones.
+    """
+    node_id = dir_nodes.get(rel_dir)
+    if node_id is None:
+        parent, _, name = rel_dir.rpartition("/")
+        node_id = result.add_node(dir_node(result, dir_nodes, parent), name)
+        dir_nodes[rel_dir] = node_id
+    return node_id
+
+
+def _iter_index_tasks(
+    result: Result,
+    dir_path: Path,
+    node_id: int,
+    entries: list[IndexEntry],
+    untracked_flag: bool,
+    config: LanguageConfig,
+    seen: Seen,
+) -> Iterator[WalkTask]:
+    if not _first_visit(dir_path, seen):
+        return
+    # relative directory path -> node_id, shared with untracked files
+    dir_nodes: dict[str, int] = {"": node_id}
+    files_by_dir: dict[str, tuple[list[Path], list[FileStat], list[int]]] = {}
+    for rel_path, mode in entries:
+        file_path = dir_path / rel_path
+        if mode & MODE_TYPE_MASK == MODE_GITLINK:
+            yield from _collect_nested_repo(
+                result,
+                file_path,
+                dir_node(result, dir_nodes, rel_path),
+                untracked_flag,
+                config,
+                seen,
+            )
+            continue
+        # the stat data of the index is only refreshed by git commands,
+        # so the files are stat-ed again rather than trusting it
+        try:
+            st = file_path.stat()
+        except OSError:
+            continue  # deleted from the work tree, or a dangling symlink
+        if mode & MODE_TYPE_MASK == MODE_SYMLINK and not stat.S_ISREG(st.st_mode):
+            continue
+        files, stats, devs = files_by_dir.setdefault(
+            rel_path.rpartition("/")[0], ([], [], [])
+        )
+        files.append(file_path)
+        stats.append((st.st_size, st.st_mtime_ns, st.st_ino))
+        devs.append(st.st_dev)
+    # tracked files are never ignored by git, so no ignore rule is attached
+    for rel_dir, (files, stats, devs) in files_by_dir.items():
+        yield (files, dir_node(result, dir_nodes, rel_dir), None, stats, devs)
+
+    if untracked_flag:
+        tracked = {dir_path / rel_path for rel_path, _ in entries}
+        yield from _collect_untracked(
+            result, dir_path, dir_nodes, tracked, config, seen
+        )
+
+
+def _collect_nested_repo(
+    result: Result,
+    dir_path: Path,
+    node_id: int,
+    untracked_flag: bool,
+    config: LanguageConfig,
+    seen: Seen,
+) -> Iterator[WalkTask]:
+    if not (dir_path / ".git").exists():
+        return  # submodule is not checked out
+    tasks = collect_files_from_index(
+        result, dir_path, node_id, untracked_flag, config, seen
+    )
+    if tasks is None:
+        tasks = collect_files(result, dir_path, node_id, False, [], config, seen=seen)
+    yield from tasks
+
+
+def _collect_untracked(
+    result: Result,
+    dir_path: Path,
+    dir_nodes: dict[str, int],
+    tracked: set[Path],
+    config: LanguageConfig,
+    seen: Seen,
+) -> Iterator[WalkTask]:
+    """
+    Collect files under a work tree which are not in the index.
+    Ignored directories are pruned, ignored files are dropped by `classify_files`.
+    """
+    matcher = GitIgnoreMatcher()
+    # (directory, relative directory path, ancestor .gitignore files)
+    stack: list[tuple[Path, str, list[Path]]] = [(dir_path, "", [])]
+    while stack:
+        cur_dir, rel_dir, cur_ignore = stack.pop()
+        dirs, files, stats, devs, names = _scan_dir(cur_dir)
+        if ".gitignore" in names:
+            cur_ignore = cur_ignore + [cur_dir / ".gitignore"]
+        ignore_rules = matcher.rules_for(cur_ignore)
+        for sub_dir in dirs:
+            if sub_dir in tracked:
+                continue  # gitlinks are already collected
+            rel_sub_dir = f"{rel_dir}/{sub_dir.name}" if rel_dir else sub_dir.name
+            if (sub_dir / ".git").exists():
+                yield from _collect_nested_repo(
+                    result,
+                    sub_dir,
+                    dir_node(result, dir_nodes, rel_sub_dir),
+                    True,
+                    config,
+                    seen,
+                )
+            elif not check_dir_skipped(sub_dir, config, ignore_rules) and _first_visit(
+                sub_dir, seen
+            ):
+                stack.append((sub_dir, rel_sub_dir, cur_ignore))
+        untracked = [i for i, file_path in enumerate(files) if file_path not in tracked]
+        if untracked:
+            yield (
+                [files[i] for i in untracked],
+                dir_node(result, dir_nodes, rel_dir),
+                ignore_rules,
+                [stats[i] for i in untracked],
+                [devs[i] for i in untracked],
+            )
+
+
+def classify_files(
+    walk_tasks: Iterable[WalkTask],
+    config: LanguageConfig,
+    profile: ScanProfile | None = None,
+    seen: Seen | None = None,
+    max_file_size: int | None = None,
+    archives: list[ArchiveFile] | None = None,
+) -> Iterator[Task]:
+    """
+    Drop the files of git itself, ignored files and files skipped by config,
+    and detect the language of the others, so that each file is classified
+    once, on the walk side. Yields the kept files of each directory as a task.
+    Files already in `seen`, reached through another hardlink, symlink or
+    mount, and files bigger than `max_file_size` are dropped as well.
+    If `archives` is given, archives not in skipped paths are diverted to it,
+    whatever their language, to be counted member by member.
+    """
+    classify = config.classify
+    git_file_match = GIT_FILE_RE.match
+    for files, node_id, ignore_rules, stats, devs in walk_tasks:
+        kept_files: list[Path] = []
+        kept_stats: list[FileStat] = []
+        language_ids: list[int] = []
+        for file_path, file_stat, dev in zip(files, stats, devs):
+            archive = False
+            if git_file_match(file_path.name):
+                reason: str | None = SKIP_GIT_FILE
+            elif ignore_rules is not None and ignore_rules.match(file_path):
+                reason = SKIP_GITIGNORE
+            else:
+                language_id, reason = classify(file_path)
+                archive = (
+                    archives is not None
+                    and reason != SKIP_PATHS
+                    and is_archive(file_path)
+                )
+                if archive:
+                    reason = None
+                elif (
+                    reason is None
+                    and max_file_size is not None
+                    and file_stat[0] > max_file_size
+                ):
+                    reason = SKIP_TOO_LARGE
+                if reason is None and seen is not None:
+                    key = (dev, file_stat[2])
+                    if key in seen:
+                        reason = SKIP_DUPLICATE
+                    else:
+                        seen.add(key)
+            if reason is None and archives is not None and archive:
+                archives.append((file_path, node_id, file_stat[0]))
+            elif reason is None:
+                kept_files.append(file_path)
+                kept_stats.append(file_stat)
+                language_ids.append(language_id)
+            elif profile is not None:
+                profile.count(reason)
+        if profile is not None:
+            profile.count("files_seen", len(files))
+            profile.count("bytes_seen", sum(file_stat[0] for file_stat in stats))
+        if kept_files:
+            yield (kept_files, node_id, kept_stats, language_ids, None)
+
+
+def walk_root(
+    result: Result,
+    root: Path,
+    node_id: int,
+    no_git_flag: bool,
+    git_index_flag: bool,
+    untracked_flag: bool,
+    config: LanguageConfig,
+    seen: Seen,
+) -> Iterator[WalkTask]:
+    """
+    Walk a root whose node is `node_id`, from the index of its git repos with
+    `git_index_flag` (unless `no_git_flag`), or else from the file system,
+    skipping the files and directories already in `seen`.
+    """
+    walk_tasks: Iterator[WalkTask] | None = None
+    if git_index_flag and not no_git_flag:
+        walk_tasks = collect_files_from_index(
+            result, root, node_id, untracked_flag, config, seen
+        )
+    if walk_tasks is None:
+        walk_tasks = collect_files(
+            result, root, node_id, no_git_flag, [], config, seen=seen
+        )
+    return walk_tasks
+
+
+def _add_archive(
+    result: Result,
+    node_id: int,
+    archive_path: Path,
+    scan: ArchiveScan,
+    no_git_flag: bool,
+    profile: ScanProfile | None = None,
+) -> list[MemberRecord]:
+    """
+    Add the counted members of an archive under its node, with a node for
+    every directory of the archive, dropping the files of git itself and, unless
+    `no_git_flag`, the members ignored by the .gitignore members of the archive.
+    Returns the members kept.
+    """
+    records, gitignores, counters = scan
+    if profile is not None:
+        for name, value in counters.items():
+            profile.count(name, value)
+    matcher = GitIgnoreMatcher()
+    if not no_git_flag:
+        for rel_dir, content in gitignores.items():
+            lines = content.decode("utf-8", errors="ignore").splitlines()
+            matcher.add(archive_path / rel_dir / ".gitignore", lines)
+    dir_nodes: dict[str, int] = {"": node_id}
+    # directory in the archive -> its gitignore rules
+    dir_rules: dict[str, IgnoreRules | None] = {}
+    kept: list[MemberRecord] = []
+    for record in records:
+        member, _, language_id, code, comment, blank, _ = record
+        rel_dir, _, name = member.rpartition("/")
+        ignore_rules = dir_rules.get(rel_dir)
+        if rel_dir not in dir_rules:
+            parts = rel_dir.split("/") if rel_dir else []
+            ancestors = ["/".join(parts[:i]) for i in range(len(parts) + 1)]
+            ignore_rules = matcher.rules_for(
+                [
+                    archive_path / ancestor / ".gitignore"
+                    for ancestor in ancestors
+                    if not no_git_flag and ancestor in gitignores
+                ]
             )
-            cur_node_id = new_repo_node.id
+            dir_rules[rel_dir] = ignore_rules
+        if GIT_FILE_RE.match(name):
+            reason: str | None = SKIP_GIT_FILE
+        elif ignore_rules is not None and ignore_rules.match(archive_path / member):
+            reason = SKIP_GITIGNORE
+        else:
+            reason = None
+        if reason is not None:
+            if profile is not None:
+                profile.count(reason)
+                profile.count(COUNTED, -1)  # counted by the worker all the same
+            continue
+        member_node = dir_node(result, dir_nodes, rel_dir)
+        result.add_counts(member_node, language_id, LineCounts(code, comment, blank))
+        kept.append(record)
+    return kept
 
-    file_paths = []
-    tasks = []
-    for entry in dir_path.iterdir():
-        if entry.is_dir():
-            if entry.name == ".git":
+
+def make_batches(
+    tasks: Iterable[Task],
+    cache: ScanCache | RootCaches | None,
+    max_bytes: int = BATCH_BYTES,
+    keep_entries: bool = False,
+    large_files: list[LargeFile] | None = None,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    fast: bool = False,
+) -> Iterator[tuple[list[Task], int]]:
+    """
+    Regroup per-directory tasks into batches of roughly `max_bytes` bytes to
+    count, splitting the tasks of big directories, and attach cached entries.
+    With `keep_entries`, workers return the entries of counted files even if
+    there is no cache.
+    If `large_files` is given, files bigger than `max_file_size` which are not
+    cached are split into range tasks (only counting lines with `fast`) and
+    added to it instead.
+    Yields (batch, estimated bytes to count).
+    """
+    no_cache: dict[str, CacheEntry] | None = {} if keep_entries else None
+    batch: list[Task] = []
+    batch_bytes = 0
+    batch_files = 0
+    for file_paths, node_id, stats, language_ids, _ in tasks:
+        cached = cache.lookup(file_paths) if cache is not None else no_cache
+        if large_files is not None and max(stats)[0] > max_file_size:
+            file_paths, stats, language_ids = _split_large_files(
+                file_paths,
+                node_id,
+                stats,
+                language_ids,
+                cached,
+                large_files,
+                max_file_size,
+                fast,
+            )
+            if not file_paths:
                 continue
-            tasks.extend(collect_files(entry, cur_node_id, no_git_flag, ignore))
-        elif entry.is_file():
-            file_paths.append(entry)
-    if file_paths:
-        tasks.append((file_paths, cur_node_id, [p for p in ignore]))
+        start = 0
+        for i, (file_path, file_stat) in enumerate(zip(file_paths, stats)):
+            entry = cached.get(str(file_path)) if cached is not None else None
+            if entry is not None and entry[:3] == file_stat:
+                batch_bytes += MIN_FILE_COST  # only checked, not read
+            else:
+                batch_bytes += max(file_stat[0], MIN_FILE_COST)
+            batch_files += 1
+            if batch_bytes >= max_bytes or batch_files >= BATCH_FILES:
+                batch.append(
+                    _sub_task(
+                        file_paths, node_id, stats, language_ids, cached, start, i + 1
+                    )
+                )
+                yield batch, batch_bytes
+                batch, batch_bytes, batch_files = [], 0, 0
+                start = i + 1
+        if start < len(file_paths):
+            batch.append(
+                _sub_task(
+                    file_paths,
+                    node_id,
+                    stats,
+                    language_ids,
+                    cached,
+                    start,
+                    len(file_paths),
+                )
+            )
+    if batch:
+        yield batch, batch_bytes
 
-    if ignore_append_flag:
-        ignore.pop()
-    return tasks
 
+def _split_large_files(
+    file_paths: list[Path],
+    node_id: int,
+    stats: list[FileStat],
+    language_ids: list[int],
+    cached: dict[str, CacheEntry] | None,
+    large_files: list[LargeFile],
+    max_file_size: int,
+    fast: bool,
+) -> tuple[list[Path], list[FileStat], list[int]]:
+    """
+    Move the large files of a task which can be counted in ranges to
+    `large_files`, and return the other files.
+    """
+    kept_files: list[Path] = []
+    kept_stats: list[FileStat] = []
+    kept_language_ids: list[int] = []
+    for file_path, file_stat, language_id in zip(file_paths, stats, language_ids):
+        entry = cached.get(str(file_path)) if cached is not None else None
+        if file_stat[0] > max_file_size and (entry is None or entry[:3] != file_stat):
+            ranges = file_ranges(file_path)
+            if ranges is not None:
+                range_tasks: list[RangeTask] = [
+                    (str(file_path), language_id, start, end, INITIAL_STATE, fast)
+                    for start, end in ranges
+                ]
+                large_files.append(
+                    (file_path, node_id, file_stat, language_id, range_tasks)
+                )
+                continue
+        kept_files.append(file_path)
+        kept_stats.append(file_stat)
+        kept_language_ids.append(language_id)
+    return kept_files, kept_stats, kept_language_ids
 
-def counter(path: Path, no_git_flag: bool) -> Result:
-    config = LanguageConfig.from_yaml()
-    result = Result()
 
-    # 1. collect tasks
-    # each task process files in same dir (no recursion)
-    tasks = collect_files(path, result.root_repo.id, no_git_flag, [])
+def count_large_files(
+    large_files: list[LargeFile],
+    imap: Callable[
+        [Callable[[RangeTask], RangeResult], Iterable[RangeTask]],
+        Iterator[RangeResult],
+    ],
+) -> Iterator[tuple[LargeFile, LineCounts, str]]:
+    """
+    Count the ranges of large files with `imap`, e.g. `Pool.imap`, which yields
+    results in order. Ranges are counted from the initial classifier state, and
+    counted again from the end state of the previous range in the rare case
+    they start inside a block comment or a multi-line string.
+    Yields (large file, its line counts, its content digest or "").
+    """
+    results = imap(count_range, (task for *_, tasks in large_files for task in tasks))
+    for large_file in large_files:
+        counts = LineCounts()
+        state = INITIAL_STATE
+        digests: list[bytes] = []
+        for file_path, language_id, start, end, start_state, fast in large_file[4]:
+            range_counts, end_state, digest = next(results)
+            if start_state != state:
+                retry: RangeTask = (file_path, language_id, start, end, state, fast)
+                range_counts, end_state, digest = next(imap(count_range, [retry]))
+            counts = counts.merge(range_counts)
+            state = end_state
+            digests.append(digest)
+        yield large_file, counts, combine_digests(digests) if all(digests) else ""
 
-    # 2. process tasks
-    results: list[list[tuple[int, int, int]]] = []
-    all_ignore_paths = {p for task in tasks for p in task[2]}
-    if len(tasks) < TASK_THRESHOLD:
+
+def _archive_bytes(archives: list[ArchiveFile]) -> int:
+    return sum(size for _, _, size in archives)
+
+
+def _large_bytes(large_files: list[LargeFile]) -> int:
+    return sum(large_file[2][0] for large_file in large_files)
+
+
+def _sub_task(
+    file_paths: list[Path],
+    node_id: int,
+    stats: list[FileStat],
+    language_ids: list[int],
+    cached: dict[str, CacheEntry] | None,
+    start: int,
+    end: int,
+) -> Task:
+    if start == 0 and end == len(file_paths):
+        return (file_paths, node_id, stats, language_ids, cached)
+    return (
+        file_paths[start:end],
+        node_id,
+        stats[start:end],
+        language_ids[start:end],
+        cached,
+    )
+
+
+def counter(
+    path: Path | Sequence[Path],
+    no_git_flag: bool,
+    cache_dir: Path | None = None,
+    git_index_flag: bool = False,
+    untracked_flag: bool = False,
+    jobs: int | None = None,
+    executor: str | None = None,
+    on_file: Callable[[str, Language, LineCounts], None] | None = None,
+    profile: ScanProfile | None = None,
+    config: LanguageConfig | None = None,
+    file_entries: dict[str, CacheEntry] | None = None,
+    dedup: bool = False,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    large_file_policy: str = "full",
+    archives_flag: bool = False,
+    pool: "Pool | None" = None,
+    cancelled: Callable[[], bool] | None = None,
+    deadline: float | None = None,
+) -> Result:
+    """
+    Count lines of all files under `path`, or under every root of a sequence of
+    paths, which are then the children of a root node named by their path.
+    A file or directory reached more than once, through a symlink, a hardlink,
+    a bind mount or overlapping roots, is only counted once.
+    If `cache_dir` is given, unchanged files are served from the on-disk cache.
+    If `git_index_flag` is set, files of git repos are enumerated from their index.
+    `executor` is one of "process", "thread" or "serial", chosen from the file
+    system type of (the first) `path` by default, and `jobs` is the number of
+    its workers.
+    `on_file` is called with (path, language, line counts) for every counted file
+    as soon as its batch is counted.
+    If `profile` is given, it is filled with timings and counters of the scan.
+    `config` is loaded from `cache_dir` unless given, and `file_entries`, if
+    given, is filled with the cache entry of every counted file.
+    With `dedup`, files are hashed while they are read, so that the result also
+    has the unique lines and the duplicate groups of files with the same content.
+    Files bigger than `max_file_size` are handled by `large_file_policy`, one of
+    `LARGE_FILE_POLICIES`: split into line aligned ranges counted in parallel
+    (only counting their lines, as code, with "count-fast"), or skipped.
+    A path which is an archive is counted member by member without extracting
+    it, and so are the archives found in the tree with `archives_flag`, as a
+    directory named after them; archives inside archives are not opened.
+    `pool`, if given, is a warm pool of workers of `executor`, initialized by
+    `init_worker` with `config` (as is the calling process, which counts small
+    scans itself), which is used rather than starting one, and left running.
+    The scan raises `ScanCancelled` once `cancelled()` returns True, and
+    `TimeoutError` after the `time.monotonic()` `deadline`, both checked
+    between batches and while waiting for the workers, and nothing is cached
+    then. Concurrent scans sharing `pool` each keep a few tasks in flight, so
+    one scan does not queue behind the whole of another.
+    """
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    if config is None:
+        config = LanguageConfig.load(cache_dir)
+    result = Result(config.languages, dedup)
+    roots: list[tuple[Path, int]]
+    cache: ScanCache | RootCaches | None = None
+    if isinstance(path, Path):
+        roots = [(path, Result.ROOT)]
+        if cache_dir is not None:
+            cache = ScanCache(cache_dir, path, config.fingerprint())
+    else:
+        roots = [(root, result.add_node(Result.ROOT, str(root))) for root in path]
+        if cache_dir is not None:
+            cache = RootCaches(cache_dir, list(path), config.fingerprint())
+    if profile is not None:
+        wall, cpu = time.perf_counter() - start_wall, time.thread_time() - start_cpu
+        profile.add_stage("config", wall, cpu)
+
+    # archives given as paths are not walked, but counted like the archives
+    # found in the tree
+    archives: list[ArchiveFile] = []
+    for root, node_id in roots:
+        if is_archive(root) and root.is_file():
+            archives.append((root, node_id, root.stat().st_size))
+    archive_roots = {root for root, _, _ in archives}
+
+    # 1. walk the tree lazily, so counting overlaps with the walk, and classify
+    # the files as they are found, one root after the other
+    seen: Seen = set()
+    walk_tasks = chain.from_iterable(
+        walk_root(
+            result,
+            root,
+            node_id,
+            no_git_flag,
+            git_index_flag,
+            untracked_flag,
+            config,
+            seen,
+        )
+        for root, node_id in roots
+        if root not in archive_roots
+    )
+    skip_size = max_file_size if large_file_policy == "skip" else None
+    tasks = classify_files(
+        walk_tasks,
+        config,
+        profile,
+        seen,
+        skip_size,
+        archives if archives_flag else None,
+    )
+    if profile is not None:
+        # the walk runs in the thread consuming batches, interleaved with counting
+        tasks = profile.iter_stage("walk", tasks)
+    if executor is None:
+        executor = default_executor(roots[0][0]) if roots else "serial"
+    if jobs is None:
+        jobs = default_jobs(executor)
+    large_files: list[LargeFile] = []
+    batches = _until_stopped(
+        make_batches(
+            tasks,
+            cache,
+            THREAD_BATCH_BYTES if executor == "thread" else BATCH_BYTES,
+            keep_entries=file_entries is not None,
+            large_files=large_files,
+            max_file_size=max_file_size,
+            fast=large_file_policy == "count-fast",
+        ),
+        cancelled,
+        deadline,
+    )
+
+    # 2. only start a process pool if there are enough bytes to count,
+    # threads are cheap to start and hide the latency of slow file systems,
+    # and a single batch is counted faster here than sent to a warm pool
+    if pool is not None:
+        threshold = BATCH_BYTES
+    else:
+        threshold = PARALLEL_THRESHOLD_BYTES if executor == "process" else 0
+    head: list[list[Task]] = []
+    head_bytes = 0
+    for batch, batch_bytes in batches:
+        head.append(batch)
+        head_bytes += batch_bytes
+        if (
+            head_bytes + _large_bytes(large_files) + _archive_bytes(archives)
+            >= threshold
+        ):
+            break
+    # large files and archives found so far are counted in the pool as well
+    head_bytes += _large_bytes(large_files) + _archive_bytes(archives)
+    rest = (batch for batch, _ in batches)
+    entries: dict[str, CacheEntry] = {}
+    file_records = on_file is not None
+    profiling = profile is not None
+
+    def merge(batch_result: BatchResult) -> None:
+        _check_stop(cancelled, deadline)
+        packed, batch_entries, records, contents, worker_profile = batch_result
+        if profile is not None:
+            merge_wall, merge_cpu = time.perf_counter(), time.thread_time()
+            if worker_profile is not None:
+                profile.add_worker(worker_profile)
+        result.add_packed(packed)
+        if contents:
+            result.add_contents(contents)
+        entries.update(batch_entries)
+        if on_file is not None:
+            for file_path, language_id, *counts in records:
+                on_file(file_path, config.languages[language_id], LineCounts(*counts))
+        if profile is not None:
+            profile.add_stage(
+                "merge",
+                time.perf_counter() - merge_wall,
+                time.thread_time() - merge_cpu,
+            )
+
+    def merge_large(item: tuple[LargeFile, LineCounts, str]) -> None:
+        (file_path, node_id, file_stat, language_id, range_tasks), counts, digest = item
+        _check_stop(cancelled, deadline)
+        key = str(file_path)
+        result.add_counts(node_id, language_id, counts)
+        if large_file_policy == "full":  # lines only counted are not cached
+            entries[key] = (*file_stat, language_id, *counts, digest)
+        if dedup and digest:
+            result.add_contents([(key, file_stat[0], digest, language_id, *counts)])
+        if on_file is not None:
+            on_file(key, config.languages[language_id], counts)
+        if profile is not None:
+            profile.count(COUNTED)
+            profile.count(SPLIT)
+            profile.count("bytes_counted", file_stat[0])
+            profile.count("ranges", len(range_tasks))
+
+    def archive_tasks() -> list[ArchiveTask]:
+        # only complete once the walk is over
+        return [(str(archive_path), skip_size) for archive_path, _, _ in archives]
+
+    def merge_archive(archive: ArchiveFile, scan: ArchiveScan) -> None:
+        archive_path, node_id, _ = archive
+        _check_stop(cancelled, deadline)
+        if archive_path not in archive_roots:
+            node_id = result.add_node(node_id, archive_path.name)
+        members = _add_archive(
+            result, node_id, archive_path, scan, no_git_flag, profile
+        )
+        for member, size, language_id, code, comment, blank, digest in members:
+            key = str(archive_path / member)
+            if dedup and digest:
+                result.add_contents(
+                    [(key, size, digest, language_id, code, comment, blank)]
+                )
+            if on_file is not None:
+                counts = LineCounts(code, comment, blank)
+                on_file(key, config.languages[language_id], counts)
+        if profile is not None:
+            profile.count("archives")
+
+    # 3. count and aggregate results as they come, then the ranges of the large
+    # files and the archives, once all other files are queued
+    def count_in(workers: "Pool") -> None:
+        for batch_result in workers.imap_unordered(process_batch, chain(head, rest)):
+            merge(batch_result)
+        for item in count_large_files(large_files, workers.imap):
+            merge_large(item)
+        scans = workers.imap(process_archive, archive_tasks())
+        for archive, scan in zip(archives, scans):
+            merge_archive(archive, scan)
+
+    count_start = time.perf_counter()
+    if executor == "serial" or head_bytes < threshold or jobs <= 1:
         # process in single process
-        init_worker(config, all_ignore_paths)
-        for task in tasks:
-            results.append(process_file(task))
+        if pool is None:
+            init_worker(config, file_records, profiling, dedup)
+        for batch in chain(head, rest):
+            merge(process_batch(batch))
+        for item in count_large_files(large_files, map):
+            merge_large(item)
+        for archive, scan in zip(archives, map(process_archive, archive_tasks())):
+            merge_archive(archive, scan)
+    elif pool is not None:
+        # the walk stays in this thread, and only a few tasks are queued at once
+        in_flight = max(jobs, 1) * POOL_TASKS_PER_WORKER
+
+        def pool_imap(
+            func: Callable[[RangeTask], RangeResult], items: Iterable[RangeTask]
+        ) -> Iterator[RangeResult]:
+            return _pool_imap(pool, func, items, in_flight, cancelled, deadline)
+
+        batch_results = _pool_imap(
+            pool, process_batch, chain(head, rest), in_flight, cancelled, deadline
+        )
+        for batch_result in batch_results:
+            merge(batch_result)
+        for item in count_large_files(large_files, pool_imap):
+            merge_large(item)
+        scans = _pool_imap(
+            pool, process_archive, archive_tasks(), in_flight, cancelled, deadline
+        )
+        for archive, scan in zip(archives, scans):
+            merge_archive(archive, scan)
     else:
-        print(f"Processing {len(tasks)} tasks with {cpu_count() + 1} processes...")
-        with Pool(
-            processes=cpu_count() + 1,
-            initializer=init_worker,
-            initargs=(config, all_ignore_paths),
-        ) as pool:
-            results = pool.map(process_file, tasks, chunksize=(cpu_count() + 1) * 2)
-
-    # 3. aggregate results
-    flatten_results = [item for sublist in results for item in sublist]
-    for repo_node_id, language_id, line_count in flatten_results:
-        repo_node = RepoStatsNode.get_node_by_id(repo_node_id)
-        language = config.languages[language_id]
-        repo_node.stats[language] = repo_node.stats.get(language, 0) + line_count
+        # multiprocessing.pool is slow to import, and not needed for small trees
+        from multiprocessing.pool import Pool, ThreadPool
+
+        new_pool: Pool
+        if executor == "thread":
+            # threads share the config
+            init_worker(config, file_records, profiling, dedup)
+            new_pool = ThreadPool(processes=jobs)
+        else:
+            print(f"Processing with {jobs} processes...")
+            new_pool = Pool(
+                processes=jobs,
+                initializer=init_worker,
+                initargs=(config, file_records, profiling, dedup),
+            )
+        with new_pool:
+            count_in(new_pool)
+
+    if profile is not None:
+        profile.pool_wall = time.perf_counter() - count_start
+        with profile.stage("cache_save"):
+            if cache is not None:
+                cache.save(entries)
+        profile.finish()
+    elif cache is not None:
+        cache.save(entries)
+    if file_entries is not None:
+        file_entries.update(entries)
     return result
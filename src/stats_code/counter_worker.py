@@ -1,62 +1,334 @@
-import re
+import hashlib
+import heapq
+import os
+import threading
+import time
+from array import array
 from pathlib import Path
-from pathspec import PathSpec
-from .utils import check_path, counter_lines_in_file
+from typing import IO
+from .archive import ArchiveScan, scan_archive
+from .utils import (
+    CHUNK_SIZE,
+    RangeHasher,
+    content_digest,
+    counter_lines_in_bytes,
+    counter_lines_in_file,
+    counter_lines_in_stream,
+)
 from .language_config import LanguageConfig
+from .line_classifier import ClassifierState, CommentSyntax, LineClassifier, LineCounts
+from .cache import CacheEntry
+from .result import ContentRecord
+from .scan_profile import (
+    BINARY,
+    CACHED,
+    COUNTED,
+    SAME_CONTENT,
+    SLOWEST_FILES,
+    WorkerProfile,
+)
 
-# (file_path, repo_node_id, .gitignore_file_paths, language_config)
-Task = tuple[list[Path], int, list[Path]]
+# (size, mtime_ns, inode) of a file, as seen when walking
+FileStat = tuple[int, int, int]
+# (file_paths, directory node_id, file_stats, language_ids,
+#  cached_entries or None if cache is disabled)
+# files are already filtered and classified by the walk, workers only count them
+Task = tuple[list[Path], int, list[FileStat], list[int], dict[str, CacheEntry] | None]
+# (node_id, language_id) -> [code_lines, comment_lines, blank_lines]
+Totals = dict[tuple[int, int], list[int]]
+# (file_path, language_id, code_lines, comment_lines, blank_lines)
+FileRecord = tuple[str, int, int, int, int]
+# (packed totals, fresh cache entries, file records, content records,
+#  profile of the batch or None)
+BatchResult = tuple[
+    "array[int]",
+    dict[str, CacheEntry],
+    list[FileRecord],
+    list[ContentRecord],
+    WorkerProfile | None,
+]
 
-worker_language_config: LanguageConfig | None = None
-worker_ignore_specs: dict[Path, PathSpec] = {}
-git_re: re.Pattern | None = None
+# (file path, language_id, start, end, classifier state at start, whether lines
+#  are only counted, not classified) of a line aligned range of a large file
+RangeTask = tuple[str, int, int, int, ClassifierState, bool]
+# (line counts, classifier state at end, digest of the range or b"")
+RangeResult = tuple[LineCounts, ClassifierState, bytes]
+
+# (archive path, size above which its members are skipped, or None)
+ArchiveTask = tuple[str, int | None]
 
+# distinct contents whose line counts are remembered by each worker
+CONTENT_MEMO_SIZE = 1 << 16
 
-def check_ignore(path: Path) -> bool:
-    for spec in worker_ignore_specs.values():
-        if check_path(spec, path):
-            return True
-    return False
+worker_language_config: LanguageConfig | None = None
+worker_file_records: bool = False
+worker_profile: bool = False
+worker_dedup: bool = False
+# (content digest, language_id) -> line counts, shared by worker threads
+worker_contents: dict[tuple[str, int], LineCounts] = {}
+# (size, language_id) of the contents bigger than a chunk in `worker_contents`:
+# files of these sizes are hashed before being counted
+worker_large_sizes: set[tuple[int, int]] = set()
 
 
-def init_worker(config: LanguageConfig, ignore_paths: set[Path]) -> None:
+def init_worker(
+    config: LanguageConfig,
+    file_records: bool = False,
+    profile: bool = False,
+    dedup: bool = False,
+) -> None:
     """
-    Initializer for each worker process.
+    Initializer for each worker process, or once for all worker threads.
+    With `file_records`, the counts of every file are sent back as well, with
+    `profile`, the timings and counters of every batch, and with `dedup`, the
+    content digest of every file, and files whose content was already counted
+    by the worker are not classified again.
     """
-    global worker_language_config, worker_ignore_specs, git_re
+    global worker_language_config, worker_file_records, worker_profile, worker_dedup
     worker_language_config = config
-    for path in ignore_paths:
-        with path.open("r", encoding="utf-8", errors="ignore") as f:
-            worker_ignore_specs[path] = PathSpec.from_lines(
-                "gitwildmatch", f.readlines()
-            )
-    git_re = re.compile(r".*\.git.*?")  # pattern like `.gitignore`, `.gitsubmodule` ...
+    worker_file_records = file_records
+    worker_profile = profile
+    worker_dedup = dedup
+    worker_contents.clear()
+    worker_large_sizes.clear()
 
 
-def process_file(task: Task) -> list[tuple[int, int, int]]:
+def count_content(
+    file_path: Path, language_id: int, syntax: CommentSyntax | None, size: int
+) -> tuple[LineCounts, str, bool]:
     """
-    Task for a worker process to determin if a file needs to be counted and count lines.
-    return:
-        tuple of (repo_node_id, language_id, line_count)
+    Read a file once, hashing its content and counting its lines, unless the
+    worker already counted the same content for the same language.
+    Files bigger than a chunk, whose `size` was seen by the walk, are streamed
+    instead, see `_count_large_content`.
+    Returns (line counts, content digest or "" if unreadable, whether the
+    counts were already known).
     """
-    file_paths, repo_node_id, ignores = task
+    try:
+        with open(file_path, "rb", buffering=0) as f:
+            if size > CHUNK_SIZE:
+                return _count_large_content(f, language_id, syntax, size)
+            data = f.readall()
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return LineCounts(), "", False
+    digest = content_digest(data)
+    counts = worker_contents.get((digest, language_id))
+    if counts is not None:
+        return counts, digest, True
+    counts = counter_lines_in_bytes(data, syntax)
+    _remember_content(digest, language_id, counts)
+    return counts, digest, False
+
+
+def _count_large_content(
+    f: IO[bytes], language_id: int, syntax: CommentSyntax | None, size: int
+) -> tuple[LineCounts, str, bool]:
+    """
+    Stream a file bigger than a chunk, whose digest is only known at the end.
+    It is hashed and counted in one pass, unless the worker already counted a
+    content of the same size and language: then it is only hashed, and counted
+    from its start again if its content was not counted after all.
+    """
+    if (size, language_id) in worker_large_sizes:
+        hasher = RangeHasher()
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+        counts = worker_contents.get((digest, language_id))
+        if counts is not None:
+            return counts, digest, True
+        f.seek(0)
+    hasher = RangeHasher()
+    counts = counter_lines_in_stream(f, syntax, hasher)
+    digest = hasher.hexdigest()
+    _remember_content(digest, language_id, counts)
+    worker_large_sizes.add((size, language_id))
+    return counts, digest, False
+
 
-    global worker_language_config, worker_ignore_specs, git_re
+def _remember_content(digest: str, language_id: int, counts: LineCounts) -> None:
+    if len(worker_contents) >= CONTENT_MEMO_SIZE:
+        worker_contents.clear()
+        worker_large_sizes.clear()
+    worker_contents[(digest, language_id)] = counts
+
+
+def process_file(
+    task: Task,
+    totals: Totals,
+    entries: dict[str, CacheEntry],
+    records: list[FileRecord] | None,
+    counters: dict[str, int] | None = None,
+    slowest: list[tuple[float, str]] | None = None,
+    contents: list[ContentRecord] | None = None,
+) -> None:
+    """
+    Task for a worker to count lines of files, unless they are cached.
+    Line counts are added to `totals`, fresh cache entries of counted files
+    to `entries` (unless cache is disabled), and a record of each file to
+    `records` if it is given. When profiling, files are counted by outcome in
+    `counters`, and the slowest ones are kept in the `slowest` heap.
+    With `contents`, files are hashed while read, and their content records
+    are added to it.
+    """
+    file_paths, node_id, stats, language_ids, cached = task
+
+    global worker_language_config
     assert worker_language_config is not None
-    assert worker_ignore_specs is not None
-    assert git_re is not None
+    languages = worker_language_config.languages
 
-    results: list[tuple[int, int, int]] = []
     assert len(file_paths) > 0
-    for file_path in file_paths:
-        if git_re.match(file_path.name):
-            continue
-        if check_ignore(file_path):
-            continue
-        if worker_language_config.check_skip_by_config(file_path):
-            continue
-        language_id = worker_language_config.detect_language_by_path(file_path)
-        line_count = counter_lines_in_file(file_path)
-        results.append((repo_node_id, language_id, line_count))
-
-    return results
+    for file_path, stat, language_id in zip(file_paths, stats, language_ids):
+        if counters is not None:
+            start_time = time.perf_counter()
+        syntax = languages[language_id]._syntax
+        entry = cached.get(str(file_path)) if cached is not None else None
+        # files are read again when their digest is needed but was not cached
+        hit = (
+            entry is not None
+            and entry[:3] == stat
+            and (contents is None or entry[7] != "")
+        )
+        same_content = False
+        if entry is not None and hit:
+            language_id, counts = entry[3], LineCounts(*entry[4:7])
+            digest = entry[7]
+        elif contents is not None:
+            counts, digest, same_content = count_content(
+                file_path, language_id, syntax, stat[0]
+            )
+        else:
+            counts, digest = counter_lines_in_file(file_path, syntax), ""
+        if cached is not None:
+            entries[str(file_path)] = (*stat, language_id, *counts, digest)
+        if contents is not None and digest:
+            contents.append((str(file_path), stat[0], digest, language_id, *counts))
+        if counters is not None and slowest is not None:
+            if hit:
+                _add(counters, CACHED, 1)
+            else:
+                _add(counters, COUNTED, 1)
+                _add(counters, "bytes_counted", stat[0])
+                if stat[0] and not counts.total:
+                    _add(counters, BINARY, 1)
+                if same_content:
+                    _add(counters, SAME_CONTENT, 1)
+            item = (time.perf_counter() - start_time, str(file_path))
+            if len(slowest) < SLOWEST_FILES:
+                heapq.heappush(slowest, item)
+            else:
+                heapq.heappushpop(slowest, item)
+        if records is not None:
+            records.append((str(file_path), language_id, *counts))
+        total = totals.get((node_id, language_id))
+        if total is None:
+            totals[(node_id, language_id)] = list(counts)
+        else:
+            total[0] += counts.code
+            total[1] += counts.comment
+            total[2] += counts.blank
+
+
+def count_range(task: RangeTask) -> RangeResult:
+    """
+    Count the lines of a range of a large file through a memory map, a chunk at
+    a time so memory stays bounded, starting from the given classifier state.
+    The range is also hashed when deduplicating.
+    """
+    import mmap
+
+    file_path, language_id, start, end, state, fast = task
+    assert worker_language_config is not None
+    syntax = worker_language_config.languages[language_id]._syntax
+    classifier = None if fast else LineClassifier(syntax, state)
+    hasher = hashlib.blake2b(digest_size=16) if worker_dedup else None
+    lines = 0
+    try:
+        with (
+            open(file_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                page_start = start - start % mmap.PAGESIZE
+                mm.madvise(mmap.MADV_SEQUENTIAL, page_start, end - page_start)
+            for pos in range(start, end, CHUNK_SIZE):
+                chunk = mm[pos : min(pos + CHUNK_SIZE, end)]
+                if hasher is not None:
+                    hasher.update(chunk)
+                if classifier is None:
+                    lines += chunk.count(b"\n")
+                else:
+                    classifier.feed(chunk)
+            if classifier is None and end > start and mm[end - 1] != ord("\n"):
+                lines += 1  # the last line has no line break
+    except (OSError, ValueError) as e:
+        print(f"Error reading {file_path}: {e}")
+        return LineCounts(), state, b""
+    digest = hasher.digest() if hasher is not None else b""
+    if classifier is None:
+        return LineCounts(lines), state, digest
+    return classifier.finish(), classifier.state, digest
+
+
+def process_archive(task: ArchiveTask) -> ArchiveScan:
+    """
+    Count the members of an archive with the config of the worker, hashing
+    them when deduplicating.
+    """
+    archive_path, max_file_size = task
+    assert worker_language_config is not None
+    return scan_archive(
+        Path(archive_path), worker_language_config, max_file_size, worker_dedup
+    )
+
+
+def process_batch(batch: list[Task]) -> BatchResult:
+    """
+    Process a batch of tasks, sized by the bytes to count rather than by directory.
+    return:
+        totals per (node_id, language_id), packed as read by `Result.add_packed`,
+        fresh cache entries of counted files (empty if cache is disabled),
+        records of counted files (empty unless requested by `init_worker`),
+        content records of counted files (empty unless deduplicating)
+    """
+    totals: Totals = {}
+    entries: dict[str, CacheEntry] = {}
+    records: list[FileRecord] = []
+    file_records = records if worker_file_records else None
+    contents: list[ContentRecord] = []
+    file_contents = contents if worker_dedup else None
+    if not worker_profile:
+        for task in batch:
+            process_file(task, totals, entries, file_records, contents=file_contents)
+        return _pack(totals), entries, records, contents, None
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    counters: dict[str, int] = {}
+    slowest: list[tuple[float, str]] = []
+    for task in batch:
+        process_file(
+            task, totals, entries, file_records, counters, slowest, file_contents
+        )
+    packed = _pack(totals)
+    worker_id = f"{os.getpid()}/{threading.current_thread().name}"
+    profile: WorkerProfile = (
+        worker_id,
+        time.perf_counter() - start_wall,
+        time.thread_time() - start_cpu,
+        counters,
+        slowest,
+    )
+    return packed, entries, records, contents, profile
+
+
+def _pack(totals: Totals) -> "array[int]":
+    packed = array("q")
+    for (node_id, language_id), (code, comment, blank) in totals.items():
+        packed.extend((node_id, language_id, code, comment, blank))
+    return packed
+
+
+def _add(counters: dict[str, int], name: str, value: int) -> None:
+    counters[name] = counters.get(name, 0) + value
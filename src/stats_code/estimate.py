@@ -0,0 +1,434 @@
+import heapq
+import math
+import random
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+from .counter import Seen, classify_files, walk_root
+from .counter_worker import BatchResult, FileStat, Task, init_worker, process_batch
+from .executor import default_executor, default_jobs
+from .language_config import LanguageConfig
+from .line_classifier import LineCounts
+from .result import CONFIDENCE_Z, DEFAULT_TIME_BUDGET, Margins, Result
+from .scan_profile import ScanProfile
+
+"""
+Estimate mode: every file is found and classified by a walk, which only stats
+files, but lines are only counted for a sample of them. Files are stratified
+by language and size class, strata are sampled in rounds where each file goes
+to the stratum whose variance it reduces the most, and line counts are
+extrapolated from the bytes of each stratum with a ratio estimator, with
+confidence intervals. The estimate tightens with every round, and is exact
+once every file is counted.
+"""
+
+# files of each stratum kept to sample from, by reservoir sampling, so memory
+# does not grow with the tree; strata with more files get more of their files
+# from another walk once their sample is all counted
+RESERVOIR_FILES = 4096
+# files counted per round, between two updates of the estimate
+ROUND_FILES = 512
+# files of a batch sent to a worker
+SAMPLE_BATCH_FILES = 16
+# lines per byte assumed when planning a stratum with less than two counted files
+_PLANNING_LINES_PER_BYTE = 1 / 32
+
+# (language_id, size class), the size class being the bit length of the size
+StratumKey = tuple[int, int]
+# (code, comment, blank, lines) estimates or variances
+_Fields = list[float]
+
+T = TypeVar("T")
+
+
+class _Stratum:
+    """
+    The files of a language in a size class: how many there are, their bytes,
+    a uniform sample of them kept by reservoir sampling, and the line counts
+    of the ones counted so far.
+    """
+
+    __slots__ = ("files", "bytes", "reservoir", "counted", "picked")
+
+    def __init__(self) -> None:
+        self.files = 0
+        self.bytes = 0
+        self.reservoir: list[tuple[Path, FileStat]] = []
+        # (size, code, comment, blank) of the counted files
+        self.counted: list[tuple[int, int, int, int]] = []
+        # files of the reservoir picked so far, counted or in flight
+        self.picked = 0
+
+    def add(self, file_path: Path, file_stat: FileStat, rng: random.Random) -> None:
+        self.files += 1
+        self.bytes += file_stat[0]
+        _sample(
+            self.reservoir, RESERVOIR_FILES, self.files, (file_path, file_stat), rng
+        )
+
+    def can_pick(self) -> bool:
+        # empty files have no lines, they are never counted
+        return self.bytes > 0 and self.picked < len(self.reservoir)
+
+    def refill_size(self) -> int:
+        """
+        How many files to add to the sample once it is all picked, as many as it
+        already has, so that memory stays proportional to the counted files and
+        a stratum is exhausted in a few walks. 0 once every file is sampled.
+        """
+        if self.bytes == 0 or self.picked < len(self.reservoir):
+            return 0
+        sampled = len(self.reservoir)
+        return min(max(RESERVOIR_FILES, sampled), self.files - sampled)
+
+    def spread(self) -> float:
+        """
+        Variance of the lines of the files around the ratio estimate, assumed
+        from the mean size until two files are counted.
+        """
+        if len(self.counted) < 2:
+            return (self.bytes / self.files * _PLANNING_LINES_PER_BYTE) ** 2
+        sizes = [item[0] for item in self.counted]
+        values = [item[1] + item[2] + item[3] for item in self.counted]
+        return _fit(values, sizes, self.files, self.bytes)[1]
+
+    def gain(self, spread: float) -> float:
+        """
+        How much counting one more file reduces the variance of the lines of
+        the stratum, with the given spread of its files.
+        """
+        n = self.picked
+        if n == 0:
+            return math.inf
+        return self.files * self.files * spread * (1 / n - 1 / (n + 1))
+
+    def estimate(self, ratios: _Fields | None) -> tuple[_Fields, _Fields]:
+        """
+        Ratio estimates of the (code, comment, blank, lines) of the stratum from
+        its bytes, and their variances. A stratum with no counted file is
+        estimated from the lines per byte of its language, `ratios`, with a
+        variance as large as the estimate.
+        """
+        n = len(self.counted)
+        if n == self.files or self.bytes == 0:
+            sums = [float(sum(item[i] for item in self.counted)) for i in (1, 2, 3)]
+            sums.append(sum(sums))
+            return sums, [0.0] * 4
+        if n == 0:
+            estimates = [ratio * self.bytes for ratio in (ratios or [0.0] * 4)]
+            return estimates, [value * value for value in estimates]
+        sizes = [item[0] for item in self.counted]
+        # finite population correction
+        fpc = 1 - n / self.files
+        estimates = []
+        variances = []
+        for values in (
+            [item[1] for item in self.counted],
+            [item[2] for item in self.counted],
+            [item[3] for item in self.counted],
+            [item[1] + item[2] + item[3] for item in self.counted],
+        ):
+            value, spread = _fit(values, sizes, self.files, self.bytes)
+            estimates.append(value)
+            variances.append(self.files * self.files * fpc * spread / n)
+        return estimates, variances
+
+
+def _sample(sample: list[T], size: int, seen: int, item: T, rng: random.Random) -> None:
+    """
+    Reservoir sampling: keep in `sample` a uniform sample of at most `size` of
+    the `seen` items seen so far, `item` being the last one.
+    """
+    if len(sample) < size:
+        sample.append(item)
+    else:
+        i = rng.randrange(seen)
+        if i < size:
+            sample[i] = item
+
+
+def _fit(
+    values: list[int], sizes: list[int], files: int, total_size: int
+) -> tuple[float, float]:
+    """
+    Ratio estimate of the total of `values` over `files` files of `total_size`
+    bytes, from a sample of their values and sizes, and the variance of the
+    sample around it.
+    """
+    n = len(values)
+    sample_size = sum(sizes)
+    if sample_size:
+        ratio = sum(values) / sample_size
+        estimate = ratio * total_size
+        residuals = [value - ratio * size for value, size in zip(values, sizes)]
+    else:
+        mean = sum(values) / n
+        estimate = mean * files
+        residuals = [value - mean for value in values]
+    if n < 2:
+        # a single file tells nothing about the spread, assume the worst
+        return estimate, float(values[0] * values[0])
+    return estimate, sum(residual * residual for residual in residuals) / (n - 1)
+
+
+def estimate(
+    path: Path,
+    no_git_flag: bool,
+    time_budget: float | None = DEFAULT_TIME_BUDGET,
+    file_budget: int | None = None,
+    git_index_flag: bool = False,
+    untracked_flag: bool = False,
+    jobs: int | None = None,
+    executor: str | None = None,
+    config: LanguageConfig | None = None,
+    cache_dir: Path | None = None,
+    profile: ScanProfile | None = None,
+    on_round: Callable[[Result], None] | None = None,
+    seed: int = 0,
+) -> Result:
+    """
+    Estimate the lines of all files under `path` from a sample of them, counted
+    until `time_budget` seconds (since the start of the walk) or `file_budget`
+    counted files are spent. At least one file of every language and size class
+    is counted, even past the budgets.
+    The result only has a root node, with the estimated line counts of every
+    language, its `sampled` files and its `margins`.
+    `on_round` is called with the estimate after every round of counted files.
+    The other arguments are the ones of `counter`, `config` being loaded from
+    `cache_dir` unless given.
+    """
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+    if config is None:
+        config = LanguageConfig.load(cache_dir)
+    rng = random.Random(seed)
+
+    def walk_files(
+        walk_profile: ScanProfile | None,
+    ) -> Iterator[tuple[StratumKey, Path, FileStat]]:
+        walked = Result(config.languages)  # directories of the walk, not reported
+        seen: Seen = set()
+        walk = walk_root(
+            walked,
+            path,
+            Result.ROOT,
+            no_git_flag,
+            git_index_flag,
+            untracked_flag,
+            config,
+            seen,
+        )
+        tasks: Iterator[Task] = classify_files(walk, config, walk_profile, seen)
+        if walk_profile is not None:
+            tasks = walk_profile.iter_stage("walk", tasks)
+        for file_paths, _, stats, language_ids, _ in tasks:
+            for file_path, file_stat, language_id in zip(
+                file_paths, stats, language_ids
+            ):
+                yield (language_id, file_stat[0].bit_length()), file_path, file_stat
+
+    # 1. walk and classify every file, only keeping a sample of each stratum
+    strata: dict[StratumKey, _Stratum] = {}
+    for key, file_path, file_stat in walk_files(profile):
+        stratum = strata.get(key)
+        if stratum is None:
+            stratum = strata[key] = _Stratum()
+        stratum.add(file_path, file_stat, rng)
+    for stratum in strata.values():
+        rng.shuffle(stratum.reservoir)
+
+    # 2. count rounds of picked files, until a budget is spent
+    if executor is None:
+        executor = default_executor(path)
+    if jobs is None:
+        jobs = default_jobs(executor)
+    profiling = profile is not None
+
+    def count_rounds(
+        run: Callable[[Iterable[list[Task]]], Iterator[BatchResult]],
+    ) -> None:
+        counted = 0
+        first = True
+        while first or (
+            (deadline is None or time.perf_counter() < deadline)
+            and (file_budget is None or counted < file_budget)
+        ):
+            limit = ROUND_FILES
+            if file_budget is not None and not first:
+                limit = min(limit, file_budget - counted)
+            picked = _pick(strata, limit, first)
+            # every sampled file is counted, sample the rest of the big strata
+            if not picked and _refill(strata, walk_files(None), rng):
+                picked = _pick(strata, limit, first)
+            if not picked:
+                return
+            first = False
+            # file path -> (stratum, size)
+            where = {
+                str(file_path): (strata[key], file_stat[0])
+                for key, file_path, file_stat in picked
+            }
+            batches: list[list[Task]] = [
+                [
+                    ([file_path], Result.ROOT, [file_stat], [key[0]], None)
+                    for key, file_path, file_stat in picked[
+                        start : start + SAMPLE_BATCH_FILES
+                    ]
+                ]
+                for start in range(0, len(picked), SAMPLE_BATCH_FILES)
+            ]
+            for _, _, records, _, worker_profile in run(batches):
+                if profile is not None and worker_profile is not None:
+                    profile.add_worker(worker_profile)
+                for file_path, _, code, comment, blank in records:
+                    stratum, size = where[file_path]
+                    stratum.counted.append((size, code, comment, blank))
+                    counted += 1
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+            if on_round is not None:
+                on_round(_estimated_result(config, strata))
+
+    count_start = time.perf_counter()
+    if executor == "serial" or jobs <= 1:
+        init_worker(config, True, profiling)
+        count_rounds(lambda batches: map(process_batch, batches))
+    else:
+        from multiprocessing.pool import Pool, ThreadPool
+
+        pool: Pool
+        if executor == "thread":
+            init_worker(config, True, profiling)
+            pool = ThreadPool(processes=jobs)
+        else:
+            pool = Pool(
+                processes=jobs,
+                initializer=init_worker,
+                initargs=(config, True, profiling),
+            )
+        # leaving the pool terminates the files still counted past the deadline
+        with pool:
+            count_rounds(lambda batches: pool.imap_unordered(process_batch, batches))
+    if profile is not None:
+        profile.pool_wall = time.perf_counter() - count_start
+        profile.finish()
+    return _estimated_result(config, strata)
+
+
+def _pick(
+    strata: dict[StratumKey, _Stratum], limit: int, first: bool
+) -> list[tuple[StratumKey, Path, FileStat]]:
+    """
+    Pick up to `limit` files to count, each from the stratum where it reduces
+    the variance the most, or one file of every stratum for the first round.
+    """
+    picked: list[tuple[StratumKey, Path, FileStat]] = []
+    if first:
+        for key, stratum in strata.items():
+            if stratum.can_pick():
+                picked.append((key, *stratum.reservoir[0]))
+                stratum.picked = 1
+        return picked
+    # the spread of each stratum only changes with counted files, not picked ones
+    spreads = {key: stratum.spread() for key, stratum in strata.items()}
+    # (-gain, -bytes, key) of every stratum with files left to pick
+    heap = [
+        (-stratum.gain(spreads[key]), -stratum.bytes, key)
+        for key, stratum in strata.items()
+        if stratum.can_pick()
+    ]
+    heapq.heapify(heap)
+    while heap and len(picked) < limit:
+        _, _, key = heapq.heappop(heap)
+        stratum = strata[key]
+        picked.append((key, *stratum.reservoir[stratum.picked]))
+        stratum.picked += 1
+        if stratum.can_pick():
+            heapq.heappush(heap, (-stratum.gain(spreads[key]), -stratum.bytes, key))
+    return picked
+
+
+def _refill(
+    strata: dict[StratumKey, _Stratum],
+    files: Iterable[tuple[StratumKey, Path, FileStat]],
+    rng: random.Random,
+) -> bool:
+    """
+    Add files from another walk, `files`, to the samples of the strata which
+    are all picked but have more files, each a uniform sample of the files
+    left, so that the counted files stay a uniform sample of their stratum.
+    Returns False if no file was added.
+    """
+    sizes = {key: stratum.refill_size() for key, stratum in strata.items()}
+    sizes = {key: size for key, size in sizes.items() if size}
+    if not sizes:
+        return False
+    sampled = {key: {item[0] for item in strata[key].reservoir} for key in sizes}
+    samples: dict[StratumKey, list[tuple[Path, FileStat]]] = {key: [] for key in sizes}
+    left = dict.fromkeys(sizes, 0)
+    for key, file_path, file_stat in files:
+        if key not in sizes or file_path in sampled[key]:
+            continue
+        left[key] += 1
+        _sample(samples[key], sizes[key], left[key], (file_path, file_stat), rng)
+    for key, sample in samples.items():
+        rng.shuffle(sample)
+        strata[key].reservoir.extend(sample)
+    return any(samples.values())
+
+
+def _estimated_result(
+    config: LanguageConfig, strata: dict[StratumKey, _Stratum]
+) -> Result:
+    """
+    Sum the estimates of the strata of every language into a result with their
+    margins, variances adding up as strata are sampled independently.
+    """
+    # lines per byte over the counted files, of every language and of all of them
+    sizes: dict[int, int] = {}
+    lines: dict[int, _Fields] = {}
+    for (language_id, _), stratum in strata.items():
+        for size, code, comment, blank in stratum.counted:
+            sizes[language_id] = sizes.get(language_id, 0) + size
+            fields = lines.setdefault(language_id, [0.0] * 4)
+            for i, value in enumerate((code, comment, blank, code + comment + blank)):
+                fields[i] += value
+    all_size = sum(sizes.values())
+    all_ratios = (
+        [sum(fields[i] for fields in lines.values()) / all_size for i in range(4)]
+        if all_size
+        else None
+    )
+
+    estimates: dict[int, _Fields] = {}
+    variances: dict[int, _Fields] = {}
+    for (language_id, _), stratum in strata.items():
+        ratios = all_ratios
+        if sizes.get(language_id):
+            ratios = [value / sizes[language_id] for value in lines[language_id]]
+        stratum_estimates, stratum_variances = stratum.estimate(ratios)
+        language_estimates = estimates.setdefault(language_id, [0.0] * 4)
+        language_variances = variances.setdefault(language_id, [0.0] * 4)
+        for i in range(4):
+            language_estimates[i] += stratum_estimates[i]
+            language_variances[i] += stratum_variances[i]
+
+    result = Result(config.languages)
+    total_variances = [0.0] * 4
+    for language_id, language_estimates in estimates.items():
+        counts = LineCounts(*(round(value) for value in language_estimates[:3]))
+        if not counts.total:
+            continue
+        result.add_counts(Result.ROOT, language_id, counts)
+        result.margins[config.languages[language_id]] = _margins(variances[language_id])
+        for i in range(4):
+            total_variances[i] += variances[language_id][i]
+    result.total_margins = _margins(total_variances)
+    result.sampled = (
+        sum(len(stratum.counted) for stratum in strata.values()),
+        sum(stratum.files for stratum in strata.values()),
+    )
+    return result
+
+
+def _margins(variances: _Fields) -> Margins:
+    return Margins(*(round(CONFIDENCE_Z * math.sqrt(value)) for value in variances))
@@ -0,0 +1,77 @@
+import os
+import re
+from pathlib import Path
+
+"""
+Choice of the executor counting files: a process pool for CPU bound scans of
+local disks, a thread pool for scans bound by the latency of network or FUSE
+file systems, or a single process.
+"""
+
+EXECUTORS = ("process", "thread", "serial")
+
+# file systems where reads are bound by latency rather than by CPU
+_LATENCY_BOUND_FS_TYPES = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "ceph",
+    "glusterfs",
+    "lustre",
+    "afs",
+    "davfs",
+}
+# spaces, tabs, line breaks and backslashes of /proc/mounts fields, which are
+# escaped as a backslash and 3 octal digits
+_MOUNT_ESCAPE_RE = re.compile(rb"\\([0-7]{3})")
+
+
+def default_jobs(executor: str) -> int:
+    cpus = os.cpu_count() or 1
+    if executor == "thread":
+        # threads mostly wait on reads, keep many of them in flight
+        return min(32, cpus + 4)
+    return cpus + 1
+
+
+def filesystem_type(path: Path) -> str | None:
+    """
+    Return the type of the file system mounting `path`, from /proc/mounts.
+    Return None if it is unknown, e.g. on platforms without /proc.
+    """
+    try:
+        with open("/proc/mounts", "rb") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    target = os.path.realpath(path)
+    best_mount = ""
+    best_type: str | None = None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # other bytes are kept as is, decoded like the paths of the file system
+        mount_point = os.fsdecode(
+            _MOUNT_ESCAPE_RE.sub(lambda m: bytes([int(m[1], 8)]), fields[1])
+        )
+        if (
+            target == mount_point or target.startswith(mount_point.rstrip("/") + "/")
+        ) and len(mount_point) >= len(best_mount):
+            best_mount, best_type = mount_point, os.fsdecode(fields[2])
+    return best_type
+
+
+def default_executor(path: Path) -> str:
+    """
+    Use threads on network and FUSE file systems, processes otherwise.
+    """
+    fs_type = filesystem_type(path)
+    if fs_type is not None and (
+        fs_type in _LATENCY_BOUND_FS_TYPES or fs_type.startswith("fuse")
+    ):
+        return "thread"
+    return "process"
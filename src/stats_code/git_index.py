@@ -0,0 +1,148 @@
+import struct
+from pathlib import Path
+
+"""
+A minimal reader of the git index file (`.git/index`, versions 2 to 4).
+It lists the tracked files of a work tree without running `git`.
+See https://git-scm.com/docs/index-format for the format.
+"""
+
+MODE_TYPE_MASK = 0o170000
+MODE_DIR = 0o040000
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+
+_HEADER = struct.Struct(">4sII")
+# ctime(2), mtime(2), dev, ino, mode, uid, gid, size
+_ENTRY_STAT = struct.Struct(">10I")
+_FLAG_EXTENDED = 0x4000
+_FLAG_STAGE_MASK = 0x3000
+_FLAG_NAME_MASK = 0x0FFF
+_EXT_FLAG_SKIP_WORKTREE = 0x4000
+# extensions which mean the index does not list the full work tree
+_UNSUPPORTED_EXTENSIONS = {b"link", b"sdir"}
+
+# (path relative to the work tree, mode)
+IndexEntry = tuple[str, int]
+
+
+class UnsupportedIndexError(Exception):
+    """
+    Raised when the index cannot be used to enumerate files,
+    callers are expected to fall back to walking the directory.
+    """
+
+
+def resolve_git_dir(work_tree: Path) -> Path | None:
+    """
+    Return the git directory of a work tree, following `gitdir:` files
+    used by submodules and worktrees. Return None if it is not a repo.
+    """
+    dot_git = work_tree / ".git"
+    if dot_git.is_dir():
+        return dot_git
+    if dot_git.is_file():
+        try:
+            content = dot_git.read_text(encoding="utf-8").strip()
+        except OSError:
+            return None
+        if content.startswith("gitdir:"):
+            git_dir = Path(content[len("gitdir:") :].strip())
+            if not git_dir.is_absolute():
+                git_dir = work_tree / git_dir
+            return git_dir if git_dir.is_dir() else None
+    return None
+
+
+def object_id_size(git_dir: Path) -> int:
+    """
+    Size in bytes of the object ids of a repo: 20, or 32 for repositories
+    created with `--object-format=sha256`.
+    """
+    try:
+        config = (git_dir / "config").read_text(encoding="utf-8", errors="ignore")
+    except OSError:
+        return 20
+    for line in config.splitlines():
+        key, _, value = line.partition("=")
+        if key.strip().lower() == "objectformat" and value.strip() == "sha256":
+            return 32
+    return 20
+
+
+def read_index(git_dir: Path) -> list[IndexEntry]:
+    """
+    Parse `<git_dir>/index` and return the stage 0 entries present in the work tree.
+    Raise UnsupportedIndexError if the index is missing or can not be trusted.
+    """
+    try:
+        data = (git_dir / "index").read_bytes()
+    except OSError as e:
+        raise UnsupportedIndexError(f"cannot read index: {e}") from e
+    hash_size = object_id_size(git_dir)
+    if len(data) < _HEADER.size + hash_size:
+        raise UnsupportedIndexError("index is truncated")
+    signature, version, count = _HEADER.unpack_from(data, 0)
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise UnsupportedIndexError(f"unsupported index version {version}")
+
+    entries: list[IndexEntry] = []
+    offset = _HEADER.size
+    prev_name = b""
+    try:
+        for _ in range(count):
+            entry_start = offset
+            mode = _ENTRY_STAT.unpack_from(data, offset)[6]
+            offset += _ENTRY_STAT.size + hash_size
+            (flags,) = struct.unpack_from(">H", data, offset)
+            offset += 2
+            extended_flags = 0
+            if flags & _FLAG_EXTENDED:
+                (extended_flags,) = struct.unpack_from(">H", data, offset)
+                offset += 2
+            if version == 4:
+                # prefix compressed name: strip N bytes of the previous name
+                strip, offset = _read_varint(data, offset)
+                end = data.index(b"\0", offset)
+                name = prev_name[: len(prev_name) - strip] + data[offset:end]
+                offset = end + 1
+            else:
+                name_len = flags & _FLAG_NAME_MASK
+                if name_len == _FLAG_NAME_MASK:
+                    name_len = data.index(b"\0", offset) - offset
+                name = data[offset : offset + name_len]
+                # entries are NUL padded to a multiple of 8 bytes
+                offset = entry_start + ((offset - entry_start + name_len) // 8 + 1) * 8
+            if mode & MODE_TYPE_MASK == MODE_DIR:
+                raise UnsupportedIndexError("sparse index is not supported")
+            is_same_path = name == prev_name
+            prev_name = name
+            if flags & _FLAG_STAGE_MASK and is_same_path:
+                continue  # unmerged path, keep only one stage
+            if extended_flags & _EXT_FLAG_SKIP_WORKTREE:
+                continue  # not checked out
+            entries.append((name.decode("utf-8", errors="surrogateescape"), mode))
+    except (struct.error, ValueError, IndexError) as e:
+        raise UnsupportedIndexError(f"index is corrupted: {e}") from e
+
+    # extensions: 4 bytes signature + 4 bytes size, until the trailing checksum
+    while offset + 8 <= len(data) - hash_size:
+        ext_signature, ext_size = struct.unpack_from(">4sI", data, offset)
+        if ext_signature in _UNSUPPORTED_EXTENSIONS:
+            raise UnsupportedIndexError(
+                f"index extension {ext_signature.decode()} is not supported"
+            )
+        offset += 8 + ext_size
+    return entries
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    # the offset encoding used by git, see varint.c
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7F)
+    return value, offset
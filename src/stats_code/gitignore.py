@@ -0,0 +1,160 @@
+import os
+import re
+from pathlib import Path
+
+"""
+Hierarchical gitignore matching.
+Rules of each .gitignore file are anchored to the directory defining them, and
+the effective rules of a directory (all its ancestor .gitignore files) are
+compiled into a single regex, which is cached and shared by every file in it.
+"""
+
+_NAMED_GROUP_RE = re.compile(r"\(\?P<\w+>")
+
+
+def translate_pattern(pattern: str) -> tuple[str, bool] | None:
+    """
+    Translate a gitwildmatch pattern to (regex anchored with ^, ignores).
+    Return None for blank lines and comments.
+    """
+    # pathspec is slow to import, and not needed when patterns come precompiled
+    from pathspec.patterns import GitWildMatchPattern
+
+    regex, include = GitWildMatchPattern.pattern_to_regex(pattern)
+    if regex is None or include is None:
+        return None
+    # groups are renamed when combined, so drop the ones of pathspec
+    return _NAMED_GROUP_RE.sub("(?:", regex), include
+
+
+def _combine(regexes: list[str]) -> re.Pattern[str]:
+    # the last matching rule wins, so callers pass rules in reverse order
+    return re.compile(
+        "^(?:" + "|".join(f"(?P<r{i}>{regex})" for i, regex in enumerate(regexes)) + ")"
+    )
+
+
+class WildMatchSpec:
+    """
+    A list of gitwildmatch patterns compiled into a single regex, matching
+    like `pathspec.PathSpec.match_file` without importing pathspec at match time.
+    It pickles as compiled regexes, so it can be loaded from a cache cheaply.
+    """
+
+    def __init__(self, patterns: list[str]) -> None:
+        rules: list[tuple[str, bool]] = []
+        for pattern in patterns:
+            translated = translate_pattern(pattern)
+            if translated is not None:
+                rules.append(translated)
+        rules.reverse()
+        self._pattern: re.Pattern[str] | None = (
+            _combine([regex for regex, _ in rules]) if rules else None
+        )
+        self._ignores: list[bool] = [ignores for _, ignores in rules]
+
+    def match_file(self, path: str) -> bool:
+        if self._pattern is None:
+            return False
+        matched = self._pattern.match(path)
+        if matched is None or matched.lastgroup is None:
+            return False
+        return self._ignores[int(matched.lastgroup[1:])]
+
+
+class IgnoreRules:
+    """
+    The compiled rules of a chain of ancestor .gitignore files.
+    """
+
+    def __init__(self, root: str, pattern: re.Pattern[str], ignores: list[bool]):
+        self._prefix_len = len(root) + 1
+        self._pattern = pattern
+        # whether the rule of each group ignores (True) or re-includes (False)
+        self._ignores = ignores
+
+    def match(self, path: Path, is_dir: bool = False) -> bool:
+        rel = os.fspath(path)[self._prefix_len :]
+        if os.sep != "/":
+            rel = rel.replace(os.sep, "/")
+        if is_dir:
+            rel += "/"
+        matched = self._pattern.match(rel)
+        if matched is None or matched.lastgroup is None:
+            return False
+        return self._ignores[int(matched.lastgroup[1:])]
+
+
+class GitIgnoreMatcher:
+    """
+    Load .gitignore files once and compile the rules of every distinct
+    chain of ancestor .gitignore files once.
+    """
+
+    def __init__(self) -> None:
+        # .gitignore path -> list of (regex relative to its directory, ignores)
+        self._files: dict[Path, list[tuple[str, bool]]] = {}
+        self._compiled: dict[tuple[Path, ...], IgnoreRules | None] = {}
+
+    def _load(self, ignore_path: Path) -> list[tuple[str, bool]]:
+        rules = self._files.get(ignore_path)
+        if rules is not None:
+            return rules
+        try:
+            with ignore_path.open("r", encoding="utf-8", errors="ignore") as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            print(f"Error loading {ignore_path}: {e}")
+            lines = []
+        return self.add(ignore_path, lines)
+
+    def add(self, ignore_path: Path, lines: list[str]) -> list[tuple[str, bool]]:
+        """
+        Register the lines of a .gitignore file which is not on disk, e.g. a
+        member of an archive, and return its rules.
+        """
+        rules: list[tuple[str, bool]] = []
+        for line in lines:
+            translated = translate_pattern(line)
+            if translated is None:
+                continue  # blank line or comment
+            regex, include = translated
+            rules.append((regex.removeprefix("^"), include))
+        self._files[ignore_path] = rules
+        return rules
+
+    def forget(self, ignore_path: Path) -> None:
+        """
+        Drop a .gitignore file which changed, and the compiled chains using it.
+        """
+        self._files.pop(ignore_path, None)
+        for key in [key for key in self._compiled if ignore_path in key]:
+            del self._compiled[key]
+
+    def rules_for(self, ignore_paths: list[Path]) -> IgnoreRules | None:
+        """
+        Return the compiled rules of the given ancestor .gitignore files,
+        ordered from the outermost to the innermost. Return None if no rule applies.
+        """
+        key = tuple(ignore_paths)
+        if key in self._compiled:
+            return self._compiled[key]
+        compiled = self._compile(key) if key else None
+        self._compiled[key] = compiled
+        return compiled
+
+    def _compile(self, ignore_paths: tuple[Path, ...]) -> IgnoreRules | None:
+        root = ignore_paths[0].parent
+        rules: list[tuple[str, bool]] = []
+        for ignore_path in ignore_paths:
+            base = ignore_path.parent.relative_to(root).as_posix()
+            prefix = "" if base == "." else re.escape(base + "/")
+            rules.extend(
+                (prefix + regex, ignores) for regex, ignores in self._load(ignore_path)
+            )
+        if not rules:
+            return None
+        # the last matching rule wins, so it has to be tried first
+        rules.reverse()
+        pattern = _combine([regex for regex, _ in rules])
+        return IgnoreRules(os.fspath(root), pattern, [ignores for _, ignores in rules])
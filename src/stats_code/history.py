@@ -0,0 +1,399 @@
+import os
+import subprocess
+from pathlib import Path
+from typing import IO, Iterator
+from .line_classifier import LineCounts
+from .result import Result
+from .language_config import LanguageConfig
+from .utils import counter_lines_in_bytes
+from .cache import BlobCache, BlobEntries
+from .counter import GIT_FILE_RE, dir_node
+from .scan_profile import ScanProfile
+from .git_index import (
+    MODE_DIR,
+    MODE_GITLINK,
+    MODE_TYPE_MASK,
+    object_id_size,
+    resolve_git_dir,
+)
+
+"""
+Line counts over the history of a git repo, read from its object database
+through one long-lived `git cat-file --batch` process, without checking out
+anything. Blobs are counted once per language and cached by object id, and
+the totals of every tree are cached, so unchanged files and directories cost
+nothing across commits.
+"""
+
+# object ids requested at once from `git cat-file --batch`: their requests
+# must fit in the pipe buffer, so that git never blocks writing its answers
+# while we are still writing requests
+READ_AHEAD = 512
+MODE_REGULAR = 0o100000
+
+# (commit id, committer date in ISO 8601, stats of the commit)
+CommitStats = tuple[str, str, Result]
+# language_id -> [code_lines, comment_lines, blank_lines] of a tree and its subtrees
+TreeTotals = dict[int, list[int]]
+# (path of a submodule relative to its repo, commit id)
+Gitlink = tuple[str, str]
+# (mode, name, object id)
+TreeEntry = tuple[int, str, str]
+
+
+class GitHistoryError(Exception):
+    """
+    Raised when the history of a repo cannot be read, e.g. an unknown revision.
+    """
+
+
+class GitObjectReader:
+    """
+    Read objects of a repo through one long-lived `git cat-file --batch` process.
+    """
+
+    def __init__(self, git_dir: Path) -> None:
+        self.git_dir = git_dir
+        self.hash_size = object_id_size(git_dir)
+        try:
+            self._process = subprocess.Popen(
+                ["git", f"--git-dir={git_dir}", "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        except OSError as e:
+            raise GitHistoryError(f"Cannot run git: {e}") from e
+        assert self._process.stdin is not None and self._process.stdout is not None
+        self._stdin: IO[bytes] = self._process.stdin
+        self._stdout: IO[bytes] = self._process.stdout
+
+    def read(self, object_id: str) -> tuple[str, bytes]:
+        """
+        Return (type, content) of an object, type is "missing" if not found.
+        """
+        self._stdin.write(f"{object_id}\n".encode("ascii"))
+        self._stdin.flush()
+        return self._read_answer()
+
+    def read_many(self, object_ids: list[str]) -> list[tuple[str, bytes]]:
+        """
+        Like `read` for many objects, with their requests pipelined.
+        """
+        found: list[tuple[str, bytes]] = []
+        for start in range(0, len(object_ids), READ_AHEAD):
+            chunk = object_ids[start : start + READ_AHEAD]
+            self._stdin.write("".join(f"{oid}\n" for oid in chunk).encode("ascii"))
+            self._stdin.flush()
+            for _ in chunk:
+                found.append(self._read_answer())
+        return found
+
+    def _read_answer(self) -> tuple[str, bytes]:
+        header = self._stdout.readline().split()
+        if not header:
+            raise GitHistoryError(f"git cat-file exited reading {self.git_dir}")
+        if len(header) != 3:
+            return "missing", b""  # "<object> missing" or "<object> ambiguous"
+        content = self._stdout.read(int(header[2]))
+        self._stdout.read(1)  # trailing newline
+        return header[1].decode("ascii"), content
+
+    def close(self) -> None:
+        self._stdin.close()
+        self._process.wait()
+
+
+def _parse_tree(content: bytes, hash_size: int) -> list[TreeEntry]:
+    # entries are "<octal mode> <name>\0<binary object id>"
+    entries: list[TreeEntry] = []
+    pos = 0
+    while pos < len(content):
+        space = content.index(b" ", pos)
+        nul = content.index(b"\0", space)
+        end = nul + 1 + hash_size
+        entries.append(
+            (
+                int(content[pos:space], 8),
+                os.fsdecode(content[space + 1 : nul]),
+                content[nul + 1 : end].hex(),
+            )
+        )
+        pos = end
+    return entries
+
+
+def list_commits(
+    git_dir: Path, rev: str, since: str | None, every: int | None
+) -> list[tuple[str, str]]:
+    """
+    List (commit id, committer date) of the first-parent history of `rev`,
+    oldest first: only `rev` itself unless `since` or `every` is given, and
+    one commit out of `every`, always including `rev`.
+    """
+    command = ["git", f"--git-dir={git_dir}", "log", "--first-parent"]
+    command.append("--format=%H %cI")
+    if since is not None:
+        command.append(f"--since={since}")
+    elif every is None:
+        command.append("--max-count=1")
+    command += [rev, "--"]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        raise GitHistoryError(f"Cannot run git: {e}") from e
+    if completed.returncode != 0:
+        raise GitHistoryError(completed.stderr.strip())
+    commits: list[tuple[str, str]] = []
+    for line in completed.stdout.splitlines()[:: every or 1]:
+        commit_id, _, date = line.partition(" ")
+        commits.append((commit_id, date))
+    commits.reverse()
+    return commits
+
+
+class RepoHistory:
+    """
+    Count the trees of the commits of one repo, whose work tree is `root`.
+    Files are classified as if checked out under `root`. Tree totals are cached
+    for the lifetime of the object, blob counts in `blobs`, which is shared with
+    submodules as blob ids are content addresses.
+    """
+
+    def __init__(
+        self,
+        git_dir: Path,
+        root: Path,
+        config: LanguageConfig,
+        blobs: BlobEntries,
+        profile: ScanProfile | None = None,
+    ) -> None:
+        self.git_dir = git_dir
+        self.root = root
+        self.config = config
+        self.blobs = blobs
+        self.profile = profile
+        self.reader = GitObjectReader(git_dir)
+        # (tree id, directory relative to the root) -> totals and gitlinks of
+        # the tree, the directory is part of the key as skip paths depend on it
+        self._trees: dict[tuple[str, str], tuple[TreeTotals, list[Gitlink]]] = {}
+
+    def commit_tree(self, commit_id: str) -> str | None:
+        """
+        Return the root tree id of a commit, None if it is not in the repo.
+        """
+        kind, content = self.reader.read(commit_id)
+        if kind != "commit" or not content.startswith(b"tree "):
+            return None
+        return content[5 : content.index(b"\n")].decode("ascii")
+
+    def tree_totals(
+        self, tree_id: str, rel_dir: str = ""
+    ) -> tuple[TreeTotals, list[Gitlink]]:
+        """
+        Return the line counts by language of a tree and its subtrees, and
+        the gitlinks found in them.
+        """
+        trees = self._trees
+        if (tree_id, rel_dir) in trees:
+            return trees[(tree_id, rel_dir)]
+        kind, content = self.reader.read(tree_id)
+        # iterative post-order: a tree is totaled once all its subtrees are,
+        # the subtrees of a tree are read at once
+        # (tree id, directory, entries, whether its subtrees were read)
+        stack: list[tuple[str, str, list[TreeEntry], bool]] = [
+            (tree_id, rel_dir, self._parse(kind, content), False)
+        ]
+        while stack:
+            cur_id, cur_dir, entries, expanded = stack.pop()
+            if expanded:
+                trees[(cur_id, cur_dir)] = self._total_tree(cur_dir, entries)
+                continue
+            stack.append((cur_id, cur_dir, entries, True))
+            sub_trees = [
+                (object_id, f"{cur_dir}/{name}" if cur_dir else name)
+                for mode, name, object_id in entries
+                if mode & MODE_TYPE_MASK == MODE_DIR
+            ]
+            sub_trees = [key for key in sub_trees if key not in trees]
+            answers = self.reader.read_many([object_id for object_id, _ in sub_trees])
+            for (object_id, sub_dir), (kind, content) in zip(sub_trees, answers):
+                stack.append((object_id, sub_dir, self._parse(kind, content), False))
+        return trees[(tree_id, rel_dir)]
+
+    def _parse(self, kind: str, content: bytes) -> list[TreeEntry]:
+        if self.profile is not None:
+            self.profile.count("trees_read")
+        if kind != "tree":
+            return []  # missing from a partial clone
+        return _parse_tree(content, self.reader.hash_size)
+
+    def _total_tree(
+        self, rel_dir: str, entries: list[TreeEntry]
+    ) -> tuple[TreeTotals, list[Gitlink]]:
+        totals: TreeTotals = {}
+        gitlinks: list[Gitlink] = []
+        # (blob cache key, language_id) of the files to add
+        files: list[tuple[str, int]] = []
+        missing: dict[str, tuple[str, int]] = {}  # blob cache key -> (id, language)
+        classify = self.config.classify
+        for mode, name, object_id in entries:
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            mode_type = mode & MODE_TYPE_MASK
+            if mode_type == MODE_DIR:
+                sub_totals, sub_gitlinks = self._trees[(object_id, rel_path)]
+                _merge(totals, sub_totals)
+                gitlinks.extend(sub_gitlinks)
+            elif mode_type == MODE_GITLINK:
+                gitlinks.append((rel_path, object_id))
+            elif mode_type == MODE_REGULAR and not GIT_FILE_RE.match(name):
+                # symlinks are skipped, their blob is the link target
+                language_id, reason = classify(self.root / rel_path)
+                if reason is not None:
+                    continue
+                key = f"{object_id}:{language_id}"
+                files.append((key, language_id))
+                if key not in self.blobs:
+                    missing[key] = (object_id, language_id)
+        if missing:
+            self._count_blobs(missing)
+        for key, language_id in files:
+            counts = self.blobs[key]
+            total = totals.get(language_id)
+            if total is None:
+                totals[language_id] = list(counts)
+            else:
+                total[0] += counts[0]
+                total[1] += counts[1]
+                total[2] += counts[2]
+        return totals, gitlinks
+
+    def _count_blobs(self, missing: dict[str, tuple[str, int]]) -> None:
+        languages = self.config.languages
+        answers = self.reader.read_many(
+            [object_id for object_id, _ in missing.values()]
+        )
+        for (key, (_, language_id)), (_, content) in zip(missing.items(), answers):
+            counts = counter_lines_in_bytes(content, languages[language_id]._syntax)
+            self.blobs[key] = (counts.code, counts.comment, counts.blank)
+            if self.profile is not None:
+                self.profile.count("blobs_counted")
+                self.profile.count("bytes_counted", len(content))
+
+    def close(self) -> None:
+        self.reader.close()
+
+
+def _merge(totals: TreeTotals, other: TreeTotals) -> None:
+    for language_id, counts in other.items():
+        total = totals.get(language_id)
+        if total is None:
+            totals[language_id] = list(counts)
+        else:
+            total[0] += counts[0]
+            total[1] += counts[1]
+            total[2] += counts[2]
+
+
+def _submodule_git_dir(
+    repo: RepoHistory, work_tree: Path, rel_path: str
+) -> Path | None:
+    # a checked out submodule, or one whose objects are kept by its super repo
+    git_dir = resolve_git_dir(work_tree)
+    if git_dir is None:
+        modules_dir = repo.git_dir / "modules" / rel_path
+        git_dir = modules_dir if modules_dir.is_dir() else None
+    return git_dir
+
+
+def count_history(
+    path: Path,
+    rev: str = "HEAD",
+    since: str | None = None,
+    every: int | None = None,
+    cache_dir: Path | None = None,
+    profile: ScanProfile | None = None,
+) -> Iterator[CommitStats]:
+    """
+    Count lines of the commits of the git repo at `path`, selected as in
+    `list_commits`, yielding the stats of each commit, oldest first, as soon
+    as it is counted. Submodules are counted at the commit recorded by their
+    super repo, when their objects are available locally.
+    If `cache_dir` is given, blob counts are kept there across runs.
+    Raises GitHistoryError if `path` is not a repo or `rev` is unknown.
+    """
+    git_dir = resolve_git_dir(path)
+    if git_dir is None:
+        raise GitHistoryError(f"{path} is not the work tree of a git repo")
+    if profile is not None:
+        with profile.stage("config"):
+            config = LanguageConfig.load(cache_dir)
+        with profile.stage("rev_list"):
+            commits = list_commits(git_dir, rev, since, every)
+    else:
+        config = LanguageConfig.load(cache_dir)
+        commits = list_commits(git_dir, rev, since, every)
+    cache = (
+        BlobCache(cache_dir, git_dir, config.fingerprint())
+        if cache_dir is not None
+        else None
+    )
+    blobs: BlobEntries = cache.entries if cache is not None else {}
+    repo = RepoHistory(git_dir, path, config, blobs, profile)
+    # path of a submodule relative to `path` -> its history, None if unavailable
+    submodules: dict[str, RepoHistory | None] = {}
+    try:
+        for commit_id, date in commits:
+            if profile is not None:
+                with profile.stage("commits"):
+                    result = _count_commit(repo, commit_id, submodules, config)
+                profile.count("commits")
+            else:
+                result = _count_commit(repo, commit_id, submodules, config)
+            yield commit_id, date, result
+    finally:
+        repo.close()
+        for submodule in submodules.values():
+            if submodule is not None:
+                submodule.close()
+        if cache is not None:
+            cache.save()
+        if profile is not None:
+            profile.finish()
+
+
+def _count_commit(
+    repo: RepoHistory,
+    commit_id: str,
+    submodules: dict[str, RepoHistory | None],
+    config: LanguageConfig,
+) -> Result:
+    result = Result(config.languages)
+    # relative directory path -> node_id, only the submodules have nodes
+    dir_nodes: dict[str, int] = {"": Result.ROOT}
+    # (history of a repo, its commit, its path relative to the root)
+    pending: list[tuple[RepoHistory, str, str]] = [(repo, commit_id, "")]
+    while pending:
+        cur_repo, cur_commit, rel_repo = pending.pop()
+        tree_id = cur_repo.commit_tree(cur_commit)
+        if tree_id is None:
+            print(f"Commit {cur_commit} not found in {cur_repo.git_dir}, skipped")
+            continue
+        totals, gitlinks = cur_repo.tree_totals(tree_id)
+        node_id = dir_node(result, dir_nodes, rel_repo)
+        result.mark_repo(node_id)
+        for language_id, (code, comment, blank) in totals.items():
+            result.add_counts(node_id, language_id, LineCounts(code, comment, blank))
+        for rel_path, sub_commit in gitlinks:
+            rel_sub = f"{rel_repo}/{rel_path}" if rel_repo else rel_path
+            if rel_sub not in submodules:
+                work_tree = repo.root / rel_sub
+                git_dir = _submodule_git_dir(cur_repo, work_tree, rel_path)
+                submodules[rel_sub] = (
+                    RepoHistory(git_dir, work_tree, config, repo.blobs, repo.profile)
+                    if git_dir is not None
+                    else None
+                )
+            submodule = submodules[rel_sub]
+            if submodule is not None:
+                pending.append((submodule, sub_commit, rel_sub))
+    return result
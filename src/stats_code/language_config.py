@@ -1,15 +1,29 @@
-import yaml
+import hashlib
+import json
+import os
+import pickle
+import re
+import stat
+import tempfile
+from collections import OrderedDict
 from pathlib import Path
-from importlib.resources import files
-from pathspec import PathSpec
-from .utils import check_path
+from .gitignore import WildMatchSpec, translate_pattern
+from .utils import _to_rel_posix
+from .line_classifier import CommentSyntax
 
 """
 Utils class for reading, validating the config provided by user.
 It will provide detailed error message when encountering invalid config.s
 """
 
-DEFAULT_CONFIG_PATH = Path(str(files("stats_code").joinpath("config/default.yml")))
+DEFAULT_CONFIG_PATH = Path(__file__).parent / "config" / "default.yml"
+CONFIG_CACHE_NAME = "language_config.pickle"
+# files classified by the lookup table, kept in its memo
+LOOKUP_MEMO_SIZE = 1 << 16
+
+# reasons a file is skipped by the config
+SKIP_PATHS = "skip_paths"
+SKIP_LANGUAGE = "skip_language"
 
 
 class Language:
@@ -19,6 +33,7 @@ class Language:
         names: list[str],
         type: str,
         color: str,
+        comments: dict | None = None,
     ) -> None:
         # validate inputs
         if not isinstance(language_name, str):
@@ -29,12 +44,43 @@ class Language:
             raise TypeError("color must be a string.")
         if not Language._validate_color_code(color):
             raise ValueError("color must be a valid hex color code.")
+        comments = comments if comments is not None else {}
+        if not isinstance(comments, dict):
+            raise TypeError("comments must be a mapping.")
+        line_comments = comments.get("line", [])
+        block_comments = comments.get("block", [])
+        strings = comments.get("strings", [])
+        if not isinstance(line_comments, list) or not all(
+            isinstance(c, str) and c for c in line_comments
+        ):
+            raise TypeError("comments.line must be a list of strings.")
+        if not isinstance(block_comments, list) or not all(
+            isinstance(b, list)
+            and len(b) == 2
+            and all(isinstance(c, str) and c for c in b)
+            for b in block_comments
+        ):
+            raise TypeError("comments.block must be a list of [start, end] strings.")
+        if not isinstance(strings, list) or not all(
+            isinstance(d, str) and d for d in strings
+        ):
+            raise TypeError("comments.strings must be a list of strings.")
         # construct attributes
         self.language_name: str = language_name
         self.names: list[str] = names
         self.color: str = color
         self.type: str = type
-        self._spec: PathSpec = PathSpec.from_lines("gitwildmatch", self.names)
+        self.line_comments: list[str] = line_comments
+        self.block_comments: list[tuple[str, str]] = [
+            (start, end) for start, end in block_comments
+        ]
+        self.strings: list[str] = strings
+        self._spec: WildMatchSpec = WildMatchSpec(self.names)
+        self._syntax: CommentSyntax | None = (
+            CommentSyntax(self.line_comments, self.block_comments, self.strings)
+            if self.line_comments or self.block_comments or self.strings
+            else None
+        )
 
     @staticmethod
     def _validate_color_code(color: str) -> bool:
@@ -72,7 +118,7 @@ class SkipConfig:
         self.paths: list[str] = paths
         self.language_types: list[str] = language_types
         self.languages: list[str] = languages
-        self._spec: PathSpec = PathSpec.from_lines("gitwildmatch", self.paths)
+        self._spec: WildMatchSpec = WildMatchSpec(self.paths)
 
 
 class LanguageConfig:
@@ -86,8 +132,15 @@ class LanguageConfig:
             self._exact_name_map: dict[str, int] = {}
             # extension -> language index
             self._extension_map: dict[str, int] = {}
-            # pattern -> language index
-            self._pattern_map: list[tuple[PathSpec, int]] = []
+            # complex patterns of languages without negated patterns, in one regex
+            # whose alternatives are in priority order, so the first match wins
+            alternatives: list[str] = []
+            # group index -> language index
+            self._group_languages: list[int] = []
+            # languages with negated patterns, which need last-match-wins semantics
+            self._pattern_map: list[tuple[WildMatchSpec, int]] = []
+            # whether all complex patterns only depend on the file name
+            self._basename_only: bool = True
             self._unknown_language_index: int = len(languages) - 1
 
             # construct the maps
@@ -121,14 +174,42 @@ class LanguageConfig:
                     # L3: complex patterns
                     else:
                         complex_patterns.append(pattern)
-                if complex_patterns:
-                    spec = PathSpec.from_lines("gitwildmatch", complex_patterns)
-                    self._pattern_map.append((spec, lang_index))
+                if not complex_patterns:
+                    continue
+                if any("/" in pattern for pattern in complex_patterns):
+                    self._basename_only = False
+                translated = [translate_pattern(p) for p in complex_patterns]
+                rules = [rule for rule in translated if rule is not None]
+                if all(include for _, include in rules):
+                    for regex, _ in rules:
+                        alternatives.append(regex)
+                        self._group_languages.append(lang_index)
+                else:
+                    self._pattern_map.append(
+                        (WildMatchSpec(complex_patterns), lang_index)
+                    )
+            self._pattern: re.Pattern[str] | None = (
+                re.compile(
+                    "|".join(
+                        f"(?P<g{i}>{regex})" for i, regex in enumerate(alternatives)
+                    )
+                )
+                if alternatives
+                else None
+            )
+            # bounded LRU of classified files, by name or path, see `lookup`
+            self._memo: OrderedDict[str, int] = OrderedDict()
 
-        def lookup(self, filepath: Path) -> int | None:
+        def __getstate__(self) -> dict[str, object]:
+            state = dict(self.__dict__)
+            state["_memo"] = OrderedDict()
+            return state
+
+        def lookup(self, filepath: Path, rel_path: str | None = None) -> int | None:
             """
             Return the index of the language in the languages list.
             If no match found, return None.
+            `rel_path` is the path relative to its anchor as posix, if known.
             """
             filename = filepath.name
 
@@ -136,21 +217,56 @@ class LanguageConfig:
             if filename in self._exact_name_map:
                 return self._exact_name_map[filename]
 
-            # L2: match in O(1) time
-            if filepath.suffix:
-                if filepath.suffix in self._extension_map:
-                    ext_lang_index = self._extension_map[filepath.suffix]
-                    # check if there is a higher priority complex pattern
-                    for pattern, pattern_lang in self._pattern_map:
-                        if pattern_lang < ext_lang_index:  # higher priority
-                            if check_path(pattern, filepath):
-                                return pattern_lang
-                    return ext_lang_index
-
-            # L3: match in O(n) time
-            for pattern, lang_index in self._pattern_map:
-                if check_path(pattern, filepath):
-                    return lang_index
+            # L2 and L3 results only depend on the file name, unless some
+            # complex patterns have a slash in them
+            if not self._basename_only:
+                key = rel_path if rel_path is not None else _to_rel_posix(filepath)
+            else:
+                key = filename
+            memo = self._memo
+            try:
+                lang_index = memo[key]
+                memo.move_to_end(key)
+                return lang_index
+            except KeyError:
+                pass
+            lang_index = self._lookup(filepath.suffix, key)
+            memo[key] = lang_index
+            if len(memo) > LOOKUP_MEMO_SIZE:
+                try:
+                    memo.popitem(last=False)
+                except KeyError:
+                    pass  # emptied by another thread
+            return lang_index
+
+        def clear_memo(self) -> None:
+            """
+            Forget the memoized lookups, e.g. to time cold lookups.
+            """
+            self._memo.clear()
+
+        def _lookup(self, suffix: str, path: str) -> int:
+            # L3: the highest priority complex pattern, in a single regex match
+            pattern_lang: int | None = None
+            if self._pattern is not None:
+                matched = self._pattern.match(path)
+                if matched is not None and matched.lastgroup is not None:
+                    pattern_lang = self._group_languages[int(matched.lastgroup[1:])]
+            for spec, lang_index in self._pattern_map:
+                if pattern_lang is not None and lang_index > pattern_lang:
+                    break
+                if spec.match_file(path):
+                    pattern_lang = lang_index
+                    break
+
+            # L2: match in O(1) time, unless a complex pattern has higher priority
+            ext_lang_index = self._extension_map.get(suffix) if suffix else None
+            if ext_lang_index is not None:
+                if pattern_lang is not None and pattern_lang < ext_lang_index:
+                    return pattern_lang
+                return ext_lang_index
+            if pattern_lang is not None:
+                return pattern_lang
 
             # Fallback to Unknown language
             return self._unknown_language_index
@@ -169,6 +285,12 @@ class LanguageConfig:
             raise e
         # construct a extension map for quick lookup
         self._lut = LanguageConfig.LookupTable(self.languages)
+        # languages skipped by name or by type
+        self._skipped_languages: list[bool] = [
+            lang.language_name in self.skip.languages
+            or lang.type in self.skip.language_types
+            for lang in self.languages
+        ]
 
     def validate(self) -> None:
         # validate skip.language_types match languages
@@ -187,12 +309,38 @@ class LanguageConfig:
         if not any(lang.language_name == "Unknown" for lang in self.languages):
             raise ValueError('Language "Unknown" is not defined.')
 
+    def fingerprint(self) -> str:
+        """
+        A stable digest of the config, used to invalidate caches built with it.
+        """
+        content = {
+            "skip": [self.skip.paths, self.skip.language_types, self.skip.languages],
+            "languages": [
+                [
+                    lang.language_name,
+                    lang.names,
+                    lang.type,
+                    lang.color,
+                    lang.line_comments,
+                    lang.block_comments,
+                    lang.strings,
+                ]
+                for lang in self.languages
+            ],
+        }
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
     @classmethod
-    def from_yaml(cls) -> "LanguageConfig":
+    def from_yaml(cls, content: bytes | None = None) -> "LanguageConfig":
+        # yaml is only needed when the config is not loaded from the cache
+        import yaml
+
         config_dict: dict
-        path = DEFAULT_CONFIG_PATH
-        with open(path, "r", encoding="utf-8") as f:
-            config_dict = yaml.safe_load(f)
+        if content is None:
+            content = DEFAULT_CONFIG_PATH.read_bytes()
+        config_dict = yaml.safe_load(content)
         # construct skip config
         try:
             skip_config = SkipConfig(
@@ -212,6 +360,7 @@ class LanguageConfig:
                     names=value["names"],
                     color=value["color"],
                     type=value["type"],
+                    comments=value.get("comments"),
                 )
             except TypeError as e:
                 print(f"Error in language config for '{key}': {e}")
@@ -222,18 +371,73 @@ class LanguageConfig:
             languages=languages_list,
         )
 
+    @classmethod
+    def load(cls, cache_dir: Path | None = None) -> "LanguageConfig":
+        """
+        Load the default config, from a pickled copy in `cache_dir` if it was
+        built from the same YAML content by the same stats-code sources.
+        Warm loads skip YAML parsing, validation and glob compilation.
+        As unpickling can run code, the copy is only loaded if it belongs to
+        the current user and nobody else can write to it, and it is rebuilt
+        if it can not be loaded.
+        """
+        content = DEFAULT_CONFIG_PATH.read_bytes()
+        if cache_dir is None:
+            return cls.from_yaml(content)
+        key = _config_cache_key(content)
+        cache_path = cache_dir / CONFIG_CACHE_NAME
+        try:
+            with open(cache_path, "rb") as f:
+                if _is_private(os.fstat(f.fileno())):
+                    cached_key, config = pickle.load(f)
+                    if cached_key == key and isinstance(config, LanguageConfig):
+                        return config
+                else:
+                    print(f"Ignoring config cache {cache_path}: not private to you")
+        except FileNotFoundError:
+            pass
+        except Exception as e:  # a corrupted or outdated pickle can raise anything
+            print(f"Error loading config cache {cache_path}: {e}")
+        config = cls.from_yaml(content)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=cache_dir, prefix=CONFIG_CACHE_NAME, suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump((key, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            print(f"Error saving config cache {cache_path}: {e}")
+        return config
+
+    def classify(self, filepath: Path) -> tuple[int, str | None]:
+        """
+        Detect the language of a file and whether the config skips it, at once.
+        Returns (language index, SKIP_PATHS, SKIP_LANGUAGE or None if not skipped).
+        """
+        rel_path = _to_rel_posix(filepath)
+        index = self._lut.lookup(filepath, rel_path)
+        if index is None:
+            raise AssertionError(f"No matching language found for file: {filepath}")
+        if self.skip._spec.match_file(rel_path):
+            return index, SKIP_PATHS
+        if self._skipped_languages[index]:
+            return index, SKIP_LANGUAGE
+        return index, None
+
     def check_skip_by_config(self, filepath: Path) -> bool:
         """
         Check if the given filepath should be skipped based on the skip config.
         """
-        if check_path(self.skip._spec, filepath):
-            return True
-        language = self.detect_language_by_path(filepath)
-        if self.languages[language].language_name in self.skip.languages:
-            return True
-        if self.languages[language].type in self.skip.language_types:
-            return True
-        return False
+        return self.classify(filepath)[1] is not None
+
+    def clear_lookup_memo(self) -> None:
+        self._lut.clear_memo()
 
     def detect_language_by_path(self, filepath: Path) -> int:
         """
@@ -250,3 +454,29 @@ class LanguageConfig:
         #     if check_path(language._spec, filepath):
         #         return index
         # raise AssertionError(f"No matching language found for file: {filepath}")
+
+
+def _is_private(st: os.stat_result) -> bool:
+    """
+    Check that a file belongs to the current user, and that only they can
+    write to it. Always true where files have no owner, e.g. on Windows.
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _config_cache_key(content: bytes) -> str:
+    # the sources of the pickled classes stand in for the package version, as
+    # they also change with local edits, and importlib.metadata is slow to import
+    digest = hashlib.sha256(content)
+    package_dir = Path(__file__).parent
+    for module in (
+        "language_config.py",
+        "gitignore.py",
+        "line_classifier.py",
+        "utils.py",
+    ):
+        st = (package_dir / module).stat()
+        digest.update(f"{module}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return digest.hexdigest()
@@ -0,0 +1,300 @@
+import re
+from typing import NamedTuple
+
+"""
+Single pass classification of lines into code, comment and blank lines.
+Lines which can not be part of a block comment or multi-line string are
+classified in bulk by C level counting and regex scanning. Only lines around
+block comment and multi-line string delimiters are scanned token by token.
+"""
+
+_NONSPACE_RE = re.compile(rb"[^ \t\f\v\r\n]")
+_BLANK_LINE_RE = re.compile(rb"[ \t\f\v\r]*\n")
+# line breaks followed by a blank line, starting with a literal so the regex
+# engine can skip ahead quickly, and only matching one byte per line
+_BLANK_NEXT_LINE_RE = re.compile(rb"\n(?=[ \t\f\v\r]*\n)")
+
+# (the line has code, the line has a comment, closer of an open block comment,
+#  closer of an open multi-line string) at a line start
+ClassifierState = tuple[bool, bool, bytes | None, bytes | None]
+INITIAL_STATE: ClassifierState = (False, False, None, None)
+
+_LINE_COMMENT = 0
+_BLOCK_COMMENT = 1
+_STRING = 2
+
+
+class LineCounts(NamedTuple):
+    code: int = 0
+    comment: int = 0
+    blank: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.code + self.comment + self.blank
+
+    def merge(self, other: "LineCounts") -> "LineCounts":
+        return LineCounts(
+            self.code + other.code,
+            self.comment + other.comment,
+            self.blank + other.blank,
+        )
+
+
+class CommentSyntax:
+    """
+    The compiled comment and string delimiters of a language.
+    """
+
+    def __init__(
+        self,
+        line_comments: list[str],
+        block_comments: list[tuple[str, str]],
+        strings: list[str],
+    ) -> None:
+        # opener -> (kind, closer)
+        self.tokens: dict[bytes, tuple[int, bytes]] = {}
+        for opener in strings:
+            self.tokens[opener.encode()] = (_STRING, opener.encode())
+        for opener, closer in block_comments:
+            self.tokens[opener.encode()] = (_BLOCK_COMMENT, closer.encode())
+        for opener in line_comments:
+            self.tokens[opener.encode()] = (_LINE_COMMENT, b"\n")
+        # longest first, so `"""` wins over `"` and `--[[` over `--`
+        openers = sorted(self.tokens, key=len, reverse=True)
+        multiline_openers = [
+            opener
+            for opener in openers
+            if self.tokens[opener][0] == _BLOCK_COMMENT or _is_multiline_string(opener)
+        ]
+        line_openers = [
+            opener for opener in openers if self.tokens[opener][0] == _LINE_COMMENT
+        ]
+        self.token_re: re.Pattern[bytes] = _compile_alternatives(openers)
+        # lines without these can be classified in bulk
+        self.multiline_openers: list[bytes] = multiline_openers
+        self.comment_line_re: re.Pattern[bytes] | None = None
+        self.comment_next_line_re: re.Pattern[bytes] | None = None
+        if line_openers:
+            alternatives = b"|".join(re.escape(opener) for opener in line_openers)
+            self.comment_line_re = re.compile(rb"[ \t\f\v\r]*(?:" + alternatives + b")")
+            self.comment_next_line_re = re.compile(
+                rb"\n(?=[ \t\f\v\r]*(?:" + alternatives + b"))"
+            )
+
+
+class LineClassifier:
+    """
+    Classify the lines of one file, fed as consecutive chunks of bytes.
+    A part of a file starting at a line start can be classified on its own
+    from the `state` of the classifier of the previous part.
+    """
+
+    def __init__(
+        self, syntax: CommentSyntax | None, state: ClassifierState = INITIAL_STATE
+    ) -> None:
+        self._syntax = syntax
+        self._code = 0
+        self._comment = 0
+        self._blank = 0
+        # state of the current line
+        self._line_code: bool
+        self._line_comment: bool
+        # closer of a block comment or string spanning lines
+        self._open_block: bytes | None
+        self._open_string: bytes | None
+        (
+            self._line_code,
+            self._line_comment,
+            self._open_block,
+            self._open_string,
+        ) = state
+        # the trailing partial line of the last chunk
+        self._rest = b""
+
+    @property
+    def state(self) -> ClassifierState:
+        """
+        State at the start of the next line, once only whole lines were fed.
+        """
+        return (
+            self._line_code,
+            self._line_comment,
+            self._open_block,
+            self._open_string,
+        )
+
+    def feed(self, chunk: bytes) -> None:
+        end = chunk.rfind(b"\n") + 1
+        if not end:
+            self._rest += chunk
+            return
+        if self._rest:
+            buf = self._rest + chunk[:end]
+        elif end == len(chunk):
+            buf = chunk
+        else:
+            buf = chunk[:end]
+        self._rest = chunk[end:]
+        self._process(buf)
+
+    def finish(self) -> LineCounts:
+        if self._rest:
+            self._process(self._rest + b"\n")
+            self._rest = b""
+        return LineCounts(self._code, self._comment, self._blank)
+
+    def _end_line(self) -> None:
+        if self._line_code:
+            self._code += 1
+        elif self._line_comment:
+            self._comment += 1
+        else:
+            self._blank += 1
+        self._line_code = False
+        self._line_comment = False
+
+    def _process(self, buf: bytes) -> None:
+        """
+        Process a buffer made of complete lines.
+        """
+        syntax = self._syntax
+        if syntax is None:
+            self._bulk(buf, 0, len(buf))
+            return
+        pos = 0
+        if self._open_block is not None or self._open_string is not None:
+            pos = self._scan(buf, 0, 0)
+        # next position of each multi-line opener, found with the fast
+        # substring search of bytes.find rather than a regex alternation
+        next_found = {
+            opener: buf.find(opener, pos) for opener in syntax.multiline_openers
+        }
+        while pos < len(buf):
+            for opener, found in next_found.items():
+                if found != -1 and found < pos:
+                    next_found[opener] = buf.find(opener, pos)
+            candidates = [found for found in next_found.values() if found != -1]
+            if not candidates:
+                self._bulk(buf, pos, len(buf))
+                return
+            found = min(candidates)
+            line_start = max(buf.rfind(b"\n", pos, found) + 1, pos)
+            self._bulk(buf, pos, line_start)
+            pos = self._scan(buf, line_start, found + 1)
+
+    def _bulk(self, buf: bytes, start: int, end: int) -> None:
+        """
+        Classify whole lines between `start` and `end`, which are all
+        either code, a line comment or blank.
+        """
+        if start >= end:
+            return
+        lines = buf.count(b"\n", start, end)
+        # the first line, then every line following a line break
+        blanks = 1 if _BLANK_LINE_RE.match(buf, start, end) else 0
+        blanks += len(_BLANK_NEXT_LINE_RE.findall(buf, start, end))
+        comments = 0
+        syntax = self._syntax
+        if syntax is not None and syntax.comment_line_re is not None:
+            assert syntax.comment_next_line_re is not None
+            comments = 1 if syntax.comment_line_re.match(buf, start, end) else 0
+            comments += len(syntax.comment_next_line_re.findall(buf, start, end))
+        self._code += lines - blanks - comments
+        self._comment += comments
+        self._blank += blanks
+
+    def _scan(self, buf: bytes, pos: int, min_end: int) -> int:
+        """
+        Scan token by token from a line start, until the end of a line after
+        `min_end` is reached with no block comment or string left open.
+        Return the position after that line.
+        """
+        assert self._syntax is not None
+        token_re = self._syntax.token_re
+        tokens = self._syntax.tokens
+        if self._open_block is not None:
+            pos = self._skip_block(buf, pos, self._open_block)
+        elif self._open_string is not None:
+            pos = self._skip_string(buf, pos, self._open_string)
+        while pos < len(buf):
+            line_end = buf.index(b"\n", pos)
+            matched = token_re.search(buf, pos, line_end)
+            if matched is None:
+                if _NONSPACE_RE.search(buf, pos, line_end):
+                    self._line_code = True
+                self._end_line()
+                pos = line_end + 1
+                if pos > min_end:
+                    return pos
+                continue
+            start = matched.start()
+            if _NONSPACE_RE.search(buf, pos, start):
+                self._line_code = True
+            kind, closer = tokens[matched.group()]
+            if kind == _LINE_COMMENT:
+                self._line_comment = True
+                pos = line_end
+            elif kind == _BLOCK_COMMENT:
+                self._line_comment = True
+                pos = self._skip_block(buf, matched.end(), closer)
+            else:
+                self._line_code = True
+                pos = self._skip_string(buf, matched.end(), closer)
+        return pos
+
+    def _skip_block(self, buf: bytes, start: int, closer: bytes) -> int:
+        """
+        Skip a block comment, return the position after its closer.
+        """
+        end = buf.find(closer, start)
+        self._open_block = closer if end == -1 else None
+        stop = len(buf) if end == -1 else end
+        self._skip_lines(buf, start, stop, comment=True)
+        return stop if end == -1 else end + len(closer)
+
+    def _skip_string(self, buf: bytes, start: int, closer: bytes) -> int:
+        """
+        Skip a string literal, return the position after its closer.
+        Only triple quoted and backtick strings may span lines.
+        """
+        end = buf.find(closer, start)
+        while end != -1 and _is_escaped(buf, end):
+            end = buf.find(closer, end + 1)
+        if not _is_multiline_string(closer):
+            line_end = buf.index(b"\n", start)
+            if end == -1 or end > line_end:
+                return line_end  # unterminated, ends with the line
+            return end + len(closer)
+        self._open_string = closer if end == -1 else None
+        stop = len(buf) if end == -1 else end
+        self._skip_lines(buf, start, stop, comment=False)
+        return stop if end == -1 else end + len(closer)
+
+    def _skip_lines(self, buf: bytes, start: int, stop: int, comment: bool) -> None:
+        # lines fully inside a block comment or a multi-line string
+        lines = buf.count(b"\n", start, stop)
+        if not lines:
+            return
+        self._end_line()
+        if comment:
+            self._comment += lines - 1
+            self._line_comment = True
+        else:
+            self._code += lines - 1
+            self._line_code = True
+
+
+def _compile_alternatives(openers: list[bytes]) -> re.Pattern[bytes]:
+    return re.compile(b"|".join(re.escape(opener) for opener in openers))
+
+
+def _is_multiline_string(delimiter: bytes) -> bool:
+    return len(delimiter) == 3 or delimiter == b"`"
+
+
+def _is_escaped(buf: bytes, pos: int) -> bool:
+    backslashes = 0
+    while pos > backslashes and buf[pos - backslashes - 1] == 0x5C:  # "\"
+        backslashes += 1
+    return backslashes % 2 == 1
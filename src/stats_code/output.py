@@ -0,0 +1,366 @@
+import csv
+import json
+from typing import TYPE_CHECKING, Any, Iterable, TextIO
+from .line_classifier import LineCounts
+from .language_config import Language
+from .result import CONFIDENCE, DuplicateGroup, Margins, Result, Stats
+from .scan_profile import ScanProfile
+
+if TYPE_CHECKING:
+    from .history import CommitStats
+
+"""
+Machine readable outputs of stats-code, of a scan or of the commits of a
+history scan. Unlike the table, they do not need rich.
+"""
+
+FORMATS = ("table", "json", "ndjson", "csv")
+
+
+def _counts_dict(counts: LineCounts) -> dict[str, int]:
+    return {
+        "code": counts.code,
+        "comment": counts.comment,
+        "blank": counts.blank,
+        "lines": counts.total,
+    }
+
+
+def _stats_dict(stats: Stats) -> dict[str, dict[str, int]]:
+    sorted_stats = sorted(stats.items(), key=lambda item: item[1].total, reverse=True)
+    return {
+        language.language_name: _counts_dict(counts)
+        for language, counts in sorted_stats
+    }
+
+
+def _total(stats: Stats) -> LineCounts:
+    total = LineCounts()
+    for counts in stats.values():
+        total = total.merge(counts)
+    return total
+
+
+def _node_dict(result: Result, node: int) -> dict[str, Any]:
+    # iterative, so deep trees do not hit the recursion limit
+    root: dict[str, Any] = {}
+    stack = [(node, root)]
+    while stack:
+        cur_node, cur_dict = stack.pop()
+        stats = result.stats(cur_node)
+        cur_dict["name"] = result.name(cur_node)
+        cur_dict["path"] = result.path(cur_node)
+        cur_dict["repo"] = result.is_repo(cur_node)
+        cur_dict["total"] = _counts_dict(_total(stats))
+        cur_dict["languages"] = _stats_dict(stats)
+        children: list[dict[str, Any]] = []
+        cur_dict["children"] = children
+        for child in result.children(cur_node):
+            child_dict: dict[str, Any] = {}
+            children.append(child_dict)
+            stack.append((child, child_dict))
+    return root
+
+
+def _duplicate_dict(group: DuplicateGroup) -> dict[str, Any]:
+    size, digest, language, counts, paths = group
+    return {
+        "size": size,
+        "digest": digest,
+        "language": language.language_name,
+        "lines": _counts_dict(counts),
+        "copies": len(paths),
+        "paths": paths,
+    }
+
+
+def _unique_dict(result: Result) -> dict[str, Any]:
+    stats = result.unique
+    return {"total": _counts_dict(_total(stats)), "languages": _stats_dict(stats)}
+
+
+def _estimate_dict(result: Result) -> dict[str, Any]:
+    assert result.sampled is not None
+    sampled, files = result.sampled
+    margins = sorted(
+        result.margins.items(), key=lambda item: item[1].lines, reverse=True
+    )
+    return {
+        "confidence": CONFIDENCE,
+        "files": files,
+        "sampled": sampled,
+        "margins": {
+            "total": (result.total_margins or Margins())._asdict(),
+            "languages": {
+                language.language_name: margin._asdict() for language, margin in margins
+            },
+        },
+    }
+
+
+def tree_dict(result: Result) -> dict[str, Any]:
+    """
+    The whole result tree, every directory and git repo, as nested dicts.
+    """
+    return _node_dict(result, Result.ROOT)
+
+
+def summary_dict(result: Result) -> dict[str, Any]:
+    """
+    Totals of the whole result and of every git repo, without the directory tree.
+    """
+    stats = result.total
+    return {
+        "total": _counts_dict(_total(stats)),
+        "languages": _stats_dict(stats),
+        "repos": {
+            path: {
+                "total": _counts_dict(_total(stats)),
+                "languages": _stats_dict(stats),
+            }
+            for path, stats in result.repos().items()
+        },
+    }
+
+
+def write_json(
+    result: Result,
+    out: TextIO,
+    profile: ScanProfile | None = None,
+    duplicates: int | None = None,
+) -> None:
+    """
+    Write the whole result tree, every directory and git repo, as one document,
+    with the profile of the scan under a "profile" key if given.
+    A deduplicated scan also has its "unique" lines, and up to `duplicates`
+    groups of identical files under a "duplicates" key if given, and an
+    estimated result the margins of its counts under an "estimate" key.
+    """
+    document = tree_dict(result)
+    if result.sampled is not None:
+        document["estimate"] = _estimate_dict(result)
+    if result.dedup:
+        document["unique"] = _unique_dict(result)
+        if duplicates is not None:
+            document["duplicates"] = [
+                _duplicate_dict(group) for group in result.duplicates()[:duplicates]
+            ]
+    if profile is not None:
+        document["profile"] = profile.to_dict()
+    json.dump(document, out, separators=(",", ":"))
+    out.write("\n")
+
+
+def write_csv(result: Result, out: TextIO, by_root: bool = False) -> None:
+    """
+    Write one row per language with its total line counts.
+    With `by_root`, for a multi-root scan, rows start with a "root" column and
+    the rows of every root come before the "total" rows of all of them.
+    A deduplicated scan has a last "unique_lines" column, only filled in the
+    rows of the total, and an estimated result has the margins of its counts
+    in last "*_margin" columns.
+    """
+    writer = csv.writer(out, lineterminator="\n")
+    header = ["language", "code", "comment", "blank", "lines"]
+    unique = result.unique if result.dedup else None
+    if unique is not None:
+        header.append("unique_lines")
+    margins = (
+        {language.language_name: margin for language, margin in result.margins.items()}
+        if result.sampled is not None
+        else None
+    )
+    if margins is not None:
+        header.extend(f"{field}_margin" for field in Margins._fields)
+    # (leading columns, stats, whether they are the total) of each group of rows
+    sections: list[tuple[list[str], Stats, bool]]
+    if not by_root:
+        writer.writerow(header)
+        sections = [([], result.total, True)]
+    else:
+        writer.writerow(["root", *header])
+        sections = [
+            ([root], stats, False) for root, stats in result.directories(1).items()
+        ]
+        sections.append((["total"], result.total, True))
+    unique_lines = (
+        {language.language_name: counts.total for language, counts in unique.items()}
+        if unique is not None
+        else None
+    )
+    for prefix, stats, is_total in sections:
+        for name, counts in _stats_dict(stats).items():
+            row: list[Any] = [
+                *prefix,
+                name,
+                counts["code"],
+                counts["comment"],
+                counts["blank"],
+                counts["lines"],
+            ]
+            if unique_lines is not None:
+                row.append(unique_lines.get(name, 0) if is_total else "")
+            if margins is not None:
+                row.extend(margins.get(name, Margins()))
+            writer.writerow(row)
+
+
+def _commit_dict(commit: "CommitStats") -> dict[str, Any]:
+    commit_id, date, result = commit
+    stats = result.total
+    return {
+        "commit": commit_id,
+        "date": date,
+        "total": _counts_dict(_total(stats)),
+        "languages": _stats_dict(stats),
+        "submodules": {
+            path: {
+                "total": _counts_dict(_total(stats)),
+                "languages": _stats_dict(stats),
+            }
+            for path, stats in result.repos().items()
+            if path
+        },
+    }
+
+
+def write_history_json(
+    commits: Iterable["CommitStats"], out: TextIO, profile: ScanProfile | None = None
+) -> None:
+    """
+    Write the time series of commits, oldest first, as one document with a
+    "commits" list, streamed as commits are counted.
+    """
+    out.write('{"commits":[')
+    for i, commit in enumerate(commits):
+        if i:
+            out.write(",")
+        json.dump(_commit_dict(commit), out, separators=(",", ":"))
+    out.write("]")
+    if profile is not None:
+        out.write(',"profile":')
+        json.dump(profile.to_dict(), out, separators=(",", ":"))
+    out.write("}\n")
+
+
+def write_history_csv(commits: Iterable["CommitStats"], out: TextIO) -> None:
+    """
+    Write one row per commit and language with its total line counts.
+    """
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(["commit", "date", "language", "code", "comment", "blank", "lines"])
+    for commit_id, date, result in commits:
+        for name, counts in _stats_dict(result.total).items():
+            writer.writerow(
+                [
+                    commit_id,
+                    date,
+                    name,
+                    counts["code"],
+                    counts["comment"],
+                    counts["blank"],
+                    counts["lines"],
+                ]
+            )
+        out.flush()
+
+
+class NdjsonWriter:
+    """
+    Write one JSON record per line: a "file" record for every counted file while
+    the scan runs, then a "repo" record for every git repo, a "profile" record
+    if the scan was profiled, and a "total" record.
+    File paths are relative to `root`, or absolute if it is None, for a
+    multi-root scan, which also gets a "root" record for every root.
+    A deduplicated scan gets a "unique" record before the total, and up to
+    `duplicates` "duplicate" records of groups of identical files if given.
+    An estimate gets an "estimate" record after every round of counted files,
+    and the margins of its final counts in the total record.
+    History scans write a "commit" record per commit instead.
+    """
+
+    def __init__(
+        self, out: TextIO, root: str | None, duplicates: int | None = None
+    ) -> None:
+        self._out = out
+        self._duplicates = duplicates
+        self._by_root = root is None
+        self._prefix_len = len(root.rstrip("/")) + 1 if root is not None else 0
+
+    def _write(self, record: dict[str, Any]) -> None:
+        self._out.write(json.dumps(record, separators=(",", ":")))
+        self._out.write("\n")
+
+    def file(self, file_path: str, language: Language, counts: LineCounts) -> None:
+        record: dict[str, Any] = {
+            "type": "file",
+            "path": file_path[self._prefix_len :],
+            "language": language.language_name,
+        }
+        record.update(_counts_dict(counts))
+        self._write(record)
+
+    def finish(self, result: Result, profile: ScanProfile | None = None) -> None:
+        for path, stats in result.repos().items():
+            self._write(
+                {
+                    "type": "repo",
+                    "path": path,
+                    "total": _counts_dict(_total(stats)),
+                    "languages": _stats_dict(stats),
+                }
+            )
+        if self._by_root:
+            for path, stats in result.directories(1).items():
+                self._write(
+                    {
+                        "type": "root",
+                        "path": path,
+                        "total": _counts_dict(_total(stats)),
+                        "languages": _stats_dict(stats),
+                    }
+                )
+        if result.dedup:
+            if self._duplicates is not None:
+                for group in result.duplicates()[: self._duplicates]:
+                    self._write({"type": "duplicate", **_duplicate_dict(group)})
+            self._write({"type": "unique", **_unique_dict(result)})
+        if profile is not None:
+            self._write({"type": "profile", **profile.to_dict()})
+        stats = result.total
+        record: dict[str, Any] = {
+            "type": "total",
+            "total": _counts_dict(_total(stats)),
+            "languages": _stats_dict(stats),
+        }
+        if result.sampled is not None:
+            record["estimate"] = _estimate_dict(result)
+        self._write(record)
+        self._out.flush()
+
+    def estimate(self, result: Result) -> None:
+        """
+        Write an "estimate" record of the line counts estimated so far.
+        """
+        stats = result.total
+        self._write(
+            {
+                "type": "estimate",
+                "total": _counts_dict(_total(stats)),
+                "languages": _stats_dict(stats),
+                "estimate": _estimate_dict(result),
+            }
+        )
+        self._out.flush()
+
+    def commit(self, commit: "CommitStats") -> None:
+        """
+        Write a "commit" record of a history scan, as soon as it is counted.
+        """
+        self._write({"type": "commit", **_commit_dict(commit)})
+        self._out.flush()
+
+    def finish_history(self, profile: ScanProfile | None = None) -> None:
+        if profile is not None:
+            self._write({"type": "profile", **profile.to_dict()})
+        self._out.flush()
@@ -1,22 +1,54 @@
-from rich.console import Console
-from rich.table import Table
-from rich.progress_bar import ProgressBar
-from .result import Result
+from typing import TYPE_CHECKING, Iterable
+from .result import CONFIDENCE, Margins, Result
+from .line_classifier import LineCounts
+
+if TYPE_CHECKING:
+    from .history import CommitStats
+
+# languages named in each row of the history table
+HISTORY_TOP_LANGUAGES = 3
 
 
 def render_stats(result: Result) -> None:
+    # rich is slow to import, and only needed by the table output
+    from rich.console import Console
+    from rich.table import Table
+    from rich.progress_bar import ProgressBar
+
     console = Console()
-    table = Table(title="Code Statistics")
+    title = "Code Statistics"
+    if result.sampled is not None:
+        title += (
+            f" (estimated from {result.sampled[0]} of {result.sampled[1]} files, "
+            f"{CONFIDENCE:.0%} margins)"
+        )
+    table = Table(title=title)
 
     stats = result.total
 
     table.add_column("Language", justify="left", style="cyan", no_wrap=True)
-    table.add_column("Lines of Code", justify="right", style="magenta")
+    table.add_column("Code", justify="right", style="magenta")
+    table.add_column("Comment", justify="right", style="blue")
+    table.add_column("Blank", justify="right", style="dim")
+    table.add_column("Lines", justify="right", style="magenta")
+    # lines counting every distinct content once, for deduplicated scans
+    unique = result.unique if result.dedup else None
+    if unique is not None:
+        table.add_column("Unique", justify="right", style="magenta")
+    # margins of the lines, for estimated results
+    margins = result.margins if result.sampled is not None else None
+    if margins is not None:
+        table.add_column("±", justify="right", style="red")
     table.add_column("Distribution", justify="left", style="yellow")
     table.add_column("Percentage", justify="right", style="green")
-    sorted_stats = dict(sorted(stats.items(), key=lambda item: item[1], reverse=True))
+    sorted_stats = dict(
+        sorted(stats.items(), key=lambda item: item[1].total, reverse=True)
+    )
 
-    total_lines = sum(sorted_stats.values())
+    total = LineCounts()
+    for counts in sorted_stats.values():
+        total = total.merge(counts)
+    total_lines = total.total
     total_bar = ProgressBar(
         total=100.0,
         completed=100.0,
@@ -24,13 +56,29 @@ def render_stats(result: Result) -> None:
         complete_style="white",
         finished_style="white",
     )
-    table.add_row("Total", str(total_lines), total_bar, None, style="bold white")
-    for language, line_count in sorted_stats.items():
+    # cells of the optional columns
+    extra_cells = []
+    if unique is not None:
+        extra_cells.append(str(sum(counts.total for counts in unique.values())))
+    if margins is not None:
+        extra_cells.append(str((result.total_margins or Margins()).lines))
+    table.add_row(
+        "Total",
+        str(total.code),
+        str(total.comment),
+        str(total.blank),
+        str(total_lines),
+        *extra_cells,
+        total_bar,
+        None,
+        style="bold white",
+    )
+    for language, counts in sorted_stats.items():
         color = (
             language.color if language and getattr(language, "color", None) else "white"
         )
         assert color is not None
-        percentage = (line_count / total_lines * 100) if total_lines > 0 else 0
+        percentage = (counts.total / total_lines * 100) if total_lines > 0 else 0
         bar = ProgressBar(
             total=100.0,
             completed=percentage,
@@ -38,11 +86,131 @@ def render_stats(result: Result) -> None:
             complete_style=color,
             finished_style=color,
         )
+        extra_cells = []
+        if unique is not None:
+            extra_cells.append(str(unique.get(language, LineCounts()).total))
+        if margins is not None:
+            extra_cells.append(str(margins.get(language, Margins()).lines))
         table.add_row(
             f"[{color}]{language.language_name}[/{color}]",
-            str(line_count),
+            str(counts.code),
+            str(counts.comment),
+            str(counts.blank),
+            str(counts.total),
+            *extra_cells,
             bar,
             f"{percentage:.2f}%",
         )
 
     console.print(table)
+
+
+def render_roots(result: Result) -> None:
+    """
+    Render the totals of every root of a multi-root scan, which are the
+    children of the result root.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    table = Table(title="Roots")
+
+    table.add_column("Root", justify="left", style="cyan", no_wrap=True)
+    table.add_column("Code", justify="right", style="magenta")
+    table.add_column("Comment", justify="right", style="blue")
+    table.add_column("Blank", justify="right", style="dim")
+    table.add_column("Lines", justify="right", style="magenta")
+    table.add_column("Top language", justify="left", style="yellow")
+    for root, stats in result.directories(1).items():
+        sorted_stats = sorted(
+            stats.items(), key=lambda item: item[1].total, reverse=True
+        )
+        total = LineCounts()
+        for _, counts in sorted_stats:
+            total = total.merge(counts)
+        top = ""
+        if sorted_stats and total.total > 0:
+            language, counts = sorted_stats[0]
+            top = (
+                f"[{language.color}]{language.language_name}[/{language.color}] "
+                f"{counts.total / total.total * 100:.1f}%"
+            )
+        table.add_row(
+            root,
+            str(total.code),
+            str(total.comment),
+            str(total.blank),
+            str(total.total),
+            top,
+        )
+
+    console.print(table)
+
+
+def render_duplicates(result: Result, limit: int) -> None:
+    """
+    Render up to `limit` groups of identical files of a deduplicated scan, the
+    ones with the most duplicated lines first.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    table = Table(title="Duplicate Files")
+
+    table.add_column("Language", justify="left", style="cyan", no_wrap=True)
+    table.add_column("Copies", justify="right", style="magenta")
+    table.add_column("Lines", justify="right", style="magenta")
+    table.add_column("Duplicated", justify="right", style="red")
+    table.add_column("Files", justify="left", style="dim")
+    for _, _, language, counts, paths in result.duplicates()[:limit]:
+        table.add_row(
+            f"[{language.color}]{language.language_name}[/{language.color}]",
+            str(len(paths)),
+            str(counts.total),
+            str((len(paths) - 1) * counts.total),
+            "\n".join(paths),
+        )
+
+    console.print(table)
+
+
+def render_history(commits: Iterable["CommitStats"]) -> None:
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    table = Table(title="Code Statistics History")
+
+    table.add_column("Commit", justify="left", style="cyan", no_wrap=True)
+    table.add_column("Date", justify="left", style="dim", no_wrap=True)
+    table.add_column("Code", justify="right", style="magenta")
+    table.add_column("Comment", justify="right", style="blue")
+    table.add_column("Blank", justify="right", style="dim")
+    table.add_column("Lines", justify="right", style="magenta")
+    table.add_column("Top languages", justify="left", style="yellow")
+    for commit_id, date, result in commits:
+        sorted_stats = sorted(
+            result.total.items(), key=lambda item: item[1].total, reverse=True
+        )
+        total = LineCounts()
+        for _, counts in sorted_stats:
+            total = total.merge(counts)
+        top = [
+            f"[{language.color}]{language.language_name}[/{language.color}] "
+            f"{counts.total / total.total * 100:.1f}%"
+            for language, counts in sorted_stats[:HISTORY_TOP_LANGUAGES]
+            if total.total > 0
+        ]
+        table.add_row(
+            commit_id[:10],
+            date,
+            str(total.code),
+            str(total.comment),
+            str(total.blank),
+            str(total.total),
+            ", ".join(top),
+        )
+
+    console.print(table)
@@ -1,54 +1,299 @@
+import threading
+from array import array
+from typing import Iterator, NamedTuple
 from .language_config import Language
+from .line_classifier import LineCounts
 
-Stats = dict[Language, int]
+"""
+The result tree of stats-code, stored in flat arrays owned by each Result.
+Every walked directory is a node, and git repos are directory nodes flagged
+as repos. Line counts are kept per node and language as a node x language
+matrix, with one column of (code, comment, blank) triples per language seen.
+"""
 
+Stats = dict[Language, LineCounts]
+# (file path, size, content digest, language_id, code_lines, comment_lines,
+#  blank_lines) of a file counted by a scan with content deduplication
+ContentRecord = tuple[str, int, str, int, int, int, int]
+# (size, content digest, language, line counts of one copy, paths of the copies)
+DuplicateGroup = tuple[int, str, Language, LineCounts, list[str]]
 
-class RepoStatsNode:
+
+# z score of the two sided 95% confidence intervals of estimated results
+CONFIDENCE = 0.95
+CONFIDENCE_Z = 1.959964
+# seconds spent counting the sample of an estimate, unless a file budget is given
+DEFAULT_TIME_BUDGET = 10.0
+
+
+class Margins(NamedTuple):
     """
-    A repo node in the stats-code result tree.
+    Half widths of the confidence intervals of estimated line counts.
     """
 
-    _nodes_map: dict[int, "RepoStatsNode"] = {}
-    _nodes_count: int = 0  # for generating unique IDs
+    code: int = 0
+    comment: int = 0
+    blank: int = 0
+    lines: int = 0
 
-    def __init__(self) -> None:
-        self.submodules: dict[str, RepoStatsNode] = {}
-        self.stats: Stats = {}
-        self.id: int = RepoStatsNode._nodes_count
-        RepoStatsNode._nodes_map[self.id] = self
-        RepoStatsNode._nodes_count += 1
 
-    @classmethod
-    def get_node_by_id(cls, node_id: int) -> "RepoStatsNode":
-        return cls._nodes_map[node_id]
+# items per node in a column of the count matrix: code, comment, blank
+_FIELDS = 3
+# items per (node, language_id) in totals packed in an `array("q")`:
+# node, language_id, code_lines, comment_lines, blank_lines
+PACKED_TOTALS_STRIDE = 5
 
 
 class Result:
     """
-    A class to represent the result of the result of stats-code.
-    It contains the overall statistics for the repository.
+    A class to represent the result of stats-code.
+    Nodes are referred to by their index, the root node (the scanned directory)
+    is `Result.ROOT`, and a parent node always has a lower index than its
+    children. Nodes may be added and counted from different threads.
     """
 
-    def __init__(self) -> None:
-        self._tree_root: RepoStatsNode = RepoStatsNode()
+    ROOT = 0
+
+    def __init__(self, languages: list[Language], dedup: bool = False) -> None:
+        self._languages = languages
+        # whether files were grouped by content, see `add_contents`
+        self.dedup = dedup
+        # (size, digest, language_id) -> (line counts of one copy, paths)
+        self._contents: dict[tuple[int, str, int], tuple[LineCounts, list[str]]] = {}
+        # for results estimated from a sample of files, see `estimate`:
+        # (files counted, files found), and the margins of every language and
+        # of the total
+        self.sampled: tuple[int, int] | None = None
+        self.margins: dict[Language, Margins] = {}
+        self.total_margins: Margins | None = None
+        self._parents: "array[int]" = array("q", [-1])
+        self._names: list[str] = [""]
+        self._repos = bytearray(1)
+        # language_id -> counts of every node, `_FIELDS` items per node
+        self._columns: "dict[int, array[int]]" = {}
+        # counts of every node including its descendants, None when stale
+        self._rollup: "dict[int, array[int]] | None" = None
+        # children of every node, None when stale
+        self._children: list[list[int]] | None = None
+        self._lock = threading.Lock()
+
+    def add_node(self, parent: int, name: str, is_repo: bool = False) -> int:
+        """
+        Add a directory node under `parent` and return its index.
+        """
+        with self._lock:
+            node = len(self._names)
+            self._parents.append(parent)
+            self._names.append(name)
+            self._repos.append(is_repo)
+            for column in self._columns.values():
+                column.extend((0, 0, 0))
+            # a new node has no counts, so the rollup and children stay valid
+            if self._rollup is not None:
+                for column in self._rollup.values():
+                    column.extend((0, 0, 0))
+            if self._children is not None:
+                self._children.append([])
+                self._children[parent].append(node)
+            return node
+
+    def __len__(self) -> int:
+        """
+        Number of nodes, the root included.
+        """
+        return len(self._names)
+
+    def mark_repo(self, node: int, is_repo: bool = True) -> None:
+        self._repos[node] = is_repo
+
+    def add_counts(self, node: int, language_id: int, counts: LineCounts) -> None:
+        """
+        Add (or with negative counts, remove) counts of a node. A memoized
+        rollup is updated along the ancestors of the node instead of dropped,
+        so small updates of a large tree stay cheap.
+        """
+        with self._lock:
+            self._add(node, language_id, counts.code, counts.comment, counts.blank)
+            if self._rollup is None:
+                return
+            column = self._rollup.get(language_id)
+            if column is None:
+                column = array("q", [0]) * (len(self._names) * _FIELDS)
+                self._rollup[language_id] = column
+            while node >= Result.ROOT:
+                offset = node * _FIELDS
+                column[offset] += counts.code
+                column[offset + 1] += counts.comment
+                column[offset + 2] += counts.blank
+                node = self._parents[node]
+
+    def add_packed(self, packed: "array[int]") -> None:
+        """
+        Add totals packed as (node, language_id, code, comment, blank) items.
+        """
+        with self._lock:
+            for i in range(0, len(packed), PACKED_TOTALS_STRIDE):
+                self._add(*packed[i : i + PACKED_TOTALS_STRIDE])
+            self._rollup = None
+
+    def add_contents(self, contents: list[ContentRecord]) -> None:
+        """
+        Group counted files by content, i.e. by (size, digest) and language.
+        """
+        with self._lock:
+            for path, size, digest, language_id, *counts in contents:
+                group = self._contents.get((size, digest, language_id))
+                if group is None:
+                    self._contents[(size, digest, language_id)] = (
+                        LineCounts(*counts),
+                        [path],
+                    )
+                else:
+                    group[1].append(path)
 
     @property
-    def total(self) -> Stats:
-        return self.reduce_from_node(self._tree_root)
+    def unique(self) -> Stats:
+        """
+        Stats of the whole result counting every distinct content once, unlike
+        `total` which counts every copy. Empty unless the scan was deduplicated.
+        """
+        stats: Stats = {}
+        with self._lock:
+            for (_, _, language_id), (counts, _) in self._contents.items():
+                if counts.total:
+                    language = self._languages[language_id]
+                    stats[language] = stats.get(language, LineCounts()).merge(counts)
+        return stats
+
+    def duplicates(self) -> list[DuplicateGroup]:
+        """
+        Groups of non empty files with the same content, the ones with the most
+        duplicated lines first.
+        """
+        with self._lock:
+            groups: list[DuplicateGroup] = [
+                (size, digest, self._languages[language_id], counts, sorted(paths))
+                for (size, digest, language_id), (
+                    counts,
+                    paths,
+                ) in self._contents.items()
+                if size and len(paths) > 1
+            ]
+        groups.sort(key=lambda group: (-(len(group[4]) - 1) * group[3].total, group[4]))
+        return groups
+
+    def _add(
+        self, node: int, language_id: int, code: int, comment: int, blank: int
+    ) -> None:
+        column = self._columns.get(language_id)
+        if column is None:
+            column = array("q", [0]) * (len(self._names) * _FIELDS)
+            self._columns[language_id] = column
+        offset = node * _FIELDS
+        column[offset] += code
+        column[offset + 1] += comment
+        column[offset + 2] += blank
+
+    def _rolled_up(self) -> "dict[int, array[int]]":
+        """
+        Sum the counts of every node into its ancestors, in a single bottom-up
+        pass over the nodes, memoized until the tree changes.
+        """
+        with self._lock:
+            if self._rollup is not None:
+                return self._rollup
+            parents = self._parents
+            rollup: "dict[int, array[int]]" = {}
+            for language_id, column in self._columns.items():
+                rolled = array("q", column)
+                # children come after their parent, so walk the nodes backwards
+                for node in range(len(parents) - 1, 0, -1):
+                    offset = node * _FIELDS
+                    code = rolled[offset]
+                    comment = rolled[offset + 1]
+                    blank = rolled[offset + 2]
+                    if code or comment or blank:
+                        parent_offset = parents[node] * _FIELDS
+                        rolled[parent_offset] += code
+                        rolled[parent_offset + 1] += comment
+                        rolled[parent_offset + 2] += blank
+                rollup[language_id] = rolled
+            self._rollup = rollup
+            return rollup
+
+    def _stats_from(self, columns: "dict[int, array[int]]", node: int) -> Stats:
+        stats: Stats = {}
+        offset = node * _FIELDS
+        for language_id, column in columns.items():
+            counts = LineCounts(*column[offset : offset + _FIELDS])
+            if counts.total:
+                stats[self._languages[language_id]] = counts
+        return stats
 
     @property
-    def root_repo(self) -> RepoStatsNode:
-        return self._tree_root
-
-    @staticmethod
-    def get_submodules(node: RepoStatsNode) -> dict[str, RepoStatsNode]:
-        return node.submodules
-
-    @staticmethod
-    def reduce_from_node(node: RepoStatsNode) -> Stats:
-        aggregated_stats: Stats = dict(node.stats)  # start with current node's stats
-        for submodule in node.submodules.values():
-            submodule_stats = Result.reduce_from_node(submodule)
-            for lang, count in submodule_stats.items():
-                aggregated_stats[lang] = aggregated_stats.get(lang, 0) + count
-        return aggregated_stats
+    def total(self) -> Stats:
+        return self.stats(Result.ROOT)
+
+    def stats(self, node: int, recursive: bool = True) -> Stats:
+        """
+        Stats of a node, including all its descendants unless `recursive` is False.
+        """
+        if recursive:
+            return self._stats_from(self._rolled_up(), node)
+        return self._stats_from(self._columns, node)
+
+    def path(self, node: int) -> str:
+        """
+        Path of a node relative to the scanned directory, "" for the root.
+        """
+        names: list[str] = []
+        while node > Result.ROOT:
+            names.append(self._names[node])
+            node = self._parents[node]
+        return "/".join(reversed(names))
+
+    def name(self, node: int) -> str:
+        return self._names[node]
+
+    def nodes(self) -> Iterator[tuple[int, int, str]]:
+        """
+        Yield (node, parent, name) of every node but the root, parents first.
+        """
+        for node in range(1, len(self._names)):
+            yield node, self._parents[node], self._names[node]
+
+    def children(self, node: int) -> list[int]:
+        with self._lock:
+            if self._children is None:
+                self._children = [[] for _ in self._names]
+                for child in range(1, len(self._names)):
+                    self._children[self._parents[child]].append(child)
+            return self._children[node]
+
+    def is_repo(self, node: int) -> bool:
+        return bool(self._repos[node])
+
+    def repos(self) -> dict[str, Stats]:
+        """
+        Stats of every git repo by path, including their submodules.
+        """
+        rollup = self._rolled_up()
+        return {
+            self.path(node): self._stats_from(rollup, node)
+            for node in range(len(self._names))
+            if self._repos[node]
+        }
+
+    def directories(self, depth: int = 1) -> dict[str, Stats]:
+        """
+        Stats of every directory `depth` levels below the root by path,
+        including all their descendants.
+        """
+        rollup = self._rolled_up()
+        depths = array("q", [0]) * len(self._names)
+        found: dict[str, Stats] = {}
+        for node in range(1, len(self._names)):
+            depths[node] = depths[self._parents[node]] + 1
+            if depths[node] == depth:
+                found[self.path(node)] = self._stats_from(rollup, node)
+        return found
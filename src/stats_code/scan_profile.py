@@ -0,0 +1,173 @@
+import heapq
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, TypeVar
+
+"""
+Lightweight instrumentation of a scan: wall and CPU time of each stage, files
+and bytes seen, skipped by reason and counted, per-worker busy and idle time
+and the slowest files. Nothing is recorded unless a ScanProfile is passed in.
+"""
+
+SLOWEST_FILES = 10
+
+# reasons a file is not counted, besides the skip reasons of `LanguageConfig.classify`,
+# or how it is counted
+SKIP_GIT_FILE = "git_file"  # .gitignore, .gitmodules...
+SKIP_GITIGNORE = "gitignore"
+SKIP_TOO_LARGE = "too_large"  # bigger than --max-file-size, with the skip policy
+SKIP_DUPLICATE = "duplicate"  # reached again through a hardlink, symlink or mount
+BINARY = "binary"  # not empty, but no line counted: binary or unreadable
+CACHED = "cached"
+COUNTED = "counted"
+SPLIT = "split"  # counted in line aligned ranges, in parallel
+SAME_CONTENT = "same_content"  # counted, but its content was already classified
+
+# (worker id, busy wall seconds, busy cpu seconds, {counter: value},
+#  slowest files as [(seconds, path)])
+WorkerProfile = tuple[str, float, float, dict[str, int], list[tuple[float, str]]]
+
+T = TypeVar("T")
+
+
+class ScanProfile:
+    """
+    Stage timings and counters of one scan, filled in by `counter()`. It may be
+    updated from several threads, e.g. by the walk running in the task handler
+    thread of a pool while results are merged in the calling thread.
+    """
+
+    def __init__(self) -> None:
+        # stage -> [wall seconds, cpu seconds]
+        self.stages: dict[str, list[float]] = {}
+        self.counters: dict[str, int] = {}
+        # worker id -> [busy wall seconds, busy cpu seconds, batches]
+        self.workers: dict[str, list[float]] = {}
+        self.pool_wall: float = 0.0
+        self._slowest: list[tuple[float, str]] = []
+        self._started = (time.perf_counter(), time.process_time())
+        # guards the updates
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._count(name, value)
+
+    def add_stage(self, stage: str, wall: float, cpu: float) -> None:
+        with self._lock:
+            self._add_stage(stage, wall, cpu)
+
+    def _count(self, name: str, value: int) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _add_stage(self, stage: str, wall: float, cpu: float) -> None:
+        timing = self.stages.setdefault(stage, [0.0, 0.0])
+        timing[0] += wall
+        timing[1] += cpu
+
+    def stage(self, stage: str) -> "_StageTimer":
+        """
+        Time a stage of the calling thread: `with profile.stage("walk"): ...`
+        """
+        return _StageTimer(self, stage)
+
+    def iter_stage(self, stage: str, items: Iterator[T]) -> Iterator[T]:
+        """
+        Time the production of every item of an iterator as a stage, e.g. a
+        lazy walk consumed by a pool.
+        """
+        while True:
+            with self.stage(stage):
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
+    def add_worker(self, worker: WorkerProfile) -> None:
+        worker_id, wall, cpu, counters, slowest = worker
+        with self._lock:
+            busy = self.workers.setdefault(worker_id, [0.0, 0.0, 0])
+            busy[0] += wall
+            busy[1] += cpu
+            busy[2] += 1
+            self._add_stage("count", wall, cpu)
+            for name, value in counters.items():
+                self._count(name, value)
+            for item in slowest:
+                if len(self._slowest) < SLOWEST_FILES:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+
+    def finish(self) -> None:
+        wall = time.perf_counter() - self._started[0]
+        cpu = time.process_time() - self._started[1]
+        with self._lock:
+            self.stages["total"] = [wall, cpu]
+
+    @property
+    def slowest(self) -> list[tuple[float, str]]:
+        return sorted(self._slowest, reverse=True)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stages": {
+                stage: {"wall": wall, "cpu": cpu}
+                for stage, (wall, cpu) in self.stages.items()
+            },
+            "counters": dict(sorted(self.counters.items())),
+            "workers": {
+                worker_id: {
+                    "busy": busy,
+                    "cpu": cpu,
+                    # workers outliving the counting (e.g. serial) have no idle time
+                    "idle": max(self.pool_wall - busy, 0.0),
+                    "batches": int(batches),
+                }
+                for worker_id, (busy, cpu, batches) in self.workers.items()
+            },
+            "slowest_files": [
+                {"path": path, "seconds": seconds} for seconds, path in self.slowest
+            ],
+        }
+
+    def report(self) -> str:
+        data = self.to_dict()
+        lines = ["Profile:", f"  {'stage':<20} {'wall (s)':>10} {'cpu (s)':>10}"]
+        for stage, timing in data["stages"].items():
+            lines.append(
+                f"  {stage:<20} {timing['wall']:>10.3f} {timing['cpu']:>10.3f}"
+            )
+        lines.append("  counters:")
+        for name, value in data["counters"].items():
+            lines.append(f"    {name:<24} {value:>14}")
+        lines.append(f"  workers ({self.pool_wall:.3f}s of counting):")
+        for worker_id, worker in data["workers"].items():
+            lines.append(
+                f"    {worker_id:<24} busy {worker['busy']:>8.3f}s"
+                f"  idle {worker['idle']:>8.3f}s  batches {worker['batches']}"
+            )
+        lines.append("  slowest files:")
+        for item in data["slowest_files"]:
+            lines.append(f"    {item['seconds']:>8.3f}s  {item['path']}")
+        return "\n".join(lines)
+
+
+class _StageTimer:
+    def __init__(self, profile: ScanProfile, stage: str) -> None:
+        self._profile = profile
+        self._stage = stage
+        self._wall = 0.0
+        self._cpu = 0.0
+
+    def __enter__(self) -> None:
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._profile.add_stage(
+            self._stage,
+            time.perf_counter() - self._wall,
+            time.thread_time() - self._cpu,
+        )
@@ -0,0 +1,256 @@
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, Sequence
+from .counter import DEFAULT_MAX_FILE_SIZE, ScanCancelled, counter
+from .counter_worker import init_worker
+from .executor import default_jobs
+from .language_config import Language, LanguageConfig
+from .line_classifier import LineCounts
+from .result import Result
+
+"""
+Library API for programs counting many trees, e.g. a service counting a repo
+per request: a `Scanner` loads the language config and starts its workers
+once, and every scan reuses them, so a scan of a small repo only costs its I/O.
+"""
+
+# a root to scan, as a path or a string
+PathLike = str | os.PathLike[str]
+# (file path, language, line counts) of a counted file
+ScannedFile = tuple[str, Language, LineCounts]
+# files counted ahead of a slow consumer of `Scanner.iter_files` or
+# `Scanner.aiter_files`
+RECORD_QUEUE_SIZE = 4096
+# how often a scan blocked on a full record queue checks for cancellation
+_POLL_SECONDS = 0.1
+
+
+class Scanner:
+    """
+    A long-lived scanner: the config is loaded once, and a pool of `jobs`
+    worker processes (or threads, with `executor="thread"`) is started once and
+    shared by every scan, small scans being counted in the calling thread.
+    Scans may run concurrently from several threads, each with its own timeout
+    and cancellation. The other arguments are the options of `counter()` for
+    every scan. Close the scanner, or use it as a context manager, to stop its
+    workers; the worker state of `counter_worker` is shared by the process, so
+    a process should not run other scans with different options meanwhile.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | None = None,
+        jobs: int | None = None,
+        executor: str = "process",
+        no_git_flag: bool = False,
+        git_index_flag: bool = False,
+        untracked_flag: bool = False,
+        dedup: bool = False,
+        max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+        large_file_policy: str = "full",
+        archives_flag: bool = False,
+        config: LanguageConfig | None = None,
+    ) -> None:
+        if executor not in ("process", "thread"):
+            raise ValueError(f"a scanner runs a process or thread pool: {executor}")
+        self.config: LanguageConfig = config or LanguageConfig.load(cache_dir)
+        self.cache_dir = cache_dir
+        self.executor = executor
+        self.jobs: int = jobs or default_jobs(executor)
+        self.no_git_flag = no_git_flag
+        self.git_index_flag = git_index_flag
+        self.untracked_flag = untracked_flag
+        self.dedup = dedup
+        self.max_file_size = max_file_size
+        self.large_file_policy = large_file_policy
+        self.archives_flag = archives_flag
+        self._closed = threading.Event()
+        self._running = 0
+        self._idle = threading.Condition()
+
+        # file records are always sent back, so any scan can stream them
+        from multiprocessing.pool import Pool, ThreadPool
+
+        initargs = (self.config, True, False, dedup)
+        init_worker(*initargs)
+        self._pool: Pool
+        if executor == "thread":
+            self._pool = ThreadPool(processes=self.jobs)
+        else:
+            self._pool = Pool(
+                processes=self.jobs, initializer=init_worker, initargs=initargs
+            )
+
+    def __enter__(self) -> "Scanner":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Cancel the running scans, wait for them to stop, and stop the workers.
+        """
+        self._closed.set()
+        with self._idle:
+            self._idle.wait_for(lambda: self._running == 0)
+        self._pool.terminate()
+        self._pool.join()
+
+    def scan(
+        self,
+        path: PathLike | Sequence[PathLike],
+        timeout: float | None = None,
+        cancel: threading.Event | None = None,
+        on_file: Callable[[str, Language, LineCounts], None] | None = None,
+    ) -> Result:
+        """
+        Count lines of all files under `path`, or under every root of a sequence
+        of paths (a string is a single path), like `counter()`, calling
+        `on_file` for every counted file.
+        Raises `TimeoutError` after `timeout` seconds, and `ScanCancelled` once
+        `cancel` is set or the scanner is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        closed = self._closed
+
+        def cancelled() -> bool:
+            return closed.is_set() or (cancel is not None and cancel.is_set())
+
+        roots: Path | list[Path]
+        if isinstance(path, (str, os.PathLike)):
+            roots = Path(os.path.abspath(path))
+        else:
+            roots = [Path(os.path.abspath(root)) for root in path]
+        with self._idle:
+            if closed.is_set():
+                raise ScanCancelled("scanner closed")
+            self._running += 1
+        try:
+            return counter(
+                roots,
+                self.no_git_flag,
+                self.cache_dir,
+                git_index_flag=self.git_index_flag,
+                untracked_flag=self.untracked_flag,
+                jobs=self.jobs,
+                executor=self.executor,
+                on_file=on_file,
+                config=self.config,
+                dedup=self.dedup,
+                max_file_size=self.max_file_size,
+                large_file_policy=self.large_file_policy,
+                archives_flag=self.archives_flag,
+                pool=self._pool,
+                cancelled=cancelled,
+                deadline=deadline,
+            )
+        finally:
+            with self._idle:
+                self._running -= 1
+                self._idle.notify_all()
+
+    def _scan_in_thread(
+        self,
+        path: PathLike | Sequence[PathLike],
+        timeout: float | None,
+        cancel: threading.Event,
+        emit: Callable[[ScannedFile | BaseException | None], None],
+    ) -> None:
+        """
+        Run a scan in a daemon thread, emitting its files, then None once it
+        completes, or the exception it raised.
+        """
+
+        def run() -> None:
+            try:
+                self.scan(path, timeout, cancel, lambda *record: emit(record))
+            except BaseException as e:
+                emit(e)
+            else:
+                emit(None)
+
+        threading.Thread(target=run, name="stats-code-scan", daemon=True).start()
+
+    def iter_files(
+        self, path: PathLike | Sequence[PathLike], timeout: float | None = None
+    ) -> Iterator[ScannedFile]:
+        """
+        Yield (path, language, line counts) of every counted file under `path`
+        as soon as its batch is counted, while the scan runs in another thread.
+        Leaving the loop early cancels the scan.
+        """
+        records: queue.Queue[ScannedFile | BaseException | None] = queue.Queue(
+            RECORD_QUEUE_SIZE
+        )
+        stop = threading.Event()
+
+        def emit(item: ScannedFile | BaseException | None) -> None:
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=_POLL_SECONDS)
+                    return
+                except queue.Full:
+                    continue
+
+        self._scan_in_thread(path, timeout, stop, emit)
+        try:
+            while True:
+                item = records.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    async def aiter_files(
+        self, path: PathLike | Sequence[PathLike], timeout: float | None = None
+    ) -> AsyncIterator[ScannedFile]:
+        """
+        Like `iter_files`, for asyncio: the scan runs in another thread, and
+        cancelling the consuming task, or leaving the loop early, cancels it.
+        """
+        # asyncio is slow to import, and only needed by async callers
+        import asyncio
+        from concurrent.futures import CancelledError
+
+        loop = asyncio.get_running_loop()
+        records: asyncio.Queue[ScannedFile | BaseException | None] = asyncio.Queue(
+            RECORD_QUEUE_SIZE
+        )
+        stop = threading.Event()
+
+        def emit(item: ScannedFile | BaseException | None) -> None:
+            if stop.is_set():
+                return
+            try:
+                put = asyncio.run_coroutine_threadsafe(records.put(item), loop)
+            except RuntimeError:  # the loop is closed, nobody is listening
+                stop.set()
+                return
+            while not stop.is_set():
+                try:
+                    put.result(_POLL_SECONDS)
+                    return
+                except TimeoutError:
+                    continue
+                except CancelledError:  # the loop is shutting down
+                    stop.set()
+            put.cancel()
+
+        self._scan_in_thread(path, timeout, stop, emit)
+        try:
+            while True:
+                item = await records.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
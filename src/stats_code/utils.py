@@ -1,45 +1,260 @@
-import chardet
-from pathspec import PathSpec
+import codecs
+import hashlib
+import os
 from pathlib import Path
+from typing import IO, TYPE_CHECKING, Callable
+from .gitignore import WildMatchSpec
+from .line_classifier import CommentSyntax, LineClassifier, LineCounts
 
+if TYPE_CHECKING:
+    from mmap import mmap
 
-def check_path(path_spec: PathSpec, filepath: Path) -> bool:
-    """
-    Check if the given filepath should be skipped based on the skip config.
-    """
+CHUNK_SIZE = 1 << 20
+# large files are hashed, and counted in parallel, in line aligned ranges of
+# about this size
+RANGE_BYTES = 32 << 20
+# like git, a file with a NUL byte in its first 8000 bytes is binary
+BINARY_SNIFF_SIZE = 8000
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+
+def _to_rel_posix(filepath: Path) -> str:
+    if os.sep == "/":
+        path = os.fspath(filepath)
+        if path.startswith("/"):
+            return path.lstrip("/")  # fast path for absolute posix paths
     try:
         rel = filepath.relative_to(filepath.anchor)
     except Exception:
         # If cannot be made relative, use absolute but as posix
         rel = filepath
-    rel_posix = rel.as_posix()
-    return path_spec.match_file(rel_posix)
+    return rel.as_posix()
+
+
+def check_path(path_spec: WildMatchSpec, filepath: Path) -> bool:
+    """
+    Check if the given filepath should be skipped based on the skip config.
+    """
+    return path_spec.match_file(_to_rel_posix(filepath))
+
+
+def check_dir(path_spec: WildMatchSpec, dirpath: Path) -> bool:
+    """
+    Check if the given directory, and so everything under it, is matched.
+    """
+    return path_spec.match_file(_to_rel_posix(dirpath) + "/")
+
 
+def _detect_bom(chunk: bytes) -> str | None:
+    # utf-32 first, as the utf-32-le BOM starts with the utf-16-le one
+    for bom, encoding in _BOMS:
+        if chunk.startswith(bom):
+            return encoding
+    return None
 
-def _detect_file_encoding(file_path: Path) -> str | None:
+
+def _feed_decoded(
+    read: Callable[[int], bytes],
+    chunk: bytes,
+    encoding: str,
+    classifier: LineClassifier,
+) -> None:
+    """
+    Feed a file in a wide encoding, which can not be classified as bytes, as utf-8.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    while chunk:
+        classifier.feed(decoder.decode(chunk).encode("utf-8"))
+        chunk = read(CHUNK_SIZE)
+
+
+def counter_lines_in_file(
+    file_path: Path, syntax: CommentSyntax | None = None
+) -> LineCounts:
+    """
+    Count code, comment and blank lines of a file, read in fixed size binary chunks.
+    Binary files (with a NUL byte near the start) count as no lines,
+    utf-16/32 files are recognized by their BOM and decoded.
+    """
     try:
-        with open(file_path, "rb") as f:
-            raw_data = f.read(1024)
-        result = chardet.detect(raw_data)
-        confidence = result["confidence"]
-        if confidence and confidence > 0.7:
-            return result["encoding"]
-        return None
-    except Exception as e:
-        print(f"Error detecting encoding for {file_path}: {e}")
-        return None
+        with open(file_path, "rb", buffering=0) as f:
+            return counter_lines_in_stream(f, syntax)
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return LineCounts()
+
+
+def counter_lines_in_stream(
+    f: IO[bytes],
+    syntax: CommentSyntax | None = None,
+    hasher: "RangeHasher | None" = None,
+) -> LineCounts:
+    """
+    Count the lines of a binary stream read in fixed size chunks, e.g. a member
+    of an archive, the same way as `counter_lines_in_file`.
+    With `hasher`, the whole stream is hashed as well, even if it is binary.
+    """
 
+    def read(size: int) -> bytes:
+        chunk = f.read(size)
+        if hasher is not None:
+            hasher.update(chunk)
+        return chunk
+
+    classifier = LineClassifier(syntax)
+    chunk = read(CHUNK_SIZE)
+    if not chunk:
+        return LineCounts()
+    encoding = _detect_bom(chunk)
+    if encoding is not None:
+        _feed_decoded(read, chunk, encoding, classifier)
+        return classifier.finish()
+    if chunk.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1:
+        while hasher is not None and read(CHUNK_SIZE):
+            pass  # hashed to the end all the same
+        return LineCounts()  # binary file
+    # files using old Mac line breaks
+    translate_cr = b"\n" not in chunk and b"\r" in chunk
+    while chunk:
+        if translate_cr:
+            chunk = chunk.replace(b"\r", b"\n")
+        classifier.feed(chunk)
+        chunk = read(CHUNK_SIZE)
+    return classifier.finish()
+
+
+def counter_lines_in_bytes(
+    data: bytes, syntax: CommentSyntax | None = None
+) -> LineCounts:
+    """
+    Count code, comment and blank lines of a file content held in memory,
+    e.g. a git blob, the same way as `counter_lines_in_file`.
+    """
+    if not data:
+        return LineCounts()
+    classifier = LineClassifier(syntax)
+    encoding = _detect_bom(data)
+    if encoding is not None:
+        classifier.feed(data.decode(encoding, errors="ignore").encode("utf-8"))
+        return classifier.finish()
+    if data.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1:
+        return LineCounts()  # binary file
+    # like files, old Mac line breaks are detected from the first chunk
+    if data.find(b"\n", 0, CHUNK_SIZE) == -1 and data.find(b"\r", 0, CHUNK_SIZE) != -1:
+        data = data.replace(b"\r", b"\n")
+    classifier.feed(data)
+    return classifier.finish()
+
+
+def split_ranges(
+    data: "bytes | mmap", size: int = RANGE_BYTES
+) -> list[tuple[int, int]]:
+    """
+    Split a file content into (start, end) ranges of about `size` bytes, each
+    but the last one ending with a line break, so ranges are made of whole lines.
+    """
+    ranges: list[tuple[int, int]] = []
+    start = 0
+    length = len(data)
+    while length - start > size:
+        end = data.find(b"\n", start + size - 1) + 1
+        if not end or end >= length:
+            break
+        ranges.append((start, end))
+        start = end
+    ranges.append((start, length))
+    return ranges
+
+
+def file_ranges(
+    file_path: Path, size: int = RANGE_BYTES
+) -> list[tuple[int, int]] | None:
+    """
+    Split a large file into line aligned ranges which can be counted on their
+    own, finding line breaks through a memory map rather than reading the file.
+    Returns None for files which must be counted as a whole: binary files,
+    wide encodings and old Mac line breaks.
+    """
+    # only imported when there are large files
+    import mmap
 
-def counter_lines_in_file(file_path: Path) -> int:
-    encoding = _detect_file_encoding(file_path)
-    if not encoding:
-        return 0
-    lines = []
     try:
-        with open(file_path, "r", encoding=encoding, errors="ignore") as f:
-            lines = f.readlines()
-    except Exception as e:
+        with (
+            open(file_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            head = mm[:CHUNK_SIZE]
+            if (
+                _detect_bom(head) is not None
+                or head.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1
+                or (b"\n" not in head and b"\r" in head)
+            ):
+                return None
+            return split_ranges(mm, size)
+    except (OSError, ValueError) as e:
         print(f"Error reading {file_path}: {e}")
-    # lines_count = sum(1 for line in lines if line.strip())
-    lines_count = len(lines)
-    return lines_count
+        return None
+
+
+def combine_digests(digests: list[bytes]) -> str:
+    """
+    The content digest of a file hashed in ranges, from the digests of its
+    ranges, which is the digest of its content if it has a single range.
+    """
+    if len(digests) == 1:
+        return digests[0].hex()
+    return hashlib.blake2b(b"".join(digests), digest_size=16).hexdigest()
+
+
+class RangeHasher:
+    """
+    Hash a content fed in chunks, e.g. streamed from an archive, in the same
+    line aligned ranges as `split_ranges`, so that its digest is the same as
+    `content_digest` of the whole content.
+    """
+
+    def __init__(self, size: int = RANGE_BYTES) -> None:
+        self._size = size
+        self._digests: list[bytes] = []
+        self._range = hashlib.blake2b(digest_size=16)
+        self._range_len = 0
+
+    def update(self, chunk: bytes) -> None:
+        while chunk:
+            # a range ends at the first line break from its `size`th byte on
+            pos = max(self._size - 1 - self._range_len, 0)
+            end = chunk.find(b"\n", pos) + 1 if pos < len(chunk) else 0
+            if not end:
+                self._range.update(chunk)
+                self._range_len += len(chunk)
+                return
+            self._range.update(chunk[:end])
+            self._digests.append(self._range.digest())
+            self._range = hashlib.blake2b(digest_size=16)
+            self._range_len = 0
+            chunk = chunk[end:]
+
+    def hexdigest(self) -> str:
+        digests = self._digests
+        if self._range_len or not digests:
+            digests = digests + [self._range.digest()]
+        return combine_digests(digests)
+
+
+def content_digest(data: bytes) -> str:
+    """
+    The digest of a file content held in memory, the same as if the file was
+    hashed in ranges.
+    """
+    view = memoryview(data)
+    return combine_digests(
+        [
+            hashlib.blake2b(view[start:end], digest_size=16).digest()
+            for start, end in split_ranges(data)
+        ]
+    )
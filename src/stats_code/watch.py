@@ -0,0 +1,587 @@
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import select
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+from .line_classifier import LineCounts
+from .result import Result
+from .language_config import LanguageConfig
+from .gitignore import GitIgnoreMatcher
+from .cache import CacheEntry
+from .counter_worker import FileStat
+from .counter import (
+    check_dir_skipped,
+    classify_files,
+    collect_files,
+    counter,
+    dir_node,
+)
+from .output import summary_dict, tree_dict
+from .utils import counter_lines_in_file
+
+"""
+Watch mode: one full scan, then a `Result` kept up to date file by file from
+change notifications (inotify, or polling the tree where it is not available),
+and served as JSON over a Unix socket.
+"""
+
+# apply changes once no event came for this long, so that a burst of writes
+# (a checkout, a build) is applied at once
+DEBOUNCE_SECONDS = 0.2
+# but apply them at least this often during a long burst
+MAX_DELAY_SECONDS = 2.0
+DEFAULT_POLL_SECONDS = 2.0
+# documents served on the socket, by the request line sent by clients
+QUERIES = ("total", "tree")
+
+# see inotify(7)
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_ONLYDIR
+)
+# wd, mask, cookie, length of the name which follows
+_EVENT = struct.Struct("iIII")
+
+# (watched directory or None if events were lost, entry name or "", mask)
+InotifyEvent = tuple[Path | None, str, int]
+
+
+def default_socket_path(root: Path) -> Path:
+    root_key = hashlib.sha1(str(root).encode("utf-8")).hexdigest()[:16]
+    return Path(tempfile.gettempdir()) / f"stats-code-{root_key}.sock"
+
+
+class Inotify:
+    """
+    A minimal inotify binding over ctypes, watching directories.
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._libc = libc
+        self.fd: int = fd
+        # watch descriptor -> watched directory
+        self._paths: dict[int, Path] = {}
+        # set when a directory could not be watched, e.g. over the watch limit
+        self.error: OSError | None = None
+
+    def add_watch(self, dir_path: Path) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if self.error is None and err != errno.ENOENT:  # not deleted meanwhile
+                self.error = OSError(err, os.strerror(err), str(dir_path))
+            return
+        self._paths[wd] = dir_path
+
+    def remove_watches(self, dir_path: Path) -> None:
+        """
+        Stop watching a directory and its descendants, e.g. when moved away.
+        """
+        for wd, path in list(self._paths.items()):
+            if path == dir_path or path.is_relative_to(dir_path):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._paths[wd]
+
+    def read(self, timeout: float | None) -> list[InotifyEvent]:
+        """
+        Wait up to `timeout` seconds (forever if None) for events.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events: list[InotifyEvent] = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = os.fsdecode(data[pos : pos + length].rstrip(b"\0"))
+            pos += length
+            if mask & _IN_Q_OVERFLOW:
+                events.append((None, "", mask))
+            elif mask & _IN_IGNORED:
+                self._paths.pop(wd, None)
+            elif wd in self._paths:
+                events.append((self._paths[wd], name, mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _Changes:
+    """
+    Changes of a watched tree found by walking and counting without its lock,
+    then applied at once while holding it.
+    """
+
+    def __init__(self) -> None:
+        # (path, directory relative to the root, stat, language_id, line counts)
+        # of every file counted again
+        self.counted: list[tuple[str, str, FileStat, int, LineCounts]] = []
+        # paths of the files gone, ignored or skipped
+        self.removed: list[str] = []
+        # (directory relative to the root, whether it is a git repo)
+        self.repos: list[tuple[str, bool]] = []
+
+
+class WatchedTree:
+    """
+    A `Result` of a directory kept up to date file by file. Every counted file
+    is kept with its node and cache entry, so a changed file only moves its
+    own counts, along the rollups of its directory and repo ancestors.
+    `on_dir` is called with every directory walked, e.g. to watch it.
+    Updates and reads of the result are serialized by `lock`, which updates
+    only hold to apply changes, not to walk and count files. Updates are made
+    by a single thread, which may read its own state without the lock.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        no_git_flag: bool,
+        config: LanguageConfig,
+        on_dir: Callable[[Path], None] | None = None,
+    ) -> None:
+        self.root = root
+        self.no_git_flag = no_git_flag
+        self.config = config
+        self.result = Result(config.languages)
+        # bumped by every scan or update which changed the result
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.on_dir = on_dir
+        # directory relative to the root -> node_id, of every directory seen
+        self._dir_nodes: dict[str, int] = {"": Result.ROOT}
+        # path -> (node_id, cache entry) of every counted file
+        self._files: dict[str, tuple[int, CacheEntry]] = {}
+        # kept across updates, .gitignore files are forgotten when they change
+        self._matcher = GitIgnoreMatcher()
+
+    def scan(
+        self,
+        cache_dir: Path | None = None,
+        jobs: int | None = None,
+        executor: str | None = None,
+    ) -> None:
+        """
+        The initial full scan, counted in parallel by `counter`.
+        """
+        entries: dict[str, CacheEntry] = {}
+        result = counter(
+            self.root,
+            self.no_git_flag,
+            cache_dir,
+            jobs=jobs,
+            executor=executor,
+            config=self.config,
+            file_entries=entries,
+        )
+        with self.lock:
+            self.result = result
+            self._dir_nodes = {result.path(node): node for node in range(len(result))}
+            for key, entry in entries.items():
+                rel_dir = self._rel(Path(key).parent)
+                self._files[key] = (self._dir_nodes[rel_dir], entry)
+            self.generation += 1
+        if self.on_dir is not None:
+            for rel_dir in self._dir_nodes:
+                self.on_dir(self.root / rel_dir)
+
+    def apply(self, rescan_dirs: set[Path], changed_files: set[Path]) -> None:
+        """
+        Walk the given directories again, and update the given files, unless
+        they are under one of these directories. The lock is only taken once
+        everything is counted, so queries are not kept waiting by a recount.
+        """
+        covered: list[Path] = []
+        # ancestors first, their descendants are covered by their walk
+        for dir_path in sorted(rescan_dirs, key=lambda path: len(path.parts)):
+            if not any(dir_path.is_relative_to(done) for done in covered):
+                covered.append(dir_path)
+        changes = _Changes()
+        for dir_path in covered:
+            self.rescan(dir_path, changes)
+        for file_path in changed_files:
+            if not any(file_path.is_relative_to(done) for done in covered):
+                self.update_file(file_path, changes)
+        if not (changes.counted or changes.removed or changes.repos):
+            return
+        with self.lock:
+            for key in changes.removed:
+                self._remove(key)
+            for key, rel_dir, file_stat, language_id, counts in changes.counted:
+                node_id = self._node(rel_dir)
+                self._remove(key)
+                self.result.add_counts(node_id, language_id, counts)
+                self._files[key] = (node_id, (*file_stat, language_id, *counts, ""))
+            for rel_dir, is_repo in changes.repos:
+                self.result.mark_repo(self._node(rel_dir), is_repo)
+            # once for all the changes, repo changes included
+            self.generation += 1
+
+    def rescan(self, dir_path: Path, changes: _Changes) -> None:
+        """
+        Walk a subtree again, after a directory was created, moved or deleted,
+        or a .gitignore edited: count new and changed files, drop the files
+        which are gone or now ignored, and leave the others alone.
+        """
+        rel_dir = self._rel(dir_path)
+        ignore, in_repo = self._ignores(dir_path.parent) if rel_dir else ([], False)
+        kept: set[str] = set()
+        if dir_path.is_dir() and (
+            rel_dir == ""
+            or not check_dir_skipped(
+                dir_path, self.config, self._matcher.rules_for(ignore)
+            )
+        ):
+            # walked into a scratch tree, whose nodes are mapped to ours by path
+            scratch = Result(self.config.languages)
+            walk = collect_files(
+                scratch,
+                dir_path,
+                Result.ROOT,
+                self.no_git_flag,
+                ignore,
+                self.config,
+                in_repo,
+            )
+            for files, node_id, stats, language_ids, _ in classify_files(
+                walk, self.config
+            ):
+                live_dir = _join(rel_dir, scratch.path(node_id))
+                for file_path, file_stat, language_id in zip(
+                    files, stats, language_ids
+                ):
+                    key = str(file_path)
+                    kept.add(key)
+                    self._count(changes, key, live_dir, file_stat, language_id)
+            for node_id in range(len(scratch)):
+                sub_dir = _join(rel_dir, scratch.path(node_id))
+                changes.repos.append((sub_dir, scratch.is_repo(node_id)))
+                if self.on_dir is not None:
+                    self.on_dir(self.root / sub_dir)
+        prefix = os.path.join(dir_path, "")
+        for key in self._files:
+            if key.startswith(prefix) and key not in kept:
+                changes.removed.append(key)
+
+    def update_file(self, file_path: Path, changes: _Changes) -> None:
+        """
+        Count a created or modified file again, or drop a deleted one.
+        """
+        key = str(file_path)
+        rel_dir = self._rel(file_path.parent)
+        node_id = self._dir_nodes.get(rel_dir)
+        try:
+            st = file_path.stat()
+        except OSError:
+            st = None
+        if node_id is None or st is None or not stat.S_ISREG(st.st_mode):
+            changes.removed.append(key)
+            return
+        file_stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+        ignore, _ = self._ignores(file_path.parent)
+        task = (
+            [file_path],
+            node_id,
+            self._matcher.rules_for(ignore),
+            [file_stat],
+            [st.st_dev],
+        )
+        for _, _, _, language_ids, _ in classify_files([task], self.config):
+            self._count(changes, key, rel_dir, file_stat, language_ids[0])
+            return
+        changes.removed.append(key)  # ignored or skipped
+
+    def forget_ignore_file(self, ignore_path: Path) -> None:
+        self._matcher.forget(ignore_path)
+
+    def _count(
+        self,
+        changes: _Changes,
+        key: str,
+        rel_dir: str,
+        file_stat: FileStat,
+        language_id: int,
+    ) -> None:
+        """
+        Count a file again into `changes`, unless it is unchanged.
+        """
+        old = self._files.get(key)
+        if old is not None and old[0] == self._dir_nodes.get(rel_dir):
+            entry = old[1]
+            if entry[:3] == file_stat and entry[3] == language_id:
+                return  # unchanged
+        counts = counter_lines_in_file(
+            Path(key), self.config.languages[language_id]._syntax
+        )
+        changes.counted.append((key, rel_dir, file_stat, language_id, counts))
+
+    def _remove(self, key: str) -> None:
+        old = self._files.pop(key, None)
+        if old is None:
+            return
+        node_id, entry = old
+        self.result.add_counts(
+            node_id, entry[3], LineCounts(-entry[4], -entry[5], -entry[6])
+        )
+
+    def _ignores(self, dir_path: Path) -> tuple[list[Path], bool]:
+        """
+        Return the .gitignore files applying to the entries of a directory,
+        from the root down to it, and whether it is inside a git repo, the same
+        way `collect_files` finds them.
+        """
+        if self.no_git_flag:
+            return [], False
+        ignore: list[Path] = []
+        in_repo = False
+        rel_dir = self._rel(dir_path)
+        parts = rel_dir.split("/") if rel_dir else []
+        cur_dir = self.root
+        for i in range(len(parts) + 1):
+            if i:
+                cur_dir = cur_dir / parts[i - 1]
+            if os.path.lexists(cur_dir / ".git"):
+                in_repo = True
+            if in_repo and os.path.lexists(cur_dir / ".gitignore"):
+                ignore.append(cur_dir / ".gitignore")
+        return ignore, in_repo
+
+    def _rel(self, path: Path) -> str:
+        rel_path = path.relative_to(self.root).as_posix()
+        return "" if rel_path == "." else rel_path
+
+    def _node(self, rel_dir: str) -> int:
+        return dir_node(self.result, self._dir_nodes, rel_dir)
+
+
+def _join(rel_dir: str, sub_dir: str) -> str:
+    return f"{rel_dir}/{sub_dir}" if rel_dir and sub_dir else rel_dir or sub_dir
+
+
+def _changes(
+    inotify: Inotify, events: list[InotifyEvent], root: Path
+) -> tuple[set[Path], set[Path]]:
+    """
+    Turn inotify events into directories to walk again and files to update.
+    """
+    rescan_dirs: set[Path] = set()
+    changed_files: set[Path] = set()
+    for dir_path, name, mask in events:
+        if dir_path is None:
+            rescan_dirs.add(root)  # events were lost
+        elif not name:
+            rescan_dirs.add(dir_path)  # the watched directory itself was deleted
+        elif name == ".gitignore" or name == ".git":
+            rescan_dirs.add(dir_path)
+        elif mask & _IN_ISDIR:
+            if mask & _IN_MOVED_FROM:
+                inotify.remove_watches(dir_path / name)
+            rescan_dirs.add(dir_path / name)
+        else:
+            changed_files.add(dir_path / name)
+    return rescan_dirs, changed_files
+
+
+class StatsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve the stats of a watched tree: a client sends a query line (see
+    `QUERIES`, "total" if empty) and receives one JSON document. Documents
+    are built once per generation of the tree, not per query.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, tree: WatchedTree) -> None:
+        self.tree = tree
+        # query -> (generation, encoded document)
+        self._documents: dict[str, tuple[int, bytes]] = {}
+        super().__init__(str(socket_path), _QueryHandler)
+
+    def document(self, query: str) -> bytes:
+        tree = self.tree
+        with tree.lock:
+            cached = self._documents.get(query)
+            if cached is not None and cached[0] == tree.generation:
+                return cached[1]
+            content = (
+                summary_dict(tree.result)
+                if query == "total"
+                else tree_dict(tree.result)
+            )
+            document: dict[str, Any] = {
+                "root": str(tree.root),
+                "generation": tree.generation,
+                "updated": time.time(),
+                **content,
+            }
+            encoded = json.dumps(document, separators=(",", ":")).encode("utf-8")
+            encoded += b"\n"
+            self._documents[query] = (tree.generation, encoded)
+            return encoded
+
+
+class _QueryHandler(socketserver.StreamRequestHandler):
+    timeout = 5.0
+
+    def handle(self) -> None:
+        assert isinstance(self.server, StatsServer)
+        try:
+            query = self.rfile.readline(64).decode("utf-8", "replace").strip()
+        except OSError:
+            return  # timed out
+        query = query or "total"
+        if query not in QUERIES:
+            error = {"error": f"unknown query {query!r}, expected one of {QUERIES}"}
+            self.wfile.write(json.dumps(error).encode("utf-8") + b"\n")
+            return
+        self.wfile.write(self.server.document(query))
+
+
+def query(socket_path: Path, query: str = "total") -> bytes:
+    """
+    Ask a running watcher for one of its documents.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall(f"{query}\n".encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        chunks: list[bytes] = []
+        while chunk := client.recv(1 << 16):
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _check_socket(socket_path: Path) -> None:
+    # a socket left behind by a watcher which died is replaced
+    if socket_path.is_socket():
+        try:
+            query(socket_path)
+        except OSError:
+            socket_path.unlink()
+        else:
+            raise OSError(f"Another watcher is serving {socket_path}")
+
+
+def watch(
+    path: Path,
+    no_git_flag: bool,
+    socket_path: Path,
+    cache_dir: Path | None = None,
+    jobs: int | None = None,
+    executor: str | None = None,
+    poll: float | None = None,
+) -> None:
+    """
+    Scan `path` once, then keep its stats up to date and serve them on
+    `socket_path` until interrupted. Changes are found with inotify, or by
+    walking the tree every `poll` seconds if given or if inotify is not available.
+    Only new and changed files are counted again.
+    """
+    _check_socket(socket_path)
+    config = LanguageConfig.load(cache_dir)
+    inotify: Inotify | None = None
+    if poll is None:
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            print(f"Cannot use inotify ({e}), polling every {DEFAULT_POLL_SECONDS}s")
+            poll = DEFAULT_POLL_SECONDS
+    tree = WatchedTree(
+        path, no_git_flag, config, inotify.add_watch if inotify is not None else None
+    )
+    tree.scan(cache_dir, jobs, executor)
+    if inotify is not None:
+        # changes made while the initial scan ran, before the directories were watched
+        tree.apply({path}, set())
+    server = StatsServer(socket_path, tree)
+    server.document("total")
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print(f"Watching {path}, serving stats on {socket_path}")
+    try:
+        while True:
+            if inotify is not None and inotify.error is not None:
+                print(
+                    f"Cannot watch all directories ({inotify.error}), polling instead"
+                )
+                inotify.close()
+                inotify = None
+                tree.on_dir = None
+                poll = poll or DEFAULT_POLL_SECONDS
+            if inotify is None:
+                assert poll is not None
+                time.sleep(poll)
+                tree.apply({path}, set())
+            else:
+                events = inotify.read(None)
+                deadline = time.monotonic() + MAX_DELAY_SECONDS
+                while time.monotonic() < deadline:
+                    more = inotify.read(DEBOUNCE_SECONDS)
+                    if not more:
+                        break
+                    events.extend(more)
+                rescan_dirs, changed_files = _changes(inotify, events, path)
+                for dir_path in rescan_dirs:
+                    tree.forget_ignore_file(dir_path / ".gitignore")
+                tree.apply(rescan_dirs, changed_files)
+            server.document("total")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        if inotify is not None:
+            inotify.close()